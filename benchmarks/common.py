@@ -0,0 +1,278 @@
+"""Shared helpers for the offline benchmark suite.
+
+Benchmarks never touch the real .h5 models, the weather API or MQTT. They
+build tiny stand-in Keras models with the same input and output shapes as
+the production models and feed them synthetic images, so results measure the
+code around the models and can be compared run-to-run on the same machine.
+"""
+import base64
+import io
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODELS_DIR = os.path.join(REPO_ROOT, "models")
+APP_DIR = os.path.join(REPO_ROOT, "tomatoApp")
+
+INPUT_SHAPE = (224, 224, 3)
+NUM_LEAF_CLASSES = 2
+NUM_DISEASE_CLASSES = 10
+
+
+def build_stub_model(num_classes: int, seed: int = 0, filters=(8, 16)):
+    """Small conv net with the production input shape and a softmax head"""
+    import tensorflow as tf
+
+    tf.random.set_seed(seed)
+    return tf.keras.Sequential([
+        tf.keras.Input(INPUT_SHAPE),
+        tf.keras.layers.Conv2D(filters[0], 3, strides=2, activation='relu'),
+        tf.keras.layers.Conv2D(filters[1], 3, strides=2, activation='relu'),
+        tf.keras.layers.GlobalAveragePooling2D(name='embedding_pool'),
+        tf.keras.layers.Dense(num_classes, activation='softmax')
+    ])
+
+
+def save_stub_models(directory: str) -> Dict[str, str]:
+    """Write stand-in leaf and disease models and return their paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = {
+        "leaf": os.path.join(directory, "leaf_stub.h5"),
+        "disease": os.path.join(directory, "disease_stub.h5")
+    }
+    build_stub_model(NUM_LEAF_CLASSES, seed=1).save(paths["leaf"])
+    build_stub_model(NUM_DISEASE_CLASSES, seed=2).save(paths["disease"])
+    return paths
+
+
+def import_model_server(model_dir: str):
+    """Import models/server.py with the stand-in models instead of the real ones"""
+    paths = save_stub_models(model_dir)
+    os.environ["LEAF_MODEL_PATH"] = paths["leaf"]
+    os.environ["DISEASE_MODEL_PATH"] = paths["disease"]
+    if MODELS_DIR not in sys.path:
+        sys.path.insert(0, MODELS_DIR)
+    import server
+    return server
+
+
+def import_client():
+    """Import the analysis client from tomatoApp"""
+    if APP_DIR not in sys.path:
+        sys.path.insert(0, APP_DIR)
+    import tomato_disease_client
+    return tomato_disease_client
+
+
+def synthetic_leaf_image(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """RGB uint8 image of a green ellipse with brown lesions on a light background"""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.full((height, width, 3), (215, 210, 200), dtype=np.uint8)
+
+    leaf = ((xx - width / 2) / (width * 0.4)) ** 2 + ((yy - height / 2) / (height * 0.35)) ** 2 <= 1
+    image[leaf] = (60, 140, 50)
+    for _ in range(12):
+        cx, cy = rng.integers(width * 0.3, width * 0.7), rng.integers(height * 0.3, height * 0.7)
+        radius = rng.integers(max(2, width // 60), max(3, width // 25))
+        lesion = ((xx - cx) ** 2 + (yy - cy) ** 2 <= radius ** 2) & leaf
+        image[lesion] = (120, 80, 40)
+
+    noise = rng.integers(-12, 13, size=image.shape)
+    return np.clip(image.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def encode_jpeg(image: np.ndarray, quality: int = 90) -> bytes:
+    """JPEG-encode an RGB array"""
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def synthetic_image_b64(width: int = 256, height: int = 256, seed: int = 0) -> str:
+    """Base64 JPEG payload in the format /predict expects"""
+    return base64.b64encode(encode_jpeg(synthetic_leaf_image(width, height, seed))).decode('utf-8')
+
+
+def summarize(latencies: List[float], wall_time: Optional[float] = None) -> Dict[str, float]:
+    """Latency percentiles in milliseconds and, if given the wall time, throughput"""
+    values = np.asarray(latencies) * 1000
+    result = {
+        "n": int(values.size),
+        "mean_ms": round(float(values.mean()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3)
+    }
+    if wall_time:
+        result["throughput_per_s"] = round(values.size / wall_time, 2)
+    return result
+
+
+def time_calls(func: Callable[[], object], iterations: int, warmup: int = 2) -> List[float]:
+    """Call func repeatedly and return per-call latencies in seconds"""
+    for _ in range(warmup):
+        func()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def start_stub_model_server(latency_ms: float = 20.0, slow_rate: float = 0.0, slow_ms: float = 500.0,
+                            error_rate: float = 0.0, seed: int = 0):
+    """A local HTTP server answering /health and /predict like models/server.py, without any model
+
+    Each /predict takes latency_ms, or slow_ms for a slow_rate fraction of
+    requests, and fails with a 500 for an error_rate fraction. Returns the
+    server's URL and a function that stops it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    prediction = json.dumps({"predicted_class": "Tomato_healthy", "confidence": 0.9, "is_valid_tomato": True}).encode()
+    health = json.dumps({"status": "healthy", "admission": {"in_flight": 0, "queued": 0}}).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self._reply(200, health)
+            else:
+                self._reply(404, b'{"error": "Not found"}')
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with lock:
+                slow, failed = rng.random() < slow_rate, rng.random() < error_rate
+            time.sleep((slow_ms if slow else latency_ms) / 1000)
+            if failed:
+                self._reply(500, b'{"error": "Stub server failure"}')
+            else:
+                self._reply(200, prediction)
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    def stop():
+        http_server.shutdown()
+        http_server.server_close()
+    return f"http://127.0.0.1:{http_server.server_port}", stop
+
+
+def start_stub_weather_api(latency_ms: float = 5.0):
+    """A local HTTP server answering the weatherapi.com current, history and forecast calls the client makes
+
+    Point the client at it with WEATHER_API_URL. Returns the base URL and a
+    function that stops the server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    day = {"date": "2024-01-01", "day": {"totalprecip_mm": 2.5, "avghumidity": 80, "avgtemp_c": 24.0}}
+    bodies = {
+        "/current.json": {"current": {"temp_c": 24.0, "humidity": 85, "wind_kph": 6.0, "pressure_mb": 1012,
+                                      "precip_mm": 0.4, "condition": {"text": "Partly cloudy"}}},
+        "/history.json": {"forecast": {"forecastday": [day]}},
+        "/forecast.json": {"forecast": {"forecastday": [day] * 3}}
+    }
+    bodies = {path: json.dumps(body).encode() for path, body in bodies.items()}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(latency_ms / 1000)
+            body = bodies.get(self.path.split("?")[0])
+            self.send_response(200 if body else 404)
+            body = body or b'{"error": "Not found"}'
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    http_server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    http_server.daemon_threads = True
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+
+    def stop():
+        http_server.shutdown()
+        http_server.server_close()
+    return f"http://127.0.0.1:{http_server.server_port}", stop
+
+
+def environment_info() -> Dict[str, str]:
+    """Machine and library versions recorded with every result file"""
+    info = {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__
+    }
+    try:
+        import tensorflow as tf
+        info["tensorflow"] = tf.__version__
+    except ImportError:
+        pass
+    return info
+
+
+def write_results(results: Dict, path: str) -> None:
+    """Save results as JSON"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def _flatten(results: Dict, prefix: str = "") -> Dict[str, float]:
+    """Flatten nested result dicts into dotted metric names"""
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare_to_baseline(results: Dict, baseline: Dict, threshold: float = 0.10) -> List[str]:
+    """Return a line per latency/throughput metric that regressed by more than threshold"""
+    current = _flatten(results.get("benchmarks", {}))
+    previous = _flatten(baseline.get("benchmarks", {}))
+    regressions = []
+    for name, value in sorted(current.items()):
+        old = previous.get(name)
+        if not old:
+            continue
+        if name.endswith("_ms") and value > old * (1 + threshold):
+            regressions.append(f"{name}: {old:.3f} -> {value:.3f} ms (+{(value / old - 1) * 100:.1f}%)")
+        elif name.endswith("_per_s") and value < old * (1 - threshold):
+            regressions.append(f"{name}: {old:.2f} -> {value:.2f}/s ({(value / old - 1) * 100:.1f}%)")
+    return regressions
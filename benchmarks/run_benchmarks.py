@@ -0,0 +1,841 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark suite for the inference and analysis hot paths.
+
+Suites:
+- server:          LeafDetectionServer.process_request throughput by concurrency
+- analysis:        process_image_analysis against analyze-only latency by resolution, and result sizes
+- analysis_pool:   concurrent analyses through AnalysisPool against one at a time in-process
+- recommendations: generate_recommendations latency per disease
+- http:            /predict through a local Flask server under a threaded load generator
+- tta:             predict_disease with test-time augmentation against single-view and K sequential calls
+- stream:          /predict_stream on a simulated scan against one process_request per frame
+- prefilter:       process_request on obvious non-leaf images with and without the colour prefilter
+- cascade:         predict_disease through the confidence cascade at no, partial and full escalation
+- compiled:        per-call latency of model.predict against the bucketed XLA-compiled path
+- cam:             disease_model with and without Grad-CAM, and a CAM_ACTIVATION_THRESHOLD calibrated against the colour rules
+- server_pool:     client requests to one stub model server against a balanced pool with a slow tail and a failing node
+- dataset:         dataset evaluation from JPEGs against the preprocessed tensor cache
+- similarity:      SimilarityIndex build rate, k-NN latency and recall on synthetic clustered embeddings
+- sensor_store:    SensorStore ingest rate across many devices, window query latency and memory per device
+- imports:         cold import time (-X importtime) and memory of the backend's modules, and the analysis libraries they defer
+
+Results are written as JSON; pass --baseline to compare against an earlier run.
+
+Example:
+    python benchmarks/run_benchmarks.py --output benchmarks/results/today.json --baseline benchmarks/results/main.json
+"""
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import numpy as np
+
+import common
+
+DISEASE_SAMPLE = [
+    'Tomato_Bacterial_spot',
+    'Tomato_Early_blight',
+    'Tomato_Septoria_leaf_spot',
+    'Tomato_healthy'
+]
+WEATHER_SAMPLE = {'temp_c': 24.0, 'humidity': 88.0, 'soil_moisture': 65.0}
+
+
+def _run_concurrent(func, total: int, concurrency: int) -> Dict[str, float]:
+    """Run func total times over a thread pool and summarize latency and throughput"""
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def timed_call(_):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Warm up every worker thread before timing
+        list(pool.map(lambda _: func(), range(concurrency)))
+        start = time.perf_counter()
+        list(pool.map(timed_call, range(total)))
+        wall_time = time.perf_counter() - start
+    return common.summarize(latencies, wall_time)
+
+
+def bench_server(server_module, args) -> Dict:
+    """process_request throughput at each concurrency level"""
+    image_data = common.synthetic_image_b64(256, 256)
+    leaf_server = server_module.server
+    results = {}
+    for concurrency in args.concurrency:
+        results[f"concurrency_{concurrency}"] = _run_concurrent(
+            lambda: leaf_server.process_request(image_data), args.requests, concurrency
+        )
+    return results
+
+
+def bench_analysis(client_module, args, workdir: str) -> Dict:
+    """process_image_analysis latency for each resolution, against analyze() without rendering
+
+    Also compares the AnalysisResult JSON /analyze now returns with the
+    base64 PNG it used to return.
+    """
+    import cv2
+
+    client = client_module.EnhancedTomatoDiseaseClient("http://127.0.0.1:1", "", "")
+    results = {}
+    for width, height in args.resolutions:
+        image_path = os.path.join(workdir, f"leaf_{width}x{height}.jpg")
+        image = common.synthetic_leaf_image(width, height)
+        cv2.imwrite(image_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+
+        per_class = {}
+        for predicted_class in DISEASE_SAMPLE[:3]:
+            prediction = {"predicted_class": predicted_class, "confidence": 0.9}
+            latencies = common.time_calls(
+                lambda: client.process_image_analysis(image_path, prediction),
+                args.analysis_iterations, warmup=1
+            )
+            per_class[predicted_class] = common.summarize(latencies)
+            image = client.load_image(image_path)
+            per_class[f"{predicted_class}_analyze_only"] = common.summarize(common.time_calls(
+                lambda: client.analyze(image, prediction), args.analysis_iterations, warmup=1
+            ))
+
+        prediction = {"predicted_class": DISEASE_SAMPLE[1], "confidence": 0.9}
+        result = client.analyze(client.load_image(image_path), prediction)
+        png_path = client.render_analysis(client.load_image(image_path), result,
+                                          os.path.join(workdir, f"analysis_{width}x{height}.png"))
+        with open(png_path, "rb") as f:
+            png_b64_bytes = len(base64.b64encode(f.read()))
+        result_bytes = len(json.dumps(result.to_dict()))
+        per_class["payload_bytes"] = {
+            "analysis_json": result_bytes,
+            "analysis_image_b64": png_b64_bytes,
+            "ratio": round(png_b64_bytes / result_bytes, 1)
+        }
+        results[f"{width}x{height}"] = per_class
+    return results
+
+
+def bench_analysis_pool(client_module, args, workdir: str) -> Dict:
+    """Analysis throughput through the process pool at each concurrency level
+
+    The baseline runs one analysis at a time in-process: pyplot is not
+    thread-safe, so that is the most the backend can do without the pool.
+    """
+    import cv2
+    from analysis_pool import AnalysisPool
+
+    client = client_module.EnhancedTomatoDiseaseClient("http://127.0.0.1:1", "", "")
+    width, height = args.resolutions[len(args.resolutions) // 2]
+    image_path = os.path.join(workdir, f"pool_leaf_{width}x{height}.jpg")
+    cv2.imwrite(image_path, cv2.cvtColor(common.synthetic_leaf_image(width, height), cv2.COLOR_RGB2BGR))
+    prediction = {"predicted_class": DISEASE_SAMPLE[1], "confidence": 0.9}
+
+    results = {"resolution": f"{width}x{height}"}
+    results["in_process"] = _run_concurrent(
+        lambda: client.process_image_analysis(image_path, prediction), args.pool_jobs, 1
+    )
+    start = time.perf_counter()
+    pool = AnalysisPool(args.pool_workers or None, max(args.concurrency) * 2, timeout=600)
+    results["pool_startup_seconds"] = round(time.perf_counter() - start, 2)
+    results["workers"] = pool.workers
+    try:
+        for concurrency in args.concurrency:
+            results[f"pool_concurrency_{concurrency}"] = _run_concurrent(
+                lambda: pool.analyze(image_path, prediction), args.pool_jobs, concurrency
+            )
+    finally:
+        pool.close()
+    return results
+
+
+def load_cam_images(args, width: int, height: int) -> List[np.ndarray]:
+    """RGB photos from --cam-image-dir, or synthetic leaves without one"""
+    if not args.cam_image_dir:
+        return [common.synthetic_leaf_image(width, height, seed=seed) for seed in range(args.cam_images)]
+    from PIL import Image
+    names = sorted(name for name in os.listdir(args.cam_image_dir)
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png')))[:args.cam_images]
+    return [np.asarray(Image.open(os.path.join(args.cam_image_dir, name)).convert('RGB')) for name in names]
+
+
+def bench_cam(server_module, client_module, args) -> Dict:
+    """Grad-CAM cost on the server, and the CAM_ACTIVATION_THRESHOLD that best matches detect_disease_regions
+
+    The threshold is swept over the 5th to 95th percentiles of the unscaled
+    activation on the leaves. At each one, agreement is the mean IoU of the
+    CAM and rule disease masks; the best is reported with its severity
+    difference in percentage points. With the stand-in models and synthetic
+    leaves the maps are meaningless, so only the latencies carry over. To
+    calibrate, point DISEASE_MODEL_PATH at the real model and --cam-image-dir
+    at photos of diseased leaves.
+    """
+    from response_format import decode_map
+
+    leaf_server = server_module.server
+    client = client_module.EnhancedTomatoDiseaseClient("http://127.0.0.1:1", "", "")
+    width, height = args.resolutions[len(args.resolutions) // 2]
+    predicted_class = DISEASE_SAMPLE[1]
+    batch = leaf_server.process_image(common.synthetic_image_b64(width, height))
+
+    results = {"resolution": f"{width}x{height}"}
+    results["predict"] = common.summarize(common.time_calls(
+        lambda: leaf_server.run_disease_model(batch), args.cam_iterations
+    ))
+    results["predict_with_cam"] = common.summarize(common.time_calls(
+        lambda: leaf_server.run_disease_cam(batch), args.cam_iterations
+    ))
+    results["predict_with_cam"]["ratio_vs_predict"] = round(
+        results["predict_with_cam"]["mean_ms"] / results["predict"]["mean_ms"], 2
+    )
+
+    rule_latencies, cam_latencies, samples = [], [], []
+    for image in load_cam_images(args, width, height):
+        image_data = base64.b64encode(common.encode_jpeg(image)).decode()
+        result = leaf_server.predict_disease(image_data, with_cam=True)
+        # Real photos are scored as the model classified them; stand-in predictions are noise
+        image_class = result["predicted_class"] if args.cam_image_dir else predicted_class
+        if 'healthy' in image_class:
+            continue
+        leaf_mask, _ = client.segment_leaf(image)
+
+        start = time.perf_counter()
+        rule_mask, _ = client.detect_disease_regions(image, leaf_mask, image_class)
+        rule_latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        activation = client.cam_activation(result["cam"], image.shape[:2])
+        client.cam_disease_regions(image, leaf_mask, image_class, activation, threshold=float(activation.mean()))
+        cam_latencies.append(time.perf_counter() - start)
+        samples.append((leaf_mask > 0, rule_mask > 0, activation))
+    if not samples:
+        return {"error": "No image was classified as diseased"}
+
+    leaf_activation = np.concatenate([activation[leaf] for leaf, _, activation in samples])
+    sweep = []
+    for threshold in np.unique(np.percentile(leaf_activation, np.arange(5, 100, 5))):
+        ious, severity_differences = [], []
+        for leaf, rule, activation in samples:
+            cam = leaf & (activation >= threshold)
+            union = np.logical_or(rule, cam).sum()
+            ious.append(np.logical_and(rule, cam).sum() / union if union else 1.0)
+            severity_differences.append(abs(int(rule.sum()) - int(cam.sum())) / max(int(leaf.sum()), 1) * 100)
+        sweep.append((float(np.mean(ious)), float(threshold), float(np.mean(severity_differences))))
+    best_iou, best_threshold, best_difference = max(sweep)
+
+    results["images"] = len(samples)
+    results["cam_shape"] = list(decode_map(result["cam"]).shape)
+    results["rule_regions"] = common.summarize(rule_latencies)
+    results["cam_regions"] = common.summarize(cam_latencies)
+    results["calibrated_threshold"] = round(best_threshold, 6)
+    results["mask_iou_mean"] = round(best_iou, 4)
+    results["severity_difference_mean"] = round(best_difference, 2)
+    results["iou_by_threshold"] = {f"{threshold:.6g}": round(iou, 4) for iou, threshold, _ in sweep}
+    return results
+
+
+def bench_server_pool(client_module, args) -> Dict:
+    """Client /predict latency against one stub model server and against a ModelServerPool of three
+
+    Every healthy stub answers in 20 ms but 5% of requests take 400 ms; in the
+    pool, one node also fails half its requests. Hedging cuts the slow tail
+    and ejection takes the failing node out of rotation.
+    """
+    from model_server_pool import ModelServerPool
+
+    payload = {"image": common.synthetic_image_b64(64, 64)}
+    layouts = {
+        "single": [{}],
+        "pool": [{}, {}, {"error_rate": 0.5}],
+        "pool_no_hedging": [{}, {}, {"error_rate": 0.5}]
+    }
+    results = {}
+    for name, nodes in layouts.items():
+        servers = [common.start_stub_model_server(20.0, 0.05, 400.0, seed=i, **node) for i, node in enumerate(nodes)]
+        urls = [url for url, _ in servers]
+        pool = ModelServerPool(urls, health_interval=1.0, eject_seconds=5.0, hedge_after=0.1)
+        if name == "pool_no_hedging":
+            pool.max_hedge_ratio = 0.0
+        # Route the client's calls through this pool instead of the process-wide shared one
+        ModelServerPool._shared[tuple(urls)] = pool
+        client = client_module.EnhancedTomatoDiseaseClient(",".join(urls), "", "", request_timeout=10.0)
+        errors = []
+
+        def post():
+            if client._post_with_deadline("/predict", payload).status_code != 200:
+                errors.append(1)
+
+        try:
+            results[name] = _run_concurrent(post, args.server_pool_requests, args.server_pool_concurrency)
+            stats = pool.stats()
+            results[name].update({
+                "errors": len(errors),
+                "hedges": stats["hedges"],
+                "ejections": sum(endpoint["ejections"] for endpoint in stats["endpoints"])
+            })
+        finally:
+            pool.close()
+            del ModelServerPool._shared[tuple(urls)]
+            for _, stop in servers:
+                stop()
+    return results
+
+
+def bench_recommendations(client_module, args) -> Dict:
+    """generate_recommendations latency per disease"""
+    client = client_module.EnhancedTomatoDiseaseClient("http://127.0.0.1:1", "", "")
+    results = {}
+    for predicted_class in DISEASE_SAMPLE:
+        latencies = common.time_calls(
+            lambda: client.generate_recommendations(predicted_class, 0.85, WEATHER_SAMPLE),
+            args.recommendation_iterations
+        )
+        results[predicted_class] = common.summarize(latencies)
+    return results
+
+
+def bench_http(server_module, args) -> Dict:
+    """/predict latency and throughput through a local threaded Flask server"""
+    import requests
+    from werkzeug.serving import make_server
+
+    http_server = make_server("127.0.0.1", 0, server_module.app, threaded=True)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{http_server.server_port}/predict"
+    payload = json.dumps({"image": common.synthetic_image_b64(256, 256)})
+    local = threading.local()
+
+    def post():
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        response = session.post(url, data=payload, headers={"Content-Type": "application/json"}, timeout=60)
+        # 400 is the expected "not a tomato leaf" answer from the stand-in models
+        if response.status_code not in (200, 400):
+            raise RuntimeError(f"/predict returned {response.status_code}: {response.text[:200]}")
+
+    results = {}
+    try:
+        for concurrency in args.concurrency:
+            results[f"concurrency_{concurrency}"] = _run_concurrent(post, args.requests, concurrency)
+    finally:
+        http_server.shutdown()
+    return results
+
+
+def bench_tta(server_module, args) -> Dict:
+    """Batched TTA latency relative to one view and to K separate predict calls"""
+    image_data = common.synthetic_image_b64(1024, 768)
+    leaf_server = server_module.server
+    single = common.summarize(common.time_calls(
+        lambda: leaf_server.predict_disease(image_data), args.tta_iterations
+    ))
+    results = {"single_view": single}
+    for views in args.tta_views:
+        batched = common.summarize(common.time_calls(
+            lambda: leaf_server.predict_disease(image_data, tta_views=views), args.tta_iterations
+        ))
+        sequential = common.summarize(common.time_calls(
+            lambda: [leaf_server.predict_disease(image_data) for _ in range(views)], max(1, args.tta_iterations // 4)
+        ))
+        batched["ratio_vs_single"] = round(batched["mean_ms"] / single["mean_ms"], 2)
+        batched["ratio_vs_sequential"] = round(batched["mean_ms"] / sequential["mean_ms"], 2)
+        results[f"views_{views}"] = batched
+    return results
+
+
+def _scan_frames(args) -> List[str]:
+    """Base64 JPEG frames of a slow scan: each view is held for a few frames with sensor noise"""
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(args.stream_frames):
+        view = i // args.stream_hold
+        image = np.roll(common.synthetic_leaf_image(640, 480, seed=view), view * 40, axis=1)
+        noisy = np.clip(image.astype(np.int16) + rng.integers(-4, 5, size=image.shape), 0, 255).astype(np.uint8)
+        frames.append(base64.b64encode(common.encode_jpeg(noisy)).decode('utf-8'))
+    return frames
+
+
+def bench_stream(server_module, args) -> Dict:
+    """Frames per second through /predict_stream's dedup and batching against per-frame process_request"""
+    frames = _scan_frames(args)
+    leaf_server = server_module.server
+    lines = [json.dumps({"image": frame, "frame_id": i}) for i, frame in enumerate(frames)]
+
+    def per_frame():
+        for frame in frames:
+            leaf_server.process_request(frame, store=False)
+
+    summary = {}
+
+    def streamed():
+        for result in server_module.stream_predictions(lines, args.stream_batch_size, server_module.STREAM_HASH_THRESHOLD,
+                                                       server_module.STREAM_MAX_SKIPPED):
+            if "summary" in result:
+                summary.update(result["summary"])
+
+    results = {}
+    for name, func in (("per_frame", per_frame), ("stream", streamed)):
+        stats = common.summarize(common.time_calls(func, args.stream_iterations, warmup=1))
+        stats["frames_per_s"] = round(len(frames) / (stats["mean_ms"] / 1000), 1)
+        results[name] = stats
+    results["stream"]["skipped_fraction"] = round(summary["skipped_fraction"], 3)
+    results["stream"]["batches"] = summary["batches"]
+    results["cost_ratio"] = round(results["stream"]["mean_ms"] / results["per_frame"]["mean_ms"], 3)
+    return results
+
+
+def bench_prefilter(server_module, args) -> Dict:
+    """Rejecting blank, sky and soil frames with the colour prefilter against running leaf_model"""
+    rng = np.random.default_rng(0)
+    images = {}
+    for name, colour in (("wall", (215, 210, 200)), ("sky", (120, 170, 230)), ("soil", (110, 80, 50))):
+        noisy = np.full((768, 1024, 3), colour, dtype=np.int16) + rng.integers(-10, 11, size=(768, 1024, 3))
+        images[name] = base64.b64encode(common.encode_jpeg(np.clip(noisy, 0, 255).astype(np.uint8))).decode('utf-8')
+    images["leaf"] = common.synthetic_image_b64(1024, 768)
+
+    leaf_server = server_module.server
+    prefilter = leaf_server.prefilter or server_module.LeafPrefilter()
+    results = {}
+    try:
+        for name, image_data in images.items():
+            leaf_server.prefilter = prefilter
+            with_prefilter = common.summarize(common.time_calls(
+                lambda: leaf_server.process_request(image_data, store=False), args.prefilter_iterations
+            ))
+            leaf_server.prefilter = None
+            without_prefilter = common.summarize(common.time_calls(
+                lambda: leaf_server.process_request(image_data, store=False), args.prefilter_iterations
+            ))
+            with_prefilter["speedup"] = round(without_prefilter["mean_ms"] / with_prefilter["mean_ms"], 2)
+            with_prefilter["outcome"] = prefilter.check(leaf_server.decode_image(image_data))["outcome"]
+            results[name] = {"prefilter": with_prefilter, "leaf_model": without_prefilter}
+    finally:
+        leaf_server.prefilter = prefilter
+    return results
+
+
+def bench_cascade(server_module, args, workdir: str) -> Dict:
+    """predict_disease with the cascade off, and on with thresholds that escalate none, some or all images"""
+    leaf_server = server_module.server
+    images = [common.synthetic_image_b64(512, 384, seed=i) for i in range(args.cascade_images)]
+    cascade_path = os.path.join(workdir, "models", "cascade_stub.h5")
+    common.build_stub_model(common.NUM_DISEASE_CLASSES, seed=3, filters=(4, 8)).save(cascade_path)
+    if leaf_server.cascade is None:
+        leaf_server.enable_cascade(cascade_path, server_module.CascadePolicy())
+    policy = leaf_server.cascade
+
+    def run_all():
+        for image_data in images:
+            leaf_server.predict_disease(image_data)
+
+    # The median top-1 probability of the stand-in cascade model escalates about half the images
+    cascade_model = leaf_server.registry.current("cascade").model
+    median = float(np.median([cascade_model.predict(leaf_server.process_image(image_data), verbose=0).max()
+                              for image_data in images]))
+    settings = {"full_model": None, "none_escalated": (0.0, 0.0), "half_escalated": (median, 0.0),
+                "all_escalated": (1.01, 0.0)}
+    results = {}
+    try:
+        for name, thresholds in settings.items():
+            if thresholds is None:
+                leaf_server.cascade = None
+            else:
+                leaf_server.cascade = server_module.CascadePolicy(*thresholds, audit_rate=0.0)
+            latencies = common.time_calls(run_all, args.cascade_iterations, warmup=1)
+            results[name] = common.summarize([seconds / len(images) for seconds in latencies])
+            if thresholds is not None:
+                results[name]["escalation_rate"] = leaf_server.cascade.stats()["escalation_rate"]
+    finally:
+        leaf_server.cascade = policy
+    return results
+
+
+def bench_compiled(args) -> Dict:
+    """Per-call latency of model.predict, a direct call, and CompiledModel with and without XLA"""
+    if common.MODELS_DIR not in sys.path:
+        sys.path.insert(0, common.MODELS_DIR)
+    import tensorflow as tf
+    from compiled_inference import CompiledModel
+
+    model = common.build_stub_model(common.NUM_DISEASE_CLASSES, seed=2)
+    start = time.perf_counter()
+    xla = CompiledModel(model, args.compiled_buckets, jit_compile=True)
+    compile_seconds = time.perf_counter() - start
+    graph = CompiledModel(model, args.compiled_buckets, jit_compile=False)
+
+    rng = np.random.default_rng(0)
+    results = {"xla_compile_seconds": round(compile_seconds, 2), "buckets": list(xla.buckets)}
+    for batch_size in args.compiled_batch_sizes:
+        batch = rng.random((batch_size,) + common.INPUT_SHAPE, dtype=np.float32)
+        paths = {
+            "keras_predict": lambda: model.predict(batch, verbose=0),
+            "keras_call": lambda: model(tf.constant(batch), training=False).numpy(),
+            "compiled_graph": lambda: graph.predict(batch),
+            "compiled_xla": lambda: xla.predict(batch)
+        }
+        per_batch = {name: common.summarize(common.time_calls(call, args.compiled_iterations, warmup=3))
+                     for name, call in paths.items()}
+        per_batch["predict_overhead_ms"] = round(
+            per_batch["keras_predict"]["p50_ms"] - per_batch["compiled_xla"]["p50_ms"], 3
+        )
+        per_batch["bucket"] = xla.bucket_for(batch_size)
+        results[f"batch_{batch_size}"] = per_batch
+    return results
+
+
+def bench_dataset(server_module, args, workdir: str) -> Dict:
+    """Evaluating disease_model on a JPEG tree against evaluating it from the preprocessed cache"""
+    import preprocess_cache
+
+    dataset_dir = os.path.join(workdir, "dataset")
+    class_names = server_module.server.disease_class_names[:4]
+    for i in range(args.dataset_images):
+        class_dir = os.path.join(dataset_dir, class_names[i % len(class_names)])
+        os.makedirs(class_dir, exist_ok=True)
+        with open(os.path.join(class_dir, f"{i:05d}.jpg"), 'wb') as f:
+            f.write(common.encode_jpeg(common.synthetic_leaf_image(256, 256, seed=i)))
+    model = server_module.server.disease_model
+
+    def from_jpegs():
+        paths, _ = preprocess_cache.list_dataset(dataset_dir)
+        for start in range(0, len(paths), args.dataset_batch_size):
+            batch = np.stack([
+                preprocess_cache.load_image(os.path.join(dataset_dir, path))
+                for path in paths[start:start + args.dataset_batch_size]
+            ]).astype(np.float32) / 255.0
+            model.predict(batch, verbose=0)
+
+    prefix = os.path.join(workdir, "cache", "dataset")
+    results = {"jpeg": common.summarize(common.time_calls(from_jpegs, args.dataset_iterations, warmup=1))}
+    results["build"] = common.summarize(common.time_calls(
+        lambda: preprocess_cache.build(dataset_dir, prefix), 1, warmup=0
+    ))
+    cache = preprocess_cache.PreprocessedCache(prefix)
+    results["cached"] = common.summarize(common.time_calls(
+        lambda: preprocess_cache.evaluate(cache, model, class_names, args.dataset_batch_size),
+        args.dataset_iterations, warmup=1
+    ))
+    split = preprocess_cache.evaluate(cache, model, class_names, args.dataset_batch_size)
+    results["cached"]["input_share"] = round(split["input_seconds"] / (split["input_seconds"] + split["inference_seconds"]), 3)
+    results["speedup"] = round(results["jpeg"]["mean_ms"] / results["cached"]["mean_ms"], 2)
+    return results
+
+
+def _clustered_embeddings(rng, centres: np.ndarray, n: int) -> np.ndarray:
+    """Synthetic non-negative embeddings scattered around class-like centres"""
+    labels = rng.integers(0, len(centres), n)
+    noise = rng.standard_normal((n, centres.shape[1]), dtype=np.float32)
+    return np.maximum(centres[labels] + 0.6 * noise, 0)
+
+
+def bench_similarity(args, workdir: str) -> Dict:
+    """Similar-case index build rate, k-NN latency per nprobe and recall@k against exact search"""
+    if common.MODELS_DIR not in sys.path:
+        sys.path.insert(0, common.MODELS_DIR)
+    from similarity_index import SimilarityIndex
+
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((512, args.embedding_dim), dtype=np.float32)
+    # Train once, explicitly, after the bulk load instead of on the way up
+    index = SimilarityIndex(os.path.join(workdir, "similarity"), args.embedding_dim,
+                            train_size=args.similarity_vectors + 1, retrain_factor=float("inf"))
+
+    start = time.perf_counter()
+    chunk = 50000
+    for offset in range(0, args.similarity_vectors, chunk):
+        n = min(chunk, args.similarity_vectors - offset)
+        index.add_batch(_clustered_embeddings(rng, centres, n), [{"predicted_class": "synthetic"}] * n)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    index.train()
+    train_time = time.perf_counter() - start
+
+    results = {
+        "vectors": index.count,
+        "build_vectors_per_s": round(index.count / build_time, 1),
+        "train_ms": round(train_time * 1000, 1),
+        "disk_mb": round(index.stats()["disk_bytes"] / 1e6, 1),
+        "lists": index.stats()["lists"]
+    }
+    results["add_one"] = common.summarize(common.time_calls(
+        lambda: index.add(_clustered_embeddings(rng, centres, 1)[0], {"predicted_class": "synthetic"}), 200
+    ))
+
+    queries = index.project(_clustered_embeddings(rng, centres, args.similarity_queries))
+    exact_ids = [{n["id"] for n in index.search(vector=q, k=args.similarity_k, exact=True)} for q in queries[:20]]
+    results["exact"] = common.summarize(common.time_calls(
+        lambda: index.search(vector=queries[0], k=args.similarity_k, exact=True), 5, warmup=1
+    ))
+    for nprobe in args.similarity_nprobe:
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            index.search(vector=query, k=args.similarity_k, nprobe=nprobe)
+            latencies.append(time.perf_counter() - start)
+        summary = common.summarize(latencies)
+        hits = [
+            len(expected & {n["id"] for n in index.search(vector=q, k=args.similarity_k, nprobe=nprobe)})
+            for q, expected in zip(queries, exact_ids)
+        ]
+        summary[f"recall_at_{args.similarity_k}"] = round(sum(hits) / (len(hits) * args.similarity_k), 3)
+        results[f"nprobe_{nprobe}"] = summary
+    return results
+
+
+def bench_sensor_store(args) -> Dict:
+    """Sample ingest rate over --sensor-devices, 24-hour window latency and memory per device
+
+    A day of history at one sample every --sensor-interval seconds is loaded
+    first, so the rollup rings are full when the queries run.
+    """
+    if common.APP_DIR not in sys.path:
+        sys.path.insert(0, common.APP_DIR)
+    from sensor_store import SensorStore, parse_readings
+
+    rng = np.random.default_rng(0)
+    store = SensorStore(max_devices=args.sensor_devices)
+    now = time.time()
+    timestamps = np.arange(now - 24 * 3600, now, args.sensor_interval)
+    readings = [parse_readings({"temperature": 20 + 5 * rng.random(), "humidity": 50 + 40 * rng.random(),
+                                "light_intensity": 1000 * rng.random(), "soil_moisture": 100 * rng.random()})
+                for _ in range(64)]
+    device_ids = [f"pi-{i}" for i in range(args.sensor_devices)]
+
+    start = time.perf_counter()
+    samples = 0
+    for i, timestamp in enumerate(timestamps):
+        for j, device_id in enumerate(device_ids):
+            store.add(device_id, readings[(i + j) % len(readings)], timestamp)
+        samples += len(device_ids)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "devices": args.sensor_devices,
+        "samples": samples,
+        "ingest_samples_per_s": round(samples / elapsed),
+        "ingest_us_per_sample": round(elapsed / samples * 1e6, 2)
+    }
+    for label, seconds in (("1h", 3600), ("24h", 24 * 3600)):
+        results[f"window_{label}"] = common.summarize(common.time_calls(
+            lambda: store.window_mean("humidity", seconds, device_ids[-1]), args.sensor_queries, warmup=10
+        ))
+    results["latest"] = common.summarize(common.time_calls(
+        lambda: store.latest(device_ids[-1]), args.sensor_queries, warmup=10
+    ))
+    stats = store.stats()
+    results["memory_bytes"] = stats["memory_bytes"]
+    results["memory_bytes_per_device"] = stats["memory_bytes"] // max(1, stats["devices"])
+    return results
+
+
+IMPORT_TARGETS = {
+    "tomato_disease_client": "import tomato_disease_client",
+    "analysis_pool": "import analysis_pool",
+    "analysis_result": "import analysis_result",
+    "sensor_store": "import sensor_store",
+    # What the first analysis in a process pays on top of the client
+    "analysis_libraries": "import cv2, matplotlib.pyplot, mahotas, scipy.ndimage, skimage.feature"
+}
+ANALYSIS_LIBRARIES = ("cv2", "matplotlib", "mahotas", "scipy", "skimage")
+
+_IMPORT_PROBE = """
+import json, sys, time
+sys.stderr.write("--- start\\n")
+sys.stderr.flush()
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+# VmHWM rather than ru_maxrss, which keeps the parent's peak across fork and exec
+with open("/proc/self/status") as status:
+    peak_kb = next(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+print(json.dumps({{"seconds": elapsed, "max_rss_kb": peak_kb,
+                  "loaded": sorted(m for m in {libraries!r} if m in sys.modules)}}))
+"""
+
+
+def _cold_import(statement: str) -> Dict:
+    """Run an import statement in a fresh interpreter under -X importtime
+
+    Returns the wall time, peak RSS, which analysis libraries ended up in
+    sys.modules, and the cumulative microseconds of each module the statement
+    imported directly (depth 0) or through them (depth 1).
+    """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [common.APP_DIR, os.environ.get("PYTHONPATH")]))}
+    probe = _IMPORT_PROBE.format(statement=statement, libraries=ANALYSIS_LIBRARIES)
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], env=env,
+                               capture_output=True, text=True, check=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["imports"] = []
+    # Lines look like "import time: self [us] | cumulative | imported package", indented two spaces per level
+    lines = completed.stderr.splitlines()
+    for line in lines[lines.index("--- start") + 1:]:
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1 and cumulative.strip().isdigit():
+            result["imports"].append((depth, name.strip(), int(cumulative)))
+    return result
+
+
+def bench_imports(args) -> Dict:
+    """Cold import time and peak RSS of the modules the mobile backend loads at start-up
+
+    Each import runs --import-runs times in a fresh interpreter, after one run
+    that writes the bytecode caches. The image-analysis libraries should only
+    appear under analysis_libraries: the client imports them on first use.
+    """
+    results = {}
+    for target, statement in IMPORT_TARGETS.items():
+        _cold_import(statement)
+        runs = [_cold_import(statement) for _ in range(args.import_runs)]
+        named = {module.strip() for module in statement[len("import "):].split(",")}
+        results[target] = {
+            **common.summarize([run["seconds"] for run in runs]),
+            "importtime_ms": round(float(np.median([
+                sum(us for depth, _, us in run["imports"] if depth == 0) for run in runs
+            ])) / 1000, 1),
+            "max_rss_mb": round(float(np.median([run["max_rss_kb"] for run in runs])) / 1024, 1),
+            "analysis_libraries_loaded": runs[-1]["loaded"],
+            "slowest_imports": [
+                [module, round(us / 1000, 1)]
+                for _, module, us in sorted(runs[-1]["imports"], key=lambda item: item[2], reverse=True)
+                if module not in named
+            ][:5]
+        }
+    return results
+
+
+SUITES = ("server", "analysis", "analysis_pool", "recommendations", "http", "tta", "stream", "prefilter", "cascade",
+          "compiled", "cam", "server_pool", "dataset", "similarity", "sensor_store", "imports")
+
+
+def main():
+    """Run the selected suites and write the results"""
+    parser = argparse.ArgumentParser(description='Offline benchmarks for the tomato disease pipeline')
+    parser.add_argument('--suites', nargs='+', choices=SUITES, default=list(SUITES))
+    parser.add_argument('--output', default=os.path.join(common.REPO_ROOT, 'benchmarks', 'results', 'latest.json'),
+                        help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='Relative change reported as a regression')
+    parser.add_argument('--requests', type=int, default=50, help='Requests per concurrency level')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--resolutions', type=lambda s: tuple(int(v) for v in s.split('x')), nargs='+',
+                        default=[(256, 256), (1024, 768), (2048, 1536)], help='WIDTHxHEIGHT values')
+    parser.add_argument('--analysis-iterations', type=int, default=3)
+    parser.add_argument('--pool-jobs', type=int, default=16, help='Analyses per analysis_pool measurement')
+    parser.add_argument('--pool-workers', type=int, default=0, help='Analysis pool size (default: CPU count)')
+    parser.add_argument('--recommendation-iterations', type=int, default=1000)
+    parser.add_argument('--tta-views', type=int, nargs='+', default=[4, 8])
+    parser.add_argument('--tta-iterations', type=int, default=20)
+    parser.add_argument('--stream-frames', type=int, default=60)
+    parser.add_argument('--stream-hold', type=int, default=6, help='Consecutive frames showing the same view')
+    parser.add_argument('--stream-batch-size', type=int, default=8)
+    parser.add_argument('--stream-iterations', type=int, default=5)
+    parser.add_argument('--prefilter-iterations', type=int, default=20)
+    parser.add_argument('--cascade-images', type=int, default=20)
+    parser.add_argument('--cascade-iterations', type=int, default=5)
+    parser.add_argument('--compiled-batch-sizes', type=int, nargs='+', default=[1, 3, 8])
+    parser.add_argument('--compiled-buckets', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--compiled-iterations', type=int, default=50)
+    parser.add_argument('--cam-images', type=int, default=10)
+    parser.add_argument('--cam-image-dir', help='Photos of diseased leaves to calibrate CAM_ACTIVATION_THRESHOLD on')
+    parser.add_argument('--cam-iterations', type=int, default=20)
+    parser.add_argument('--server-pool-requests', type=int, default=200)
+    parser.add_argument('--server-pool-concurrency', type=int, default=4)
+    parser.add_argument('--dataset-images', type=int, default=512)
+    parser.add_argument('--dataset-batch-size', type=int, default=64)
+    parser.add_argument('--dataset-iterations', type=int, default=3)
+    parser.add_argument('--similarity-vectors', type=int, default=1000000)
+    parser.add_argument('--similarity-queries', type=int, default=200)
+    parser.add_argument('--similarity-k', type=int, default=10)
+    parser.add_argument('--similarity-nprobe', type=int, nargs='+', default=[8, 16, 32])
+    parser.add_argument('--embedding-dim', type=int, default=1280, help='disease_model penultimate width')
+    parser.add_argument('--sensor-devices', type=int, default=300)
+    parser.add_argument('--sensor-interval', type=float, default=60.0, help='Seconds between samples per device')
+    parser.add_argument('--sensor-queries', type=int, default=1000)
+    parser.add_argument('--import-runs', type=int, default=5, help='Fresh interpreters per imports measurement')
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.output)
+    # Read the baseline before the suites chdir into a temporary directory
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    results = {"environment": common.environment_info(), "config": vars(args).copy(), "benchmarks": {}}
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The client writes its rendered analyses below the working directory
+        os.chdir(workdir)
+        server_module = None
+        if {"server", "http", "tta", "stream", "prefilter", "cascade", "cam", "dataset"} & set(args.suites):
+            server_module = common.import_model_server(os.path.join(workdir, "models"))
+        client_module = None
+        if {"analysis", "analysis_pool", "recommendations", "cam", "server_pool"} & set(args.suites):
+            client_module = common.import_client()
+
+        for suite in args.suites:
+            print(f"Running {suite} benchmarks...")
+            if suite == "server":
+                results["benchmarks"][suite] = bench_server(server_module, args)
+            elif suite == "analysis":
+                results["benchmarks"][suite] = bench_analysis(client_module, args, workdir)
+            elif suite == "analysis_pool":
+                results["benchmarks"][suite] = bench_analysis_pool(client_module, args, workdir)
+            elif suite == "recommendations":
+                results["benchmarks"][suite] = bench_recommendations(client_module, args)
+            elif suite == "http":
+                results["benchmarks"][suite] = bench_http(server_module, args)
+            elif suite == "tta":
+                results["benchmarks"][suite] = bench_tta(server_module, args)
+            elif suite == "stream":
+                results["benchmarks"][suite] = bench_stream(server_module, args)
+            elif suite == "prefilter":
+                results["benchmarks"][suite] = bench_prefilter(server_module, args)
+            elif suite == "cascade":
+                results["benchmarks"][suite] = bench_cascade(server_module, args, workdir)
+            elif suite == "compiled":
+                results["benchmarks"][suite] = bench_compiled(args)
+            elif suite == "cam":
+                results["benchmarks"][suite] = bench_cam(server_module, client_module, args)
+            elif suite == "server_pool":
+                results["benchmarks"][suite] = bench_server_pool(client_module, args)
+            elif suite == "dataset":
+                results["benchmarks"][suite] = bench_dataset(server_module, args, workdir)
+            elif suite == "similarity":
+                results["benchmarks"][suite] = bench_similarity(args, workdir)
+            elif suite == "sensor_store":
+                results["benchmarks"][suite] = bench_sensor_store(args)
+            elif suite == "imports":
+                results["benchmarks"][suite] = bench_imports(args)
+
+    common.write_results(results, output_path)
+    print(json.dumps(results["benchmarks"], indent=2))
+    print(f"Results written to {output_path}")
+
+    if baseline is not None:
+        regressions = common.compare_to_baseline(results, baseline, args.threshold)
+        if regressions:
+            print(f"\nRegressions beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"\nNo regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Memory soak test for the mobile backend.
+
+Runs the code of tomatoApp/mobile_backend.ipynb in-process without starting
+its server. The backend is pointed at a stub model server and a stub weather
+API (see common.py), and its sensor store is seeded so no MQTT broker is
+needed. Then thousands of /analyze requests go through Flask's test client;
+some are asynchronous jobs and some ask for the rendered figure.
+
+The backend's /debug/memory is read after the warm-up requests and again at
+the end, once every job has finished. The run fails (exit status 1) when,
+compared with the warm-up:
+- the backend's RSS or its analysis workers' RSS kept more than --max-rss-growth-mb
+  of growth: the lowest of the last quarter of samples against the lowest of the first
+- open file descriptors grew by more than --max-fd-growth, or threads by more than --max-thread-growth
+- temp files or pyplot figures were left behind
+- any request failed
+
+The top tracemalloc growth since start-up is printed with the result, to
+show where a leak is coming from.
+
+Example:
+    python benchmarks/soak_backend.py --requests 5000 --concurrency 4 --output benchmarks/results/soak.json
+"""
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import common
+
+DEVICE_ID = "soak-pi"
+ADMIN_TOKEN = "soak"
+
+
+def load_backend():
+    """Execute the backend notebook's code as the module mobile_backend; its __main__ block does not run"""
+    path = os.path.join(common.APP_DIR, "mobile_backend.ipynb")
+    with open(path) as f:
+        notebook = json.load(f)
+    source = "\n".join("".join(cell["source"]) for cell in notebook["cells"] if cell["cell_type"] == "code")
+    if common.APP_DIR not in sys.path:
+        sys.path.insert(0, common.APP_DIR)
+    module = types.ModuleType("mobile_backend")
+    module.__file__ = path
+    sys.modules["mobile_backend"] = module
+    exec(compile(source, path, "exec"), module.__dict__)
+    return module
+
+
+def seed_sensors(backend) -> None:
+    """A fresh reading, so /analyze uses the sensor store instead of asking the Pis over MQTT"""
+    from sensor_store import parse_readings
+    backend.sensor_store.add(DEVICE_ID, parse_readings({
+        "temperature": 24.0, "humidity": 85.0, "light_intensity": 700.0, "soil_moisture": 55.0
+    }))
+
+
+def memory_report(client) -> Dict:
+    """The backend's /debug/memory after a sample, once garbage has been collected"""
+    gc.collect()
+    response = client.get("/debug/memory?sample=1", headers={"X-Admin-Token": ADMIN_TOKEN})
+    return response.get_json()
+
+
+def wait_for_jobs(backend, timeout: float) -> None:
+    """Wait until no asynchronous job is queued or running"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = backend.analysis_jobs.stats()
+        if not stats["running"] and not stats["queued"]:
+            return
+        time.sleep(0.1)
+
+
+def run_soak(backend, args, image_b64: str) -> Dict:
+    """Send the warm-up and soak requests; returns measurements before and after"""
+    local = threading.local()
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def analyze(i: int) -> None:
+        if not hasattr(local, "client"):
+            local.client = backend.app.test_client()
+        seed_sensors(backend)
+        body = {"image": image_b64, "location": "Soak"}
+        # Seeded per request, so every run sends the same mix
+        rng = random.Random(i)
+        if rng.random() < args.render_fraction or i < renders_in_warmup:
+            body["render_image"] = True
+        if rng.random() < args.async_fraction:
+            body["async"] = True
+        response = local.client.post("/analyze", json=body)
+        status = response.status_code
+        if status == 202:
+            job_url = response.get_json()["status_url"]
+            while True:
+                job = local.client.get(job_url).get_json()
+                if job["status"] in ("done", "failed"):
+                    status = job.get("error", {}).get("status", 200) if job["status"] == "failed" else 200
+                    break
+                time.sleep(0.02)
+        with lock:
+            statuses[status] += 1
+
+    # The first figure a worker renders grows its heap by about 100 MB for good; do that before measuring
+    renders_in_warmup = min(args.warmup, 4 * max(args.workers, 1))
+    client = backend.app.test_client()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(analyze, range(args.warmup)))
+    wait_for_jobs(backend, 60)
+    before = memory_report(client)
+
+    trajectory = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for offset in range(0, args.requests, args.sample_every):
+            count = min(args.sample_every, args.requests - offset)
+            list(executor.map(analyze, range(args.warmup + offset, args.warmup + offset + count)))
+            current = memory_report(client)["current"]
+            trajectory.append({
+                "requests": offset + count,
+                "rss_mb": round(current["rss_bytes"] / 2 ** 20, 1),
+                "children_rss_mb": round(current["children_rss_bytes"] / 2 ** 20, 1),
+                "open_fds": current["open_fds"],
+                "temp_files": current.get("temp_files")
+            })
+            print(f"  {offset + count} requests: RSS {trajectory[-1]['rss_mb']} MB, workers "
+                  f"{trajectory[-1]['children_rss_mb']} MB, {current['open_fds']} fds, "
+                  f"{current.get('temp_files')} temp files")
+    elapsed = time.perf_counter() - start
+    wait_for_jobs(backend, 60)
+    after = memory_report(client)
+    return {"before": before, "after": after, "trajectory": trajectory, "statuses": dict(statuses),
+            "requests_per_s": round(args.requests / elapsed, 2)}
+
+
+def sustained_growth(samples: List[float]) -> float:
+    """Lowest value in the last quarter of the samples minus the lowest in the first quarter
+
+    Rendering a figure briefly adds tens of MB to a worker, so the end of a
+    run against its start would flag noise. Growth that survives in every
+    late sample does not go away on its own.
+    """
+    quarter = max(1, len(samples) // 4)
+    return round(min(samples[-quarter:]) - min(samples[:quarter]), 1)
+
+
+def check(soak: Dict, args) -> Dict:
+    """Growth between the warm-up and the end, and the limits it broke"""
+    before, after = soak["before"]["current"], soak["after"]["current"]
+    # The first --sample-every requests settle the workers further; a short run falls back to the warm-up
+    trajectory = soak["trajectory"]
+    if len(trajectory) < 2:
+        trajectory = [{"rss_mb": before["rss_bytes"] / 2 ** 20,
+                       "children_rss_mb": before["children_rss_bytes"] / 2 ** 20}] + trajectory
+    growth = {
+        "rss_mb": sustained_growth([sample["rss_mb"] for sample in trajectory]),
+        "children_rss_mb": sustained_growth([sample["children_rss_mb"] for sample in trajectory]),
+        "open_fds": after["open_fds"] - before["open_fds"],
+        "threads": after["threads"] - before["threads"],
+        "temp_files": after.get("temp_files", 0) - before.get("temp_files", 0),
+        "matplotlib_figures": after.get("matplotlib_figures", 0)
+    }
+    failures = []
+    if growth["rss_mb"] > args.max_rss_growth_mb:
+        failures.append(f"backend RSS grew by {growth['rss_mb']} MB (limit {args.max_rss_growth_mb})")
+    if growth["children_rss_mb"] > args.max_rss_growth_mb:
+        failures.append(f"analysis worker RSS grew by {growth['children_rss_mb']} MB (limit {args.max_rss_growth_mb})")
+    if growth["open_fds"] > args.max_fd_growth:
+        failures.append(f"open file descriptors grew by {growth['open_fds']} (limit {args.max_fd_growth})")
+    if growth["threads"] > args.max_thread_growth:
+        failures.append(f"threads grew by {growth['threads']} (limit {args.max_thread_growth})")
+    if growth["temp_files"] > 0:
+        failures.append(f"{growth['temp_files']} temp files left behind")
+    if growth["matplotlib_figures"] > 0:
+        failures.append(f"{growth['matplotlib_figures']} pyplot figures left open")
+    failed_requests = sum(count for status, count in soak["statuses"].items() if status != 200)
+    if failed_requests:
+        failures.append(f"{failed_requests} requests failed: {soak['statuses']}")
+    return {"growth": growth, "failures": failures}
+
+
+def main():
+    """Run the soak test and write the results"""
+    parser = argparse.ArgumentParser(description='Memory soak test for the mobile backend')
+    parser.add_argument('--requests', type=int, default=5000, help='/analyze requests after the warm-up')
+    parser.add_argument('--warmup', type=int, default=200, help='Requests before the first measurement')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--resolution', type=lambda s: tuple(int(v) for v in s.split('x')), default=(640, 480),
+                        help='WIDTHxHEIGHT of the uploaded leaf image')
+    parser.add_argument('--async-fraction', type=float, default=0.1, help='Share of requests sent as async jobs')
+    parser.add_argument('--render-fraction', type=float, default=0.02,
+                        help='Share of requests that ask for the rendered figure')
+    parser.add_argument('--workers', type=int, default=2, help='ANALYSIS_WORKERS (0 analyzes in the request thread)')
+    parser.add_argument('--tracemalloc-frames', type=int, default=1, help='0 turns tracemalloc off')
+    parser.add_argument('--sample-every', type=int, default=500, help='Requests between memory samples')
+    parser.add_argument('--max-rss-growth-mb', type=float, default=64.0)
+    parser.add_argument('--max-fd-growth', type=int, default=8)
+    parser.add_argument('--max-thread-growth', type=int, default=4)
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args()
+
+    model_url, stop_model = common.start_stub_model_server(latency_ms=5.0)
+    weather_url, stop_weather = common.start_stub_weather_api()
+    os.environ.update({
+        "SERVER_URL": model_url,
+        "WEATHER_API_URL": weather_url,
+        "WEATHER_API_KEY": "soak",
+        "MQTT_BROKER": "127.0.0.1",
+        "COMPACT_PREDICTIONS": "false",
+        "ANALYSIS_WORKERS": str(args.workers),
+        # Every client thread has at most one analysis in flight; leave room so none is turned away
+        "ANALYSIS_QUEUE_SIZE": str(2 * args.concurrency),
+        "MEMORY_GUARD_ENABLED": "true",
+        "BACKEND_ADMIN_TOKEN": ADMIN_TOKEN,
+        "MEMORY_TRACEMALLOC_FRAMES": str(args.tracemalloc_frames),
+        # Samples are taken by the soak test, not on a timer
+        "MEMORY_SAMPLE_INTERVAL": "86400",
+        # Finished jobs are meant to be kept for a while; keep that short so they do not count as growth
+        "JOB_TTL": "5"
+    })
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    with tempfile.TemporaryDirectory() as workdir:
+        # The backend writes its log and the client its outputs below the working directory
+        os.chdir(workdir)
+        backend = load_backend()
+        logging.getLogger("tomato-disease-backend").setLevel(logging.WARNING)
+        image_b64 = common.synthetic_image_b64(*args.resolution)
+        try:
+            print(f"Soaking /analyze with {args.requests} requests after {args.warmup} warm-up requests...")
+            soak = run_soak(backend, args, image_b64)
+        finally:
+            if backend._analysis_pool:
+                backend._analysis_pool.close()
+            stop_model()
+            stop_weather()
+
+    result = check(soak, args)
+    after = soak["after"]
+    results = {
+        "environment": common.environment_info(),
+        "config": {key: list(value) if isinstance(value, tuple) else value for key, value in vars(args).items()},
+        "requests_per_s": soak["requests_per_s"],
+        "statuses": soak["statuses"],
+        "growth": result["growth"],
+        "failures": result["failures"],
+        "trajectory": soak["trajectory"],
+        "before": soak["before"]["current"],
+        "after": after["current"],
+        "endpoints": after["endpoints"],
+        "top_growth_since_start": after["tracemalloc"]["top_growth_since_start"]
+    }
+    if output_path:
+        common.write_results(results, output_path)
+        print(f"Results written to {output_path}")
+
+    print(json.dumps({"growth": result["growth"], "requests_per_s": soak["requests_per_s"]}, indent=2))
+    for entry in results["top_growth_since_start"][:5]:
+        print(f"  +{entry['size_diff_bytes'] / 1024:.1f} KiB  {entry['location'][-1]}")
+    if result["failures"]:
+        print("\nSoak test failed:")
+        for line in result["failures"]:
+            print(f"  {line}")
+        return 1
+    print("\nNo leaks beyond the limits")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Grad-CAM disease heatmaps from disease_model itself.
+
+The client's detect_disease_regions finds lesions with hand-tuned colour and
+texture rules. That costs CPU, and the rules know nothing about what the
+network based its prediction on. GradCAM returns a class-activation map with
+each prediction instead:
+
+1. One forward pass computes the last convolutional feature map, then runs
+   the remaining layers (pooling, dropout, dense head) on it in sequence to
+   get the probabilities.
+2. The gradient of the top class's log-probability with respect to that map,
+   averaged over each channel, gives one weight per channel.
+3. The ReLU of the weighted channel sum is scaled to 0-255 per image, and
+   its maximum before scaling is returned as the map's peak.
+
+The map has the feature map's resolution, 7x7 for MobileNetV2 at 224x224. It
+is a few dozen bytes per image, and the client resizes it to the photo. The
+log-probability is used because the gradient of a softmax output vanishes
+for confident predictions. A scaled map always reaches 255 somewhere, however
+weak the evidence, so anything that compares maps between images has to
+multiply by the peak first (map / 255 * peak).
+
+The computation is one tf.function traced for any batch size when the model
+version is loaded, so a batch of frames or TTA views gets its maps in a
+single call.
+"""
+from typing import List, Optional, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+from response_format import encode_map
+
+
+def split_at_feature_map(model) -> Optional[Tuple[tf.keras.Model, List]]:
+    """(model up to the last 4-D output, the layers after it), or None if there is no such output"""
+    for index in reversed(range(len(model.layers))):
+        layer = model.layers[index]
+        if len(layer.output.shape) == 4:
+            return tf.keras.Model(model.inputs, layer.output), model.layers[index + 1:]
+    return None
+
+
+class GradCAM:
+    """Probabilities, uint8 class-activation maps and their peaks for a batch in one call"""
+
+    def __init__(self, feature_model: tf.keras.Model, head: List, input_shape=(224, 224, 3)):
+        self.feature_model = feature_model
+        self.head = head
+        self._function = tf.function(self._compute,
+                                     input_signature=[tf.TensorSpec((None,) + tuple(input_shape), tf.float32)])
+        # Trace now rather than in the first request that asks for a map
+        self._function(tf.zeros((1,) + tuple(input_shape), tf.float32))
+
+    @classmethod
+    def for_model(cls, model) -> Optional["GradCAM"]:
+        split = split_at_feature_map(model)
+        return cls(*split, tuple(model.input_shape[1:])) if split is not None else None
+
+    def _compute(self, batch):
+        features = self.feature_model(batch, training=False)
+        with tf.GradientTape() as tape:
+            tape.watch(features)
+            probabilities = features
+            for layer in self.head:
+                probabilities = layer(probabilities, training=False)
+            top = tf.argmax(probabilities, axis=-1)
+            scores = tf.math.log(tf.gather(probabilities, top, batch_dims=1) + 1e-12)
+        gradients = tape.gradient(scores, features)
+        weights = tf.reduce_mean(gradients, axis=(1, 2), keepdims=True)
+        cams = tf.nn.relu(tf.reduce_sum(weights * features, axis=-1))
+        peaks = tf.reduce_max(cams, axis=(1, 2))
+        cams = cams / (peaks[:, tf.newaxis, tf.newaxis] + 1e-12)
+        return probabilities, tf.cast(tf.round(cams * 255), tf.uint8), peaks
+
+    def __call__(self, batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(probabilities, maps, peaks) with maps of shape (batch, height, width) in 0-255"""
+        probabilities, cams, peaks = self._function(tf.constant(batch, tf.float32))
+        return probabilities.numpy(), cams.numpy(), peaks.numpy()
+
+
+def encode_cam(cam: np.ndarray, peak: float) -> dict:
+    """The "cam" field of a response: the uint8 map and the unscaled activation its 255 stands for"""
+    return {**encode_map(cam), "peak": float(peak)}
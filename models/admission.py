@@ -0,0 +1,147 @@
+"""Admission control and request deadlines for the model server.
+
+At most `max_in_flight` requests run model work at once, and at most
+`max_queue` more wait for a slot. Beyond that, requests are rejected at once
+with a Retry-After estimate instead of piling up behind TensorFlow. A request
+whose deadline cannot be met from its place in the queue is rejected early
+too. Each request's deadline is held in a context variable. The server checks
+it with check_deadline() before preprocessing and before each model call, so
+work for a client that has already given up is not started.
+"""
+import contextvars
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from instrumentation import REGISTRY
+
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+IN_FLIGHT = REGISTRY.gauge("tomato_admission_in_flight", "Requests currently running model work")
+QUEUE_DEPTH = REGISTRY.gauge("tomato_admission_queue_depth", "Requests waiting for an in-flight slot")
+QUEUE_WAIT_SECONDS = REGISTRY.histogram("tomato_admission_queue_wait_seconds", "Time admitted requests spent queued")
+REJECTED = REGISTRY.counter("tomato_admission_rejected_total", "Requests turned away before or during work", ("reason",))
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class Overloaded(Exception):
+    """The server is too busy to take the request; retry after retry_after seconds"""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Server overloaded ({reason}), retry after {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the named stage could start"""
+
+    def __init__(self, stage: str):
+        super().__init__(f"Deadline exceeded before {stage}")
+        self.stage = stage
+
+
+class Deadline:
+    """Absolute expiry time of a request; no timeout means it never expires"""
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.expires = time.monotonic() + timeout if timeout else None
+
+    def remaining(self) -> float:
+        return math.inf if self.expires is None else self.expires - time.monotonic()
+
+    def check(self, stage: str) -> None:
+        if self.remaining() <= 0:
+            REJECTED.inc(1, "deadline_" + stage)
+            raise DeadlineExceeded(stage)
+
+
+def set_deadline(deadline: Optional[Deadline]) -> None:
+    """Set the deadline of the request being handled"""
+    _deadline.set(deadline)
+
+
+def check_deadline(stage: str) -> None:
+    """Raise DeadlineExceeded if the current request's deadline has passed"""
+    deadline = _deadline.get()
+    if deadline is not None:
+        deadline.check(stage)
+
+
+class AdmissionController:
+    """Bounded in-flight work with a bounded wait queue"""
+
+    def __init__(self, max_in_flight: int, max_queue: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        # Smoothed seconds per admitted request, used for Retry-After and early rejection
+        self.service_time = 0.5
+        self._cond = threading.Condition()
+
+    def estimated_wait(self, position: int) -> float:
+        """Expected seconds until the request at a queue position gets a slot"""
+        return self.service_time * (position + 1) / self.max_in_flight
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.estimated_wait(self.queued)))
+
+    @contextmanager
+    def admit(self, deadline: Optional[Deadline] = None):
+        """Hold an in-flight slot for the duration of the block"""
+        deadline = deadline or Deadline()
+        with self._cond:
+            if self.in_flight >= self.max_in_flight:
+                if self.queued >= self.max_queue:
+                    REJECTED.inc(1, "queue_full")
+                    raise Overloaded("queue_full", self._retry_after())
+                if self.estimated_wait(self.queued) > deadline.remaining():
+                    REJECTED.inc(1, "deadline_unmeetable")
+                    raise Overloaded("deadline_unmeetable", self._retry_after())
+
+                self.queued += 1
+                QUEUE_DEPTH.set(self.queued)
+                wait_start = time.perf_counter()
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline.remaining()
+                        if remaining <= 0:
+                            REJECTED.inc(1, "deadline_queue")
+                            raise DeadlineExceeded("queue")
+                        self._cond.wait(None if remaining == math.inf else remaining)
+                except BaseException:
+                    # Giving up may have swallowed the wakeup meant for a free slot; pass it on
+                    if self.in_flight < self.max_in_flight:
+                        self._cond.notify()
+                    raise
+                finally:
+                    self.queued -= 1
+                    QUEUE_DEPTH.set(self.queued)
+                QUEUE_WAIT_SECONDS.observe(time.perf_counter() - wait_start)
+            self.in_flight += 1
+            IN_FLIGHT.set(self.in_flight)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                self.in_flight -= 1
+                IN_FLIGHT.set(self.in_flight)
+                self.service_time = 0.8 * self.service_time + 0.2 * elapsed
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queued,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "service_time_ms": round(self.service_time * 1000, 1)
+            }
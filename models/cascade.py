@@ -0,0 +1,195 @@
+"""Confidence cascade in front of disease_model.
+
+A small distilled or pruned model with the same ten classes answers first.
+An image goes on to the full disease_model only when the small model's top-1
+probability is below `min_confidence` or its lead over the runner-up is below
+`min_margin`. Confident answers are returned as they are, so most easy field
+images never pay for the full model.
+
+A top-1 probability of at least c leaves at most 1 - c for the runner-up, so
+the margin is already at least 2c - 1. `min_margin` only escalates anything
+when it is above that; the defaults (0.8 and 0.7) leave a band where it does.
+
+Two agreement rates are tracked whenever both models have seen an image.
+`escalated` covers the images that were escalated anyway. `audit` covers a
+random `audit_rate` sample of confident answers, which are also sent to the
+full model. Audit agreement is the unbiased estimate of how often a cascade
+answer differs from what the full model would have said.
+
+`evaluate` runs both models over a preprocess_cache cache and sweeps the
+thresholds, to choose them knowing the escalation rate, agreement and
+accuracy each one gives:
+
+    python cascade.py evaluate cache/plantvillage --cascade-model distilled.h5
+"""
+import argparse
+import json
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from instrumentation import REGISTRY
+
+CASCADE_DECISIONS = REGISTRY.counter(
+    "tomato_cascade_total",
+    "Cascade decisions: answered by the cascade model or escalated to disease_model",
+    ("outcome",)
+)
+CASCADE_AGREEMENT = REGISTRY.counter(
+    "tomato_cascade_agreement_total",
+    "Top-1 agreement between the cascade model and disease_model on escalated and audited images",
+    ("path", "result")
+)
+
+
+def confidence_and_margin(probabilities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Top-1 probability and its lead over the runner-up, per row"""
+    top2 = np.sort(probabilities, axis=-1)[..., -2:]
+    return top2[..., 1], top2[..., 1] - top2[..., 0]
+
+
+class CascadePolicy:
+    """Escalation decisions and agreement statistics"""
+
+    def __init__(self, min_confidence: float = 0.8, min_margin: float = 0.7, audit_rate: float = 0.02, seed=None):
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.audit_rate = audit_rate
+        self._rng = np.random.default_rng(seed)
+        self._counts = {"answered": 0, "escalated": 0, "audited": 0}
+        self._agreement = {"escalated": [0, 0], "audit": [0, 0]}  # [agreed, compared]
+        self._lock = threading.Lock()
+
+    def decide(self, probabilities: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """(escalate, audit) masks for a batch of cascade model probabilities, one row per image"""
+        confidence, margin = confidence_and_margin(probabilities)
+        escalate = (confidence < self.min_confidence) | (margin < self.min_margin)
+        with self._lock:
+            audit = ~escalate & (self._rng.random(len(escalate)) < self.audit_rate)
+        escalated, audited = int(escalate.sum()), int(audit.sum())
+        CASCADE_DECISIONS.inc(len(escalate) - escalated, "answered")
+        CASCADE_DECISIONS.inc(escalated, "escalated")
+        with self._lock:
+            self._counts["answered"] += len(escalate) - escalated
+            self._counts["escalated"] += escalated
+            self._counts["audited"] += audited
+        return escalate, audit
+
+    def record_agreement(self, cascade: np.ndarray, full: np.ndarray, escalated: np.ndarray) -> None:
+        """Compare both models' top-1 classes on the images that ran through both"""
+        agree = np.argmax(cascade, axis=-1) == np.argmax(full, axis=-1)
+        with self._lock:
+            for path, mask in (("escalated", escalated), ("audit", ~escalated)):
+                agreed, compared = int(agree[mask].sum()), int(mask.sum())
+                self._agreement[path][0] += agreed
+                self._agreement[path][1] += compared
+                CASCADE_AGREEMENT.inc(agreed, path, "agree")
+                CASCADE_AGREEMENT.inc(compared - agreed, path, "disagree")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self._counts)
+            agreement = {path: list(values) for path, values in self._agreement.items()}
+        total = counts["answered"] + counts["escalated"]
+        return {
+            "min_confidence": self.min_confidence,
+            "min_margin": self.min_margin,
+            "audit_rate": self.audit_rate,
+            "images": total,
+            **counts,
+            "escalation_rate": round(counts["escalated"] / total, 4) if total else None,
+            "escalated_agreement": round(agreement["escalated"][0] / agreement["escalated"][1], 4)
+            if agreement["escalated"][1] else None,
+            "audit_agreement": round(agreement["audit"][0] / agreement["audit"][1], 4)
+            if agreement["audit"][1] else None
+        }
+
+
+def _predict_cache(cache, model, batch_size: int) -> Tuple[np.ndarray, float]:
+    """Probabilities for every row of a cache, and the inference seconds spent"""
+    from preprocess_cache import IMAGE_SIZE, to_model_input
+
+    buffer = np.empty((batch_size,) + IMAGE_SIZE + (3,), dtype=np.float32)
+    outputs, seconds = [], 0.0
+    # The first call builds the graph; keep it out of the timing
+    model.predict(buffer[:1], verbose=0)
+    for _, batch in cache.batches(batch_size):
+        model_input = to_model_input(batch, buffer)
+        start = time.perf_counter()
+        outputs.append(model.predict(model_input, verbose=0))
+        seconds += time.perf_counter() - start
+    return np.concatenate(outputs), seconds
+
+
+def evaluate(cache, cascade_model, full_model, class_names: List[str], min_confidences: List[float],
+             min_margins: List[float], batch_size: int = 64) -> Dict:
+    """Escalation rate, agreement with the full model and accuracy for each pair of thresholds"""
+    cascade_probabilities, cascade_seconds = _predict_cache(cache, cascade_model, batch_size)
+    full_probabilities, full_seconds = _predict_cache(cache, full_model, batch_size)
+    valid = cache.valid
+    label_ids = cache.label_ids(class_names)
+    scored = valid & (label_ids >= 0)
+    full_classes = np.argmax(full_probabilities, axis=1)
+    cascade_classes = np.argmax(cascade_probabilities, axis=1)
+    confidence, margin = confidence_and_margin(cascade_probabilities)
+
+    def accuracy(classes):
+        return round(float((classes[scored] == label_ids[scored]).mean()), 4) if scored.any() else None
+
+    sweep = []
+    for min_confidence in min_confidences:
+        for min_margin in min_margins:
+            escalate = (confidence < min_confidence) | (margin < min_margin)
+            final = np.where(escalate, full_classes, cascade_classes)
+            escalation_rate = float(escalate[valid].mean())
+            sweep.append({
+                "min_confidence": min_confidence,
+                "min_margin": min_margin,
+                "escalation_rate": round(escalation_rate, 4),
+                "agreement_with_full": round(float((final == full_classes)[valid].mean()), 4),
+                "accuracy": accuracy(final),
+                # Inference cost relative to running only the full model
+                "relative_cost": round((cascade_seconds + escalation_rate * full_seconds) / full_seconds, 3)
+            })
+
+    return {
+        "images": int(valid.sum()),
+        "scored": int(scored.sum()),
+        "full_accuracy": accuracy(full_classes),
+        "cascade_only_accuracy": accuracy(cascade_classes),
+        "cascade_seconds": round(cascade_seconds, 3),
+        "full_seconds": round(full_seconds, 3),
+        "sweep": sweep
+    }
+
+
+def main():
+    """Sweep cascade thresholds on a labeled cache"""
+    parser = argparse.ArgumentParser(description='Evaluate cascade thresholds on a preprocessed cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    evaluate_parser = subparsers.add_parser('evaluate', help='Escalation rate and accuracy per threshold')
+    evaluate_parser.add_argument('output_prefix', help='Cache written by preprocess_cache.py build')
+    evaluate_parser.add_argument('--cascade-model', required=True, help='Small model with the disease classes')
+    evaluate_parser.add_argument('--min-confidence', type=float, nargs='+', default=[0.7, 0.8, 0.9, 0.95])
+    evaluate_parser.add_argument('--min-margin', type=float, nargs='+', default=[0.0, 0.5, 0.7, 0.9])
+    evaluate_parser.add_argument('--batch-size', type=int, default=64)
+    evaluate_parser.add_argument('--output', help='Optional path to write the results as JSON')
+    args = parser.parse_args()
+
+    from tensorflow.keras.models import load_model
+    from preprocess_cache import PreprocessedCache
+    # The full model and class list come from DISEASE_MODEL_PATH, loaded like the server does
+    from server import server
+
+    results = evaluate(PreprocessedCache(args.output_prefix), load_model(args.cascade_model), server.disease_model,
+                       server.disease_class_names, args.min_confidence, args.min_margin, args.batch_size)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
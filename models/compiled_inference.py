@@ -0,0 +1,96 @@
+"""Fixed-shape, XLA-compiled inference for the served models.
+
+Keras `model.predict` builds a data adapter, an iterator and callbacks on
+every call. For a single 224x224 image that overhead costs more than the
+convolutions themselves. CompiledModel wraps the model in one
+`tf.function(jit_compile=True)` and traces it for a fixed set of batch-size
+buckets. Each bucket is compiled when the model is loaded, not in a request.
+
+A call copies its batch into a reusable input buffer of the nearest bucket
+size and runs the compiled function. Only the real rows of the output are
+kept. Batches larger than the largest bucket are split. `predict` has the
+same signature and return shape as the Keras method, so the server can call
+either one.
+
+With jit_compile=False the same buckets run as plain graph functions. On CPU
+this is often faster than XLA, because TensorFlow's default oneDNN kernels
+beat XLA's CPU convolutions. The compiled benchmark suite measures both.
+"""
+import queue
+from typing import Dict, Sequence
+
+import numpy as np
+import tensorflow as tf
+
+DEFAULT_BUCKETS = (1, 4, 8, 16)
+
+
+class CompiledModel:
+    """A Keras model compiled for fixed batch-size buckets"""
+
+    def __init__(self, model, buckets: Sequence[int] = DEFAULT_BUCKETS, input_shape=(224, 224, 3),
+                 jit_compile: bool = True):
+        self.model = model
+        self.buckets = tuple(sorted(set(buckets)))
+        self.input_shape = tuple(input_shape)
+        self.jit_compile = jit_compile
+        self._function = tf.function(lambda x: model(x, training=False), jit_compile=jit_compile)
+        self._concrete = {}
+        # Free input buffers per bucket; a concurrent call takes its own instead of sharing one
+        self._buffers: Dict[int, queue.SimpleQueue] = {bucket: queue.SimpleQueue() for bucket in self.buckets}
+        self.compile()
+
+    def compile(self) -> None:
+        """Trace and compile every bucket, falling back to plain graph mode if XLA is unavailable"""
+        try:
+            self._compile_buckets()
+        except tf.errors.OpError as e:
+            if not self.jit_compile:
+                raise
+            print(f"XLA compilation failed, using graph mode without XLA: {e}")
+            self.jit_compile = False
+            self._function = tf.function(lambda x: self.model(x, training=False))
+            self._compile_buckets()
+
+    def _compile_buckets(self) -> None:
+        for bucket in self.buckets:
+            spec = tf.TensorSpec((bucket,) + self.input_shape, tf.float32)
+            concrete = self._function.get_concrete_function(spec)
+            # The first call runs the XLA compiler for this shape
+            concrete(tf.zeros(spec.shape, tf.float32))
+            self._concrete[bucket] = concrete
+
+    def bucket_for(self, size: int) -> int:
+        """Smallest bucket that holds size rows"""
+        for bucket in self.buckets:
+            if bucket >= size:
+                return bucket
+        return self.buckets[-1]
+
+    def _run(self, batch: np.ndarray):
+        """One compiled call on at most the largest bucket's worth of rows"""
+        size = len(batch)
+        bucket = self.bucket_for(size)
+        free = self._buffers[bucket]
+        try:
+            buffer = free.get_nowait()
+        except queue.Empty:
+            buffer = np.zeros((bucket,) + self.input_shape, dtype=np.float32)
+        try:
+            # Rows past `size` keep whatever the last call left there; their outputs are dropped
+            buffer[:size] = batch
+            outputs = self._concrete[bucket](tf.constant(buffer))
+        finally:
+            free.put(buffer)
+        return tf.nest.map_structure(lambda output: output.numpy()[:size], outputs)
+
+    def predict(self, batch: np.ndarray, verbose: int = 0):
+        """Same result as model.predict(batch): an array, or a list of arrays for multi-output models"""
+        largest = self.buckets[-1]
+        if len(batch) <= largest:
+            return self._run(batch)
+        chunks = [self._run(batch[start:start + largest]) for start in range(0, len(batch), largest)]
+        return tf.nest.map_structure(lambda *parts: np.concatenate(parts), *chunks)
+
+    def describe(self) -> Dict:
+        return {"buckets": list(self.buckets), "jit_compile": self.jit_compile}
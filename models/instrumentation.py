@@ -0,0 +1,242 @@
+"""Lightweight latency instrumentation shared by the model server and the mobile backend.
+
+Stage timings are recorded into fixed-bucket histograms (one bisect and a
+few integer adds per observation) and exposed in the Prometheus text format
+on a /metrics route. A request ID is taken from the X-Request-ID header, or
+generated, and forwarded on outgoing calls so one analysis can be followed
+from the backend into the model server.
+
+tomatoApp imports this file through tomatoApp/shared_modules.py.
+"""
+import bisect
+import contextvars
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Iterable, Optional, Tuple
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# Seconds; covers sub-millisecond decodes up to slow weather API calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    """Render a Prometheus label set"""
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        """Record one observation"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                # [per-bucket counts..., +Inf count, sum]
+                series = self._series[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def summary(self) -> Dict[Tuple[str, ...], Dict[str, float]]:
+        """Return count, sum and mean per label set"""
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        result = {}
+        for labels, series in items:
+            count = sum(series[:-1])
+            result[labels] = {"count": count, "sum": series[-1], "mean": series[-1] / count if count else 0.0}
+        return result
+
+    def render(self) -> str:
+        """Render in the Prometheus text exposition format"""
+        with self._lock:
+            items = sorted((labels, list(series)) for labels, series in self._series.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="%s"' % bound)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            bucket_labels = _format_labels(self.labelnames, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return "\n".join(lines)
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        with self._lock:
+            return self._values.get(labelvalues, 0.0)
+
+    def render(self) -> str:
+        with self._lock:
+            items = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+        return "\n".join(lines)
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+
+    metric_type = "gauge"
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def dec(self, amount: float = 1.0, *labelvalues: str) -> None:
+        self.inc(-amount, *labelvalues)
+
+
+class Registry:
+    """Collection of metrics rendered together on /metrics"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+            return self._metrics[name]
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets)
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "tomato_stage_duration_seconds",
+    "Time spent in each pipeline stage",
+    ("stage",)
+)
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "tomato_http_request_duration_seconds",
+    "HTTP request latency by endpoint",
+    ("service", "endpoint", "method", "status")
+)
+
+
+@contextmanager
+def timed(stage: str):
+    """Time a block of code as one pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage)
+
+
+def timed_stage(stage: str):
+    """Decorator form of timed()"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_request_id() -> Optional[str]:
+    """Return the request ID of the request being handled, if any"""
+    return _request_id.get()
+
+
+def set_request_id(request_id: Optional[str] = None) -> str:
+    """Set (or generate) the request ID for the current context"""
+    request_id = request_id or uuid.uuid4().hex
+    _request_id.set(request_id)
+    return request_id
+
+
+def outgoing_headers() -> Dict[str, str]:
+    """Headers that propagate the current request ID to downstream services"""
+    request_id = current_request_id()
+    return {REQUEST_ID_HEADER: request_id} if request_id else {}
+
+
+def stage_report() -> Dict[str, Dict[str, float]]:
+    """Return count and mean milliseconds per recorded stage"""
+    return {
+        labels[0]: {"count": stats["count"], "mean_ms": round(stats["mean"] * 1000, 2)}
+        for labels, stats in sorted(STAGE_SECONDS.summary().items())
+    }
+
+
+def init_flask(app, service: str) -> None:
+    """Install request timing, request-ID propagation and a /metrics route on a Flask app"""
+    from flask import Response, g, request
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_start = time.perf_counter()
+        set_request_id(request.headers.get(REQUEST_ID_HEADER))
+
+    @app.after_request
+    def _record_request(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, service, endpoint, request.method, str(response.status_code)
+            )
+        request_id = current_request_id()
+        if request_id:
+            response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        """Prometheus-style metrics endpoint"""
+        return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,139 @@
+"""Cheap colour prefilter that rejects obvious non-leaf images before leaf_model.
+
+The image is shrunk to a small thumbnail and the fraction of vegetation-
+coloured pixels (green through yellow-green, with enough chroma and
+brightness) is computed with a few vectorized NumPy comparisons. Images below
+`reject_below` are answered as non-tomato without touching TensorFlow. The
+threshold is deliberately low: diseased leaves are partly brown, so the
+prefilter only removes blank walls, soil and sky, and everything else still
+goes to leaf_model. Images below `borderline_below` are counted separately to
+show how close the accepted traffic runs to the threshold.
+
+A random `audit_rate` fraction of rejections is still sent to leaf_model.
+When the model disagrees, the request gets the model's answer and the
+disagreement is counted as a false reject. `evaluate` measures the same thing
+offline, on a labeled cache built by preprocess_cache.py:
+
+    python leaf_prefilter.py evaluate cache/plantvillage --positive-labels tomato
+"""
+import argparse
+import json
+import random
+from typing import Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from instrumentation import REGISTRY
+
+PREFILTER_OUTCOMES = REGISTRY.counter(
+    "tomato_leaf_prefilter_total",
+    "Prefilter decisions: reject, borderline (sent to leaf_model) or pass",
+    ("outcome",)
+)
+PREFILTER_AUDITS = REGISTRY.counter(
+    "tomato_leaf_prefilter_audit_total",
+    "Audited prefilter rejects by whether leaf_model agreed",
+    ("result",)
+)
+
+THUMBNAIL_SIZE = (64, 64)
+
+
+def thumbnail(image) -> np.ndarray:
+    """Box-filtered THUMBNAIL_SIZE RGB array from a PIL image or RGB array; averaging removes sensor noise"""
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(image)
+    return np.asarray(image.resize(THUMBNAIL_SIZE, Image.BOX))
+
+
+def vegetation_fraction(rgb: np.ndarray, min_chroma: int = 25, min_value: int = 40) -> float:
+    """Fraction of pixels whose colour is green to yellow-green, from an RGB uint8 array"""
+    pixels = rgb.astype(np.int16)
+    r, g, b = pixels[..., 0], pixels[..., 1], pixels[..., 2]
+    brightest = pixels.max(axis=-1)
+    chroma = brightest - pixels.min(axis=-1)
+    # Green at least 80% of red keeps yellowing leaves (hue >= ~48 deg) and drops browns and reds
+    leafy = (5 * g >= 4 * r) & (g > b) & (chroma >= min_chroma) & (brightest >= min_value)
+    return float(leafy.mean())
+
+
+class LeafPrefilter:
+    """Reject/borderline/pass decisions on the vegetation fraction"""
+
+    def __init__(self, reject_below: float = 0.02, borderline_below: float = 0.10, audit_rate: float = 0.02):
+        self.reject_below = reject_below
+        self.borderline_below = borderline_below
+        self.audit_rate = audit_rate
+
+    def check(self, image) -> Dict:
+        """Classify a PIL image or RGB array; the result says whether to reject and whether to audit"""
+        fraction = vegetation_fraction(thumbnail(image))
+
+        if fraction < self.reject_below:
+            outcome = "reject"
+        elif fraction < self.borderline_below:
+            outcome = "borderline"
+        else:
+            outcome = "pass"
+        PREFILTER_OUTCOMES.inc(1, outcome)
+        return {
+            "outcome": outcome,
+            "leaf_fraction": round(fraction, 4),
+            "audit": outcome == "reject" and random.random() < self.audit_rate
+        }
+
+    def record_audit(self, model_says_tomato: bool) -> None:
+        """Record what leaf_model said about an audited reject"""
+        PREFILTER_AUDITS.inc(1, "false_reject" if model_says_tomato else "agree")
+
+
+def evaluate(cache, prefilter: LeafPrefilter, positive_labels: Optional[List[str]] = None) -> Dict:
+    """False-reject rate on leaf images and reject rate on the rest, over a preprocess_cache cache
+
+    Labels in positive_labels (default: every label starting with "Tomato" or
+    equal to "tomato") are leaves the prefilter must never reject.
+    """
+    def is_positive(label):
+        if positive_labels is not None:
+            return label in positive_labels
+        return label.lower().startswith("tomato")
+
+    fractions = np.array([vegetation_fraction(thumbnail(cache.pixels[i])) for i in range(len(cache))])
+    positive = np.array([is_positive(label) for label in cache.labels]) & cache.valid
+    negative = ~positive & cache.valid
+    rejected = fractions < prefilter.reject_below
+
+    false_rejects = [cache.paths[i] for i in np.flatnonzero(rejected & positive)]
+    return {
+        "images": int(cache.valid.sum()),
+        "positives": int(positive.sum()),
+        "negatives": int(negative.sum()),
+        "reject_below": prefilter.reject_below,
+        "false_reject_rate": round(len(false_rejects) / positive.sum(), 5) if positive.any() else None,
+        "negative_reject_rate": round(float(rejected[negative].mean()), 4) if negative.any() else None,
+        "borderline_rate": round(float(((fractions >= prefilter.reject_below) &
+                                        (fractions < prefilter.borderline_below))[cache.valid].mean()), 4),
+        "positive_fraction_p1": round(float(np.percentile(fractions[positive], 1)), 4) if positive.any() else None,
+        "false_rejects": false_rejects[:50]
+    }
+
+
+def main():
+    """Evaluate the prefilter thresholds on a labeled cache"""
+    parser = argparse.ArgumentParser(description='Evaluate the leaf prefilter on a preprocessed cache')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    evaluate_parser = subparsers.add_parser('evaluate', help='Measure false rejects on a labeled cache')
+    evaluate_parser.add_argument('output_prefix', help='Cache written by preprocess_cache.py build')
+    evaluate_parser.add_argument('--reject-below', type=float, default=0.02)
+    evaluate_parser.add_argument('--borderline-below', type=float, default=0.10)
+    evaluate_parser.add_argument('--positive-labels', nargs='+', help='Labels that are leaves (default: Tomato*)')
+    args = parser.parse_args()
+
+    from preprocess_cache import PreprocessedCache
+    prefilter = LeafPrefilter(args.reject_below, args.borderline_below)
+    print(json.dumps(evaluate(PreprocessedCache(args.output_prefix), prefilter, args.positive_labels), indent=2))
+
+
+if __name__ == "__main__":
+    main()
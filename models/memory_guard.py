@@ -0,0 +1,338 @@
+"""Memory and resource-leak tracking for the model server and the mobile backend.
+
+A slow leak shows up as resident memory that creeps up over days, long
+after the request that caused it. MemoryTracker keeps enough history to
+find it:
+
+- Every MEMORY_SAMPLE_INTERVAL seconds it samples RSS, open file
+  descriptors, threads, temp files with the service's prefix, open pyplot
+  figures and the RSS of child processes (the analysis pool's workers).
+  The samples go into a bounded ring, and RSS growth per hour is fitted
+  over the whole ring.
+- Each request records the change in RSS between its start and end,
+  summed per endpoint. Requests running at the same time share the
+  blame, so an endpoint only stands out if its deltas keep growing.
+- With MEMORY_TRACEMALLOC_FRAMES > 0, tracemalloc is started and a
+  snapshot is taken with every sample. The report lists the lines whose
+  allocations grew most since start-up and since the previous snapshot.
+  tracemalloc slows allocation down noticeably, so it is off by default.
+- RSS that grows while the traced Python memory stays flat is usually
+  freed heap the C allocator has not returned to the system. With glibc,
+  each sample calls malloc_trim() to return it, and the amount recovered
+  is reported (MEMORY_MALLOC_TRIM=false turns this off).
+
+All of it is reported on /debug/memory; "?sample=1" takes a sample first.
+The report shows file paths, pids and allocation sites, and a sample
+costs a malloc_trim() and a snapshot, so the route answers only requests
+carrying the service's admin token in X-Admin-Token, and is off (403)
+when no token is configured. Setting MEMORY_GUARD_ENABLED=false installs
+nothing.
+
+tomatoApp imports this file through tomatoApp/shared_modules.py.
+"""
+import ctypes
+import ctypes.util
+import hmac
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import deque
+from typing import Dict, List, Optional
+
+from instrumentation import REGISTRY
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+RESIDENT_MEMORY = REGISTRY.gauge("tomato_process_resident_memory_bytes", "Resident memory of the process",
+                                 ("service",))
+OPEN_FDS = REGISTRY.gauge("tomato_process_open_fds", "Open file descriptors of the process", ("service",))
+TEMP_FILES = REGISTRY.gauge("tomato_temp_files", "Temp files with the service's prefix", ("service",))
+
+
+def rss_bytes(pid: str = "self") -> Optional[int]:
+    """Resident set size of a process from /proc; None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """High-water mark of this process's resident memory"""
+    try:
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) * 1024 for line in f if line.startswith("VmHWM:"))
+    except (OSError, StopIteration, ValueError):
+        return None
+
+
+def _load_malloc_trim():
+    """glibc's malloc_trim, or None on other C libraries"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+        return libc.malloc_trim
+    except (OSError, AttributeError):
+        return None
+
+
+def open_fd_count() -> Optional[int]:
+    """Open file descriptors of this process"""
+    for directory in ("/proc/self/fd", "/dev/fd"):
+        try:
+            return len(os.listdir(directory))
+        except OSError:
+            continue
+    return None
+
+
+class MemoryTracker:
+    """Samples process resources on a background thread and keeps per-endpoint RSS deltas"""
+
+    def __init__(self, service: str, temp_prefix: Optional[str] = None, tracemalloc_frames: int = 0,
+                 sample_interval: float = 300.0, top_n: int = 15, history: int = 288, malloc_trim: bool = True):
+        self.service = service
+        self.temp_prefix = temp_prefix
+        self.tracemalloc_frames = tracemalloc_frames
+        self.sample_interval = sample_interval
+        self.top_n = top_n
+        self._malloc_trim = _load_malloc_trim() if malloc_trim else None
+        self._trimmed_bytes = 0
+        self._lock = threading.Lock()
+        self._endpoints: Dict[str, Dict[str, int]] = {}
+        self._history = deque(maxlen=history)
+        self._top_since_start: List[Dict] = []
+        self._top_since_last: List[Dict] = []
+        self._first_snapshot = None
+        self._last_snapshot = None
+        self._snapshots = 0
+        if tracemalloc_frames > 0:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(tracemalloc_frames)
+            self._first_snapshot = self._last_snapshot = self._snapshot()
+        self.started = time.time()
+        self.at_start = self.usage()
+        self._history.append(self.at_start)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, name="memory-tracker", daemon=True)
+        self._thread.start()
+
+    def usage(self) -> Dict:
+        """Current RSS, descriptors, threads, temp files, figures and child RSS"""
+        children = [rss_bytes(str(child.pid)) for child in multiprocessing.active_children()]
+        usage = {
+            "timestamp": round(time.time(), 3),
+            "rss_bytes": rss_bytes(),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "open_fds": open_fd_count(),
+            "threads": threading.active_count(),
+            "children": len(children),
+            "children_rss_bytes": sum(rss or 0 for rss in children)
+        }
+        if self.temp_prefix:
+            usage["temp_files"], usage["temp_bytes"] = self._temp_files()
+        if "matplotlib.pyplot" in sys.modules:
+            # Only counted once something imported pyplot; the import alone costs a second
+            usage["matplotlib_figures"] = len(sys.modules["matplotlib.pyplot"].get_fignums())
+        if tracemalloc.is_tracing():
+            usage["traced_bytes"], usage["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+        return usage
+
+    def _temp_files(self):
+        """Count and total size of the files in the temp directory with our prefix"""
+        count = size = 0
+        try:
+            with os.scandir(tempfile.gettempdir()) as entries:
+                for entry in entries:
+                    if entry.name.startswith(self.temp_prefix):
+                        count += 1
+                        try:
+                            size += entry.stat().st_size
+                        except OSError:
+                            pass
+        except OSError:
+            pass
+        return count, size
+
+    def request_started(self) -> Optional[int]:
+        """RSS at the start of a request, to pass to request_finished()"""
+        return rss_bytes()
+
+    def request_finished(self, endpoint: str, start_rss: Optional[int]) -> None:
+        """Add one request's RSS change to its endpoint"""
+        end_rss = rss_bytes()
+        if start_rss is None or end_rss is None:
+            return
+        delta = end_rss - start_rss
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "requests": 0, "rss_delta_bytes": 0, "rss_growth_bytes": 0, "max_rss_delta_bytes": 0
+            })
+            stats["requests"] += 1
+            stats["rss_delta_bytes"] += delta
+            stats["rss_growth_bytes"] += max(delta, 0)
+            stats["max_rss_delta_bytes"] = max(stats["max_rss_delta_bytes"], delta)
+
+    def sample(self) -> Dict:
+        """Record a usage sample, and a tracemalloc snapshot when tracing; returns the sample"""
+        if self._malloc_trim is not None:
+            before = rss_bytes()
+            self._malloc_trim(0)
+            after = rss_bytes()
+            if before is not None and after is not None:
+                with self._lock:
+                    self._trimmed_bytes += max(before - after, 0)
+        usage = self.usage()
+        if usage["rss_bytes"] is not None:
+            RESIDENT_MEMORY.set(usage["rss_bytes"], self.service)
+        if usage["open_fds"] is not None:
+            OPEN_FDS.set(usage["open_fds"], self.service)
+        if "temp_files" in usage:
+            TEMP_FILES.set(usage["temp_files"], self.service)
+        snapshot = self._snapshot() if tracemalloc.is_tracing() else None
+        with self._lock:
+            self._history.append(usage)
+            if snapshot is not None:
+                self._top_since_start = self._top_growth(snapshot, self._first_snapshot)
+                self._top_since_last = self._top_growth(snapshot, self._last_snapshot)
+                self._last_snapshot = snapshot
+                self._snapshots += 1
+        return usage
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.sample_interval):
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"Memory sample failed: {e}")
+
+    @staticmethod
+    def _snapshot():
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            tracemalloc.Filter(False, "<unknown>")
+        ))
+
+    def _top_growth(self, snapshot, previous) -> List[Dict]:
+        """The allocation sites that grew most between two snapshots"""
+        if previous is None:
+            return []
+        key = "traceback" if self.tracemalloc_frames > 1 else "lineno"
+        top = []
+        for stat in snapshot.compare_to(previous, key)[:self.top_n]:
+            if stat.size_diff <= 0:
+                break
+            top.append({
+                "location": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                "size_bytes": stat.size,
+                "size_diff_bytes": stat.size_diff,
+                "count_diff": stat.count_diff
+            })
+        return top
+
+    def growth_per_hour(self) -> Optional[float]:
+        """Least-squares RSS slope over the sample history, in bytes per hour"""
+        with self._lock:
+            points = [(s["timestamp"], s["rss_bytes"]) for s in self._history if s["rss_bytes"] is not None]
+        if len(points) < 3 or points[-1][0] - points[0][0] <= 0:
+            return None
+        mean_t = sum(t for t, _ in points) / len(points)
+        mean_r = sum(r for _, r in points) / len(points)
+        variance = sum((t - mean_t) ** 2 for t, _ in points)
+        slope = sum((t - mean_t) * (r - mean_r) for t, r in points) / variance
+        return round(slope * 3600)
+
+    def report(self) -> Dict:
+        """Everything /debug/memory returns"""
+        current = self.usage()
+        growth = {
+            key: current[key] - self.at_start[key]
+            for key in current
+            if key != "timestamp" and isinstance(current[key], int) and isinstance(self.at_start.get(key), int)
+        }
+        with self._lock:
+            endpoints = {
+                endpoint: {**stats, "mean_rss_delta_bytes": round(stats["rss_delta_bytes"] / stats["requests"])}
+                for endpoint, stats in sorted(self._endpoints.items())
+            }
+            history = list(self._history)
+            top_since_start, top_since_last = list(self._top_since_start), list(self._top_since_last)
+            snapshots = self._snapshots
+            trimmed = self._trimmed_bytes
+        return {
+            "service": self.service,
+            "pid": os.getpid(),
+            "uptime_seconds": round(time.time() - self.started, 1),
+            "current": current,
+            "at_start": self.at_start,
+            "growth": growth,
+            "rss_growth_bytes_per_hour": self.growth_per_hour(),
+            # Freed heap handed back to the system by malloc_trim(); None where it is not available
+            "malloc_trimmed_bytes": trimmed if self._malloc_trim is not None else None,
+            "endpoints": endpoints,
+            "history": history,
+            "tracemalloc": {
+                "enabled": tracemalloc.is_tracing(),
+                "frames": self.tracemalloc_frames,
+                "snapshots": snapshots,
+                "top_growth_since_start": top_since_start,
+                "top_growth_since_last": top_since_last
+            }
+        }
+
+    def close(self) -> None:
+        """Stop the sampling thread"""
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+
+def init_memory_guard(app, service: str, temp_prefix: Optional[str] = None,
+                      admin_token: str = "") -> Optional[MemoryTracker]:
+    """Install per-request RSS tracking and a /debug/memory route unless MEMORY_GUARD_ENABLED is false
+
+    /debug/memory requires admin_token in the X-Admin-Token header and is disabled without one.
+    """
+    if os.environ.get("MEMORY_GUARD_ENABLED", "true").lower() != "true":
+        return None
+
+    from flask import g, jsonify, request
+
+    tracker = MemoryTracker(
+        service,
+        temp_prefix=temp_prefix,
+        tracemalloc_frames=int(os.environ.get("MEMORY_TRACEMALLOC_FRAMES", 0)),
+        sample_interval=float(os.environ.get("MEMORY_SAMPLE_INTERVAL", 300)),
+        top_n=int(os.environ.get("MEMORY_TOP_ALLOCATIONS", 15)),
+        history=int(os.environ.get("MEMORY_HISTORY", 288)),
+        malloc_trim=os.environ.get("MEMORY_MALLOC_TRIM", "true").lower() == "true"
+    )
+
+    @app.before_request
+    def _start_memory():
+        g.memory_start_rss = tracker.request_started()
+
+    @app.teardown_request
+    def _record_memory(exc):
+        # teardown rather than after_request so requests that raised are counted too
+        if "memory_start_rss" in g:
+            endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+            tracker.request_finished(endpoint, g.pop("memory_start_rss"))
+
+    @app.route('/debug/memory', methods=['GET'])
+    def debug_memory():
+        """Memory, handle and temp-file usage, per-endpoint RSS deltas and top allocation growth"""
+        if not admin_token:
+            return jsonify({"error": "Memory debugging is disabled (no admin token configured)"}), 403
+        if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), admin_token):
+            return jsonify({"error": "Invalid or missing X-Admin-Token"}), 401
+        if request.args.get("sample", "").lower() in ("1", "true", "yes"):
+            tracker.sample()
+        return jsonify(tracker.report())
+
+    return tracker
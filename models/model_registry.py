@@ -0,0 +1,298 @@
+"""Versioned models with background loading, atomic swaps and canary routing.
+
+Each model kind ("leaf", "disease") has an active version, optionally a
+candidate that receives a configurable fraction of requests, and the
+previously active version kept for rollback. New versions are loaded and
+warmed up on a background thread. They are then swapped in under a lock, so
+requests never see a half-loaded model.
+
+A request pins the versions it will use once, with pin(). Everything it does
+afterwards goes through current(), which returns the pinned version. In-flight
+requests therefore finish on the version they started with, even if a swap
+happens midway. The replaced active version is kept for rollback, so it
+stays in memory until a later swap pushes it out of that slot. Only then,
+and once no request pins it, is it freed. A replaced or removed candidate
+is freed as soon as no request pins it.
+"""
+import contextvars
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+from instrumentation import REGISTRY
+
+MODEL_INFERENCE_SECONDS = REGISTRY.histogram(
+    "tomato_model_inference_seconds",
+    "Model call latency by model version",
+    ("kind", "version")
+)
+MODEL_PREDICTIONS = REGISTRY.counter(
+    "tomato_model_predictions_total",
+    "Predicted classes by model version",
+    ("kind", "version", "predicted_class")
+)
+
+_pinned = contextvars.ContextVar("pinned_model_versions", default=None)
+
+
+def file_version(path: str) -> str:
+    """Version id from the file name and a content hash"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return f"{os.path.splitext(os.path.basename(path))[0]}@{digest.hexdigest()[:12]}"
+
+
+class ModelVersion:
+    """One loaded model plus its serving statistics"""
+
+    def __init__(self, kind: str, version: str, path: str, model, class_names, extras: Optional[Dict] = None):
+        self.kind = kind
+        self.version = version
+        self.path = path
+        self.model = model
+        self.class_names = class_names
+        # Objects derived from the model at load time, e.g. the embedding model
+        self.extras = extras or {}
+        self.loaded_at = time.time()
+        self.mtime = os.path.getmtime(path) if os.path.exists(path) else None
+        self._latencies = deque(maxlen=1000)
+        self._class_counts = np.zeros(len(class_names), dtype=np.int64)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, predictions: np.ndarray) -> None:
+        """Record one model call over a batch of predictions"""
+        classes = np.argmax(predictions, axis=1)
+        MODEL_INFERENCE_SECONDS.observe(seconds, self.kind, self.version)
+        for class_id in classes:
+            MODEL_PREDICTIONS.inc(1, self.kind, self.version, self.class_names[class_id])
+        with self._lock:
+            self._latencies.append(seconds)
+            np.add.at(self._class_counts, classes, 1)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            latencies = np.asarray(self._latencies) * 1000
+            counts = self._class_counts.copy()
+        total = int(counts.sum())
+        return {
+            "version": self.version,
+            "path": self.path,
+            "loaded_at": self.loaded_at,
+            "calls": int(latencies.size),
+            "mean_ms": round(float(latencies.mean()), 2) if latencies.size else None,
+            "p95_ms": round(float(np.percentile(latencies, 95)), 2) if latencies.size else None,
+            "predictions": total,
+            "class_distribution": {
+                name: round(int(count) / total, 4) for name, count in zip(self.class_names, counts) if count
+            } if total else {}
+        }
+
+
+class ModelRegistry:
+    """Active, candidate and previous versions for each model kind"""
+
+    def __init__(self, loader: Callable, input_shape=(224, 224, 3), warmup_batch_sizes=(1, 8)):
+        self.loader = loader
+        self.input_shape = input_shape
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self._class_names: Dict[str, list] = {}
+        self._prepare: Dict[str, Callable] = {}
+        self._active: Dict[str, ModelVersion] = {}
+        self._candidate: Dict[str, ModelVersion] = {}
+        self._candidate_fraction: Dict[str, float] = {}
+        self._previous: Dict[str, ModelVersion] = {}
+        self._jobs: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._watcher = None
+
+    def register_kind(self, kind: str, class_names: list, prepare: Optional[Callable] = None) -> None:
+        """Declare a model kind; prepare(model) returns extras built once per loaded version"""
+        self._class_names[kind] = class_names
+        if prepare is not None:
+            self._prepare[kind] = prepare
+
+    def kinds(self) -> list:
+        return list(self._class_names)
+
+    # Loading
+
+    def _build_version(self, kind: str, path: str, version: Optional[str]) -> ModelVersion:
+        """Load, prepare and warm up a version without touching what is being served"""
+        model = self.loader(path)
+        outputs = int(model.outputs[0].shape[-1])
+        if outputs != len(self._class_names[kind]):
+            raise ValueError(f"{path} has {outputs} outputs, {kind} expects {len(self._class_names[kind])} classes")
+        prepare = self._prepare.get(kind)
+        extras = prepare(model) if prepare else {}
+
+        # The first calls build the graph; pay for them here, not in a request
+        for batch_size in self.warmup_batch_sizes:
+            warmup = np.zeros((batch_size,) + tuple(self.input_shape), dtype=np.float32)
+            model.predict(warmup, verbose=0)
+            for extra in extras.values():
+                if hasattr(extra, "predict"):
+                    extra.predict(warmup, verbose=0)
+        return ModelVersion(kind, version or file_version(path), path, model, self._class_names[kind], extras)
+
+    def _install(self, new_version: ModelVersion, candidate: bool, fraction: Optional[float]) -> None:
+        """Atomically make a loaded version active or the candidate"""
+        kind = new_version.kind
+        with self._lock:
+            if candidate:
+                self._candidate[kind] = new_version
+                if fraction is not None:
+                    self._candidate_fraction[kind] = fraction
+                else:
+                    self._candidate_fraction.setdefault(kind, 0.1)
+            else:
+                if kind in self._active:
+                    self._previous[kind] = self._active[kind]
+                self._active[kind] = new_version
+
+    def load(self, kind: str, path: str, version: Optional[str] = None, candidate: bool = False,
+             fraction: Optional[float] = None) -> ModelVersion:
+        """Load a version synchronously and install it"""
+        new_version = self._build_version(kind, path, version)
+        self._install(new_version, candidate, fraction)
+        return new_version
+
+    def load_async(self, kind: str, path: str, version: Optional[str] = None, candidate: bool = False,
+                   fraction: Optional[float] = None) -> Dict:
+        """Load a version on a background thread; returns the job record to poll"""
+        with self._lock:
+            job = self._jobs.get(kind)
+            if job and job["status"] == "loading":
+                raise RuntimeError(f"A {kind} model is already loading from {job['path']}")
+            job = self._jobs[kind] = {
+                "kind": kind, "path": path, "candidate": candidate, "status": "loading",
+                "started": time.time(), "finished": None, "version": None, "error": None
+            }
+
+        def run():
+            try:
+                new_version = self._build_version(kind, path, version)
+                self._install(new_version, candidate, fraction)
+                job.update(status="ready", version=new_version.version)
+            except Exception as e:
+                job.update(status="failed", error=str(e))
+                print(f"Loading {kind} model from {path} failed: {e}")
+            finally:
+                job["finished"] = time.time()
+
+        threading.Thread(target=run, name=f"load-{kind}-model", daemon=True).start()
+        return dict(job)
+
+    def watch(self, interval: float) -> None:
+        """Reload an active model in the background whenever its file changes"""
+        def poll():
+            while True:
+                time.sleep(interval)
+                for kind, active in list(self._active.items()):
+                    try:
+                        mtime = os.path.getmtime(active.path)
+                    except OSError:
+                        continue
+                    job = self._jobs.get(kind)
+                    if mtime != active.mtime and not (job and job["status"] == "loading"):
+                        print(f"{active.path} changed, reloading {kind} model")
+                        try:
+                            self.load_async(kind, active.path)
+                        except RuntimeError as e:
+                            # An admin load started since the check; try again next interval
+                            print(f"Not reloading {kind} model yet: {e}")
+                            continue
+                        # Never retry the same modification if it fails to load
+                        active.mtime = mtime
+
+        self._watcher = threading.Thread(target=poll, name="model-watcher", daemon=True)
+        self._watcher.start()
+
+    # Routing
+
+    def select(self, kind: str) -> ModelVersion:
+        """Pick the version for a new request, sending the canary fraction to the candidate"""
+        with self._lock:
+            candidate = self._candidate.get(kind)
+            if candidate is not None and random.random() < self._candidate_fraction.get(kind, 0.0):
+                return candidate
+            return self._active[kind]
+
+    @contextmanager
+    def pin(self):
+        """Fix the versions used for the rest of the current request"""
+        if _pinned.get() is not None:
+            yield _pinned.get()
+            return
+        versions = {kind: self.select(kind) for kind in self._class_names}
+        token = _pinned.set(versions)
+        try:
+            yield versions
+        finally:
+            _pinned.reset(token)
+
+    def current(self, kind: str) -> ModelVersion:
+        """The version pinned by the current request, else the active one"""
+        pinned = _pinned.get()
+        if pinned is not None and kind in pinned:
+            return pinned[kind]
+        with self._lock:
+            return self._active[kind]
+
+    # Administration
+
+    def promote(self, kind: str) -> ModelVersion:
+        """Make the candidate the active version"""
+        with self._lock:
+            candidate = self._candidate.pop(kind, None)
+            if candidate is None:
+                raise KeyError(f"No {kind} candidate to promote")
+            self._previous[kind] = self._active[kind]
+            self._active[kind] = candidate
+            return candidate
+
+    def rollback(self, kind: str) -> ModelVersion:
+        """Swap the previous active version back in"""
+        with self._lock:
+            previous = self._previous.pop(kind, None)
+            if previous is None:
+                raise KeyError(f"No previous {kind} version to roll back to")
+            self._previous[kind] = self._active[kind]
+            self._active[kind] = previous
+            return previous
+
+    def set_candidate_fraction(self, kind: str, fraction: float) -> None:
+        with self._lock:
+            self._candidate_fraction[kind] = min(max(fraction, 0.0), 1.0)
+
+    def remove_candidate(self, kind: str) -> None:
+        with self._lock:
+            if self._candidate.pop(kind, None) is None:
+                raise KeyError(f"No {kind} candidate to remove")
+
+    def describe(self) -> Dict:
+        """Versions, routing and per-version stats for every kind"""
+        with self._lock:
+            snapshot = {
+                kind: (self._active.get(kind), self._candidate.get(kind), self._previous.get(kind),
+                       self._candidate_fraction.get(kind, 0.0), dict(self._jobs.get(kind) or {}))
+                for kind in self._class_names
+            }
+        return {
+            kind: {
+                "active": active.stats() if active else None,
+                "candidate": candidate.stats() if candidate else None,
+                "candidate_fraction": fraction if candidate else 0.0,
+                "previous": previous.version if previous else None,
+                "last_load": job or None
+            }
+            for kind, (active, candidate, previous, fraction, job) in snapshot.items()
+        }
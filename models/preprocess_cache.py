@@ -0,0 +1,201 @@
+"""Decode-once cache of preprocessed images for repeated dataset evaluations.
+
+`build` walks a PlantVillage-style tree (one folder per class), decodes and
+resizes every image exactly as LeafDetectionServer.process_image does, and
+writes the pixels to a uint8 (N, 224, 224, 3) .npy file plus a sidecar .json
+index of paths and labels. `PreprocessedCache` memory-maps the .npy file and
+hands out zero-copy slices, so later evaluations skip JPEG decoding entirely
+and are bounded by inference.
+
+Examples:
+    python preprocess_cache.py build ~/PlantVillage cache/plantvillage
+    python preprocess_cache.py evaluate cache/plantvillage --model disease
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+IMAGE_SIZE = (224, 224)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def list_dataset(dataset_dir: str) -> Tuple[List[str], List[str]]:
+    """Image paths (relative to dataset_dir) and their class labels, in a stable order"""
+    paths, labels = [], []
+    for label in sorted(os.listdir(dataset_dir)):
+        class_dir = os.path.join(dataset_dir, label)
+        if not os.path.isdir(class_dir):
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(label, name))
+                labels.append(label)
+    return paths, labels
+
+
+def load_image(path: str) -> np.ndarray:
+    """Decode and resize one image the same way process_image does, as uint8"""
+    with Image.open(path) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return np.asarray(img.resize(IMAGE_SIZE), dtype=np.uint8)
+
+
+def build(dataset_dir: str, output_prefix: str, workers: Optional[int] = None) -> Dict:
+    """Preprocess every image under dataset_dir into <output_prefix>.npy and <output_prefix>.json"""
+    paths, labels = list_dataset(dataset_dir)
+    if not paths:
+        raise ValueError(f"No images found under {dataset_dir}")
+    os.makedirs(os.path.dirname(os.path.abspath(output_prefix)), exist_ok=True)
+
+    start = time.perf_counter()
+    array_path = output_prefix + ".npy"
+    pixels = np.lib.format.open_memmap(array_path, mode='w+', dtype=np.uint8, shape=(len(paths),) + IMAGE_SIZE + (3,))
+    failed = []
+
+    def decode_into(i):
+        try:
+            # Each worker writes straight into its own row of the memmap
+            pixels[i] = load_image(os.path.join(dataset_dir, paths[i]))
+        except (OSError, ValueError) as e:
+            failed.append((i, str(e)))
+
+    # PIL releases the GIL while decoding and resizing, so threads scale
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        list(pool.map(decode_into, range(len(paths))))
+    pixels.flush()
+    del pixels
+
+    index = {
+        "source": os.path.abspath(dataset_dir),
+        "shape": [len(paths), IMAGE_SIZE[1], IMAGE_SIZE[0], 3],
+        "paths": paths,
+        "labels": labels,
+        "class_names": sorted(set(labels)),
+        # Rows of unreadable images are left as zeros and excluded by the loader
+        "failed": sorted(i for i, _ in failed),
+        "created": time.time(),
+        "build_seconds": round(time.perf_counter() - start, 2)
+    }
+    with open(output_prefix + ".json", 'w') as f:
+        json.dump(index, f)
+    for i, error in failed:
+        print(f"Skipped {paths[i]}: {error}")
+    return index
+
+
+class PreprocessedCache:
+    """Read-only view of a cache written by build()"""
+
+    def __init__(self, output_prefix: str):
+        with open(output_prefix + ".json") as f:
+            self.index = json.load(f)
+        self.pixels = np.load(output_prefix + ".npy", mmap_mode='r')
+        if list(self.pixels.shape) != self.index["shape"]:
+            raise ValueError(f"{output_prefix}.npy has shape {self.pixels.shape}, index says {self.index['shape']}")
+        self.paths = self.index["paths"]
+        self.labels = self.index["labels"]
+        failed = set(self.index.get("failed", []))
+        self.valid = np.array([i not in failed for i in range(len(self.paths))], dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def label_ids(self, class_names: List[str]) -> np.ndarray:
+        """Label of every row as an index into class_names, -1 where it is not one of them"""
+        lookup = {name: i for i, name in enumerate(class_names)}
+        return np.array([lookup.get(label, -1) for label in self.labels], dtype=np.int64)
+
+    def batches(self, batch_size: int = 64) -> Iterator[Tuple[int, np.ndarray]]:
+        """(start, uint8 batch) pairs; every batch is a view into the memmap, not a copy"""
+        for start in range(0, len(self), batch_size):
+            yield start, self.pixels[start:start + batch_size]
+
+
+def to_model_input(batch: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Scale a uint8 batch to [0, 1] floats into a reused buffer, matching process_image"""
+    view = out[:len(batch)]
+    np.divide(batch, np.float32(255.0), out=view)
+    return view
+
+
+def evaluate(cache: PreprocessedCache, model, class_names: List[str], batch_size: int = 64) -> Dict:
+    """Accuracy of model over the cache, and how the time splits between input and inference"""
+    label_ids = cache.label_ids(class_names)
+    predicted = np.full(len(cache), -1, dtype=np.int64)
+    buffer = np.empty((batch_size,) + IMAGE_SIZE + (3,), dtype=np.float32)
+    input_seconds = inference_seconds = 0.0
+
+    for start, batch in cache.batches(batch_size):
+        t0 = time.perf_counter()
+        model_input = to_model_input(batch, buffer)
+        t1 = time.perf_counter()
+        predictions = model.predict(model_input, verbose=0)
+        inference_seconds += time.perf_counter() - t1
+        input_seconds += t1 - t0
+        predicted[start:start + len(batch)] = np.argmax(predictions, axis=1)
+
+    scored = cache.valid & (label_ids >= 0)
+    correct = predicted[scored] == label_ids[scored]
+    per_class = {}
+    for i, name in enumerate(class_names):
+        mask = label_ids[scored] == i
+        if mask.any():
+            per_class[name] = {"n": int(mask.sum()), "accuracy": round(float(correct[mask].mean()), 4)}
+
+    total = input_seconds + inference_seconds
+    return {
+        "images": len(cache),
+        "scored": int(scored.sum()),
+        "accuracy": round(float(correct.mean()), 4) if correct.size else None,
+        "per_class": per_class,
+        "input_seconds": round(input_seconds, 3),
+        "inference_seconds": round(inference_seconds, 3),
+        "images_per_second": round(len(cache) / total, 1) if total else None
+    }
+
+
+def main():
+    """Build a cache or evaluate one of the server's models on it"""
+    parser = argparse.ArgumentParser(description='Preprocessed tensor cache for dataset evaluations')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='Decode a class-per-folder dataset into a cache')
+    build_parser.add_argument('dataset_dir')
+    build_parser.add_argument('output_prefix', help='Writes <prefix>.npy and <prefix>.json')
+    build_parser.add_argument('--workers', type=int, help='Decode threads (default: CPU count)')
+
+    evaluate_parser = subparsers.add_parser('evaluate', help='Evaluate a server model on a cache')
+    evaluate_parser.add_argument('output_prefix')
+    evaluate_parser.add_argument('--model', choices=['leaf', 'disease'], default='disease')
+    evaluate_parser.add_argument('--batch-size', type=int, default=64)
+    evaluate_parser.add_argument('--output', help='Optional path to write the results as JSON')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        index = build(args.dataset_dir, args.output_prefix, args.workers)
+        print(f"Cached {index['shape'][0]} images from {len(index['class_names'])} classes "
+              f"in {index['build_seconds']}s ({len(index['failed'])} unreadable)")
+        return
+
+    # Loads the models from LEAF_MODEL_PATH / DISEASE_MODEL_PATH like the server does
+    from server import server
+    cache = PreprocessedCache(args.output_prefix)
+    if args.model == 'leaf':
+        results = evaluate(cache, server.leaf_model, server.leaf_class_names, args.batch_size)
+    else:
+        results = evaluate(cache, server.disease_model, server.disease_class_names, args.batch_size)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Opt-in per-request profiling for the model server and the mobile backend.
+
+When PROFILING_ENABLED is set, a request carrying an "X-Profile: 1" header
+and the admin token, or picked by PROFILE_SAMPLE_RATE, is run under cProfile
+and, where TensorFlow is loaded, under the TensorFlow profiler so the predict
+calls show up in a trace. Results go to a bounded ring of files in
+PROFILE_DIR and can be listed and downloaded from /profiles with the same
+token. Without a token only sampled requests are profiled and /profiles is
+disabled.
+
+When profiling is disabled init_profiling() installs nothing, so requests
+pay no overhead at all.
+
+tomatoApp imports this file through tomatoApp/shared_modules.py.
+"""
+import cProfile
+import hmac
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from instrumentation import current_request_id
+
+PROFILE_HEADER = "X-Profile"
+ADMIN_TOKEN_HEADER = "X-Admin-Token"
+
+
+class RequestProfiler:
+    """Captures cProfile and TensorFlow traces for selected requests"""
+
+    def __init__(self, directory: str, max_files: int = 20, sample_rate: float = 0.0, tf_trace: bool = True,
+                 admin_token: str = ""):
+        self.directory = os.path.abspath(directory)
+        self.max_files = max_files
+        self.sample_rate = sample_rate
+        self.tf_trace = tf_trace
+        self.admin_token = admin_token
+        # The TensorFlow profiler is process-wide, so only one trace can run at a time
+        self._tf_lock = threading.Lock()
+        self._ring_lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def is_admin(self, headers) -> bool:
+        """True when the request carries the configured admin token"""
+        return bool(self.admin_token) and hmac.compare_digest(headers.get(ADMIN_TOKEN_HEADER, ""), self.admin_token)
+
+    def should_profile(self, headers) -> bool:
+        """Profile when an admin asks for it by header, or for a random sample of requests"""
+        if headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes") and self.is_admin(headers):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self) -> Dict:
+        """Begin profiling the current request and return its state"""
+        state = {"started": time.time(), "profile": None, "tf_logdir": None}
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            state["profile"] = profile
+        except ValueError:
+            # Python 3.12+ allows only one active profiler per process
+            pass
+
+        if self.tf_trace and "tensorflow" in sys.modules and self._tf_lock.acquire(blocking=False):
+            import tensorflow as tf
+            logdir = tempfile.mkdtemp(prefix="tf_trace_", dir=self.directory)
+            try:
+                tf.profiler.experimental.start(logdir)
+                state["tf_logdir"] = logdir
+            except Exception:
+                shutil.rmtree(logdir, ignore_errors=True)
+                self._tf_lock.release()
+        return state
+
+    def stop(self, state: Dict, label: str) -> List[str]:
+        """Stop profiling, write the results and return the file names written"""
+        written = []
+        prefix = f"{time.strftime('%Y%m%d_%H%M%S', time.localtime(state['started']))}_{_safe_name(label)}"
+
+        try:
+            profile = state.get("profile")
+            if profile is not None:
+                profile.disable()
+                path = os.path.join(self.directory, f"{prefix}.prof")
+                profile.dump_stats(path)
+                written.append(os.path.basename(path))
+        finally:
+            # Stop the trace and free the TensorFlow profiler even if the dump failed
+            logdir = state.get("tf_logdir")
+            if logdir is not None:
+                import tensorflow as tf
+                try:
+                    tf.profiler.experimental.stop()
+                    archive = shutil.make_archive(os.path.join(self.directory, f"{prefix}.tftrace"), "zip", logdir)
+                    written.append(os.path.basename(archive))
+                finally:
+                    shutil.rmtree(logdir, ignore_errors=True)
+                    self._tf_lock.release()
+
+        self._prune()
+        return written
+
+    def list_profiles(self) -> List[Dict]:
+        """Profile files currently in the ring, newest first"""
+        profiles = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path) and name.endswith((".prof", ".tftrace.zip")):
+                stat = os.stat(path)
+                profiles.append({"name": name, "size_bytes": stat.st_size, "created": stat.st_mtime})
+        return sorted(profiles, key=lambda p: p["created"], reverse=True)
+
+    def _prune(self) -> None:
+        """Delete the oldest profile files beyond max_files"""
+        with self._ring_lock:
+            for profile in self.list_profiles()[self.max_files:]:
+                try:
+                    os.remove(os.path.join(self.directory, profile["name"]))
+                except OSError:
+                    pass
+
+
+def _safe_name(label: str) -> str:
+    """File-name-safe version of a request label"""
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", label).strip("_")[:80] or "request"
+
+
+def init_profiling(app, service: str, admin_token: str = "") -> Optional[RequestProfiler]:
+    """Install profiling hooks and /profiles routes if PROFILING_ENABLED is set
+
+    The X-Profile header and /profiles require admin_token in the X-Admin-Token
+    header; without one only PROFILE_SAMPLE_RATE selects requests.
+    """
+    if os.environ.get("PROFILING_ENABLED", "false").lower() != "true":
+        return None
+
+    from flask import abort, g, jsonify, request, send_from_directory
+
+    profiler = RequestProfiler(
+        directory=os.environ.get("PROFILE_DIR", "profiles"),
+        max_files=int(os.environ.get("PROFILE_MAX_FILES", 20)),
+        sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", 0.0)),
+        tf_trace=os.environ.get("PROFILE_TF_TRACE", "true").lower() == "true",
+        admin_token=admin_token
+    )
+
+    def admin_error():
+        if not profiler.admin_token:
+            return jsonify({"error": "Profile downloads are disabled (no admin token configured)"}), 403
+        if not profiler.is_admin(request.headers):
+            return jsonify({"error": "Invalid or missing X-Admin-Token"}), 401
+        return None
+
+    @app.before_request
+    def _start_profile():
+        if request.path.startswith("/profiles") or not profiler.should_profile(request.headers):
+            return
+        g.profile_state = profiler.start()
+
+    @app.after_request
+    def _stop_profile(response):
+        state = g.pop("profile_state", None)
+        if state is not None:
+            label = f"{service}_{request.endpoint or 'unknown'}_{current_request_id() or ''}"
+            response.headers["X-Profile-Files"] = ",".join(profiler.stop(state, label))
+        return response
+
+    @app.teardown_request
+    def _abandon_profile(exc):
+        # Requests that raised never reach after_request; still release the profilers
+        state = g.pop("profile_state", None)
+        if state is not None:
+            profiler.stop(state, f"{service}_{request.endpoint or 'unknown'}_error")
+
+    @app.route('/profiles', methods=['GET'])
+    def list_profiles():
+        """List captured profile files"""
+        error = admin_error()
+        if error:
+            return error
+        return jsonify({"profiles": profiler.list_profiles(), "max_files": profiler.max_files})
+
+    @app.route('/profiles/<name>', methods=['GET'])
+    def download_profile(name):
+        """Download one profile file"""
+        error = admin_error()
+        if error:
+            return error
+        if name not in {p["name"] for p in profiler.list_profiles()}:
+            abort(404)
+        return send_from_directory(profiler.directory, name, as_attachment=True)
+
+    return profiler
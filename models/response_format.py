@@ -0,0 +1,154 @@
+"""Compact prediction responses and optional binary encodings.
+
+A full /predict response repeats all ten disease class names and sends the
+probabilities as JSON floats. With `"compact": true` in the request, the
+server replaces both:
+
+- `class_names` becomes `classes_version`, a hash of the class lists that
+  GET /classes publishes once. Clients cache the lists by that version.
+- `all_probabilities` becomes `probabilities_f16`, the little-endian float16
+  vector. It is base64 in JSON and raw bytes in msgpack or CBOR. With
+  `"top_k": k`, it becomes `top_k` instead: [class_index, probability] pairs
+  for the k most likely classes.
+
+Independently, a client can send `Accept: application/msgpack` or
+`application/cbor` to get a binary body when the server has msgpack or cbor2
+installed. Otherwise the server falls back to JSON.
+
+Class-activation maps ("cam": true) travel as {"shape": [h, w], "data": ...,
+"peak": p}: uint8 pixels, row-major and base64-encoded (see encode_map() and
+decode_map()), scaled so that 255 stands for the unscaled activation p.
+
+tomatoApp imports this file through shared_modules.py, so the client uses
+the same expand() and decode() to undo all of this.
+"""
+import base64
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+JSON = "application/json"
+MSGPACK = "application/msgpack"
+CBOR = "application/cbor"
+_MEDIA_TYPES = {
+    "application/json": JSON,
+    "application/msgpack": MSGPACK,
+    "application/x-msgpack": MSGPACK,
+    "application/cbor": CBOR
+}
+
+
+def classes_version(class_sets: Dict[str, List[str]]) -> str:
+    """Short content hash of the class name lists"""
+    return hashlib.sha256(json.dumps(class_sets, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def available_media_types() -> List[str]:
+    """Response encodings this process can produce, best first"""
+    return [media_type for media_type, codec in ((MSGPACK, msgpack), (CBOR, cbor2)) if codec] + [JSON]
+
+
+def negotiate(accept: Optional[str]) -> str:
+    """Media type to answer with for an Accept header; JSON unless a binary type is asked for and installed"""
+    if not accept:
+        return JSON
+    ranked = []
+    for position, entry in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in entry.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        ranked.append((-quality, position, media_type.lower()))
+    for quality, _, media_type in sorted(ranked):
+        if quality == 0:
+            break
+        media_type = _MEDIA_TYPES.get(media_type, media_type)
+        if media_type in available_media_types():
+            return media_type
+    return JSON
+
+
+def compact(result: Dict, version: str, top_k: int = 0, binary: bool = False) -> Dict:
+    """Drop class_names and replace all_probabilities with float16 or top-k probabilities"""
+    if "all_probabilities" not in result:
+        return result
+    result = dict(result)
+    probabilities = np.asarray(result.pop("all_probabilities"), dtype=np.float32)
+    result.pop("class_names", None)
+    result["classes_version"] = version
+    if top_k > 0:
+        top = np.argsort(probabilities)[::-1][:top_k]
+        result["top_k"] = [[int(i), float(probabilities[i])] for i in top]
+    else:
+        raw = probabilities.astype('<f2').tobytes()
+        result["probabilities_f16"] = raw if binary else base64.b64encode(raw).decode('ascii')
+    return result
+
+
+def expand(result: Dict, class_names: List[str]) -> Dict:
+    """Undo compact(): restore all_probabilities and class_names; top-k leaves the other classes at 0"""
+    if "classes_version" not in result:
+        return result
+    result = dict(result)
+    result.pop("classes_version")
+    if "probabilities_f16" in result:
+        raw = result.pop("probabilities_f16")
+        if isinstance(raw, str):
+            raw = base64.b64decode(raw)
+        probabilities = np.frombuffer(raw, dtype='<f2').astype(float).tolist()
+    else:
+        probabilities = [0.0] * len(class_names)
+        for index, probability in result.pop("top_k", []):
+            probabilities[index] = probability
+    result["all_probabilities"] = probabilities
+    result["class_names"] = list(class_names)
+    return result
+
+
+def encode_map(array: np.ndarray) -> Dict:
+    """A 2-D uint8 map as a JSON-safe shape and base64 payload"""
+    array = np.ascontiguousarray(array, dtype=np.uint8)
+    return {"shape": list(array.shape), "data": base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def decode_map(value: Dict) -> np.ndarray:
+    """Inverse of encode_map(); also accepts raw bytes from a binary encoding"""
+    data = value["data"]
+    if isinstance(data, str):
+        data = base64.b64decode(data)
+    return np.frombuffer(data, dtype=np.uint8).reshape(value["shape"])
+
+
+def encode(payload, media_type: str) -> bytes:
+    """Serialize a response body in a media type returned by negotiate()"""
+    if media_type == MSGPACK:
+        return msgpack.packb(payload, use_bin_type=True)
+    if media_type == CBOR:
+        return cbor2.dumps(payload)
+    return json.dumps(payload).encode()
+
+
+def decode(body: bytes, content_type: Optional[str]):
+    """Parse a response body by its Content-Type header"""
+    media_type = _MEDIA_TYPES.get((content_type or JSON).split(";")[0].strip().lower(), JSON)
+    if media_type == MSGPACK:
+        return msgpack.unpackb(body, raw=False)
+    if media_type == CBOR:
+        return cbor2.loads(body)
+    return json.loads(body)
@@ -2,20 +2,96 @@ import tensorflow as tf
 import numpy as np
 from tensorflow.keras.models import load_model
 from tensorflow.keras.preprocessing.image import img_to_array
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 import os
 import base64
+import json
 from PIL import Image
 import io
+import time
+import math
+from instrumentation import init_flask, timed, current_request_id
+from profiling import init_profiling
+from memory_guard import init_memory_guard
+from similarity_index import SimilarityIndex
+from model_registry import ModelRegistry
+from leaf_prefilter import LeafPrefilter
+from cascade import CascadePolicy
+from compiled_inference import CompiledModel
+from activation_maps import GradCAM, encode_cam
+from response_format import JSON, classes_version, compact, encode, negotiate
+from admission import (AdmissionController, Deadline, DeadlineExceeded, Overloaded,
+                       DEADLINE_HEADER, check_deadline, set_deadline)
 
 app = Flask(__name__)
+init_flask(app, "model_server")
+
+# Number of test-time augmentation views used when a request asks for TTA without a count
+DEFAULT_TTA_VIEWS = int(os.environ.get("TTA_VIEWS", 8))
+MAX_TTA_VIEWS = 8
+
+# How far the edge's probabilities may sum from 1; int8-quantized outputs are off by up to half a step per class
+EDGE_SUM_TOLERANCE = 0.05
+
+# Directory of the similar-case index; unset leaves indexing and /similar disabled
+SIMILARITY_INDEX_DIR = os.environ.get("SIMILARITY_INDEX_DIR", "")
+MAX_SIMILAR_RESULTS = 100
+
+# Frame-stream scanning: frames per inference batch, the dHash Hamming distance
+# below which a frame counts as a duplicate, and how many duplicates in a row
+# may reuse one result before a frame is inferred anyway
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 8))
+STREAM_HASH_THRESHOLD = int(os.environ.get("STREAM_HASH_THRESHOLD", 5))
+STREAM_MAX_SKIPPED = int(os.environ.get("STREAM_MAX_SKIPPED", 30))
+
+# Admission control: requests running model work at once, requests allowed to
+# wait for a slot, and the deadline applied when a request does not set one (0 = none)
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 2))
+MAX_QUEUE = int(os.environ.get("MAX_QUEUE", 8))
+DEFAULT_DEADLINE_MS = int(os.environ.get("DEFAULT_DEADLINE_MS", 30000))
+admission = AdmissionController(MAX_IN_FLIGHT, MAX_QUEUE)
+
+# Colour prefilter in front of leaf_model: images with less than
+# LEAF_PREFILTER_REJECT_BELOW leaf-coloured pixels are rejected without TensorFlow
+LEAF_PREFILTER = os.environ.get("LEAF_PREFILTER", "true").lower() == "true"
+LEAF_PREFILTER_REJECT_BELOW = float(os.environ.get("LEAF_PREFILTER_REJECT_BELOW", 0.02))
+LEAF_PREFILTER_BORDERLINE_BELOW = float(os.environ.get("LEAF_PREFILTER_BORDERLINE_BELOW", 0.10))
+LEAF_PREFILTER_AUDIT_RATE = float(os.environ.get("LEAF_PREFILTER_AUDIT_RATE", 0.02))
+
+# Confidence cascade: a small model with the disease classes answers first and
+# images below either threshold are escalated to disease_model; unset path disables it.
+# The margin only matters above 2 * CASCADE_MIN_CONFIDENCE - 1
+CASCADE_MODEL_PATH = os.environ.get("CASCADE_MODEL_PATH", "")
+CASCADE_MIN_CONFIDENCE = float(os.environ.get("CASCADE_MIN_CONFIDENCE", 0.8))
+CASCADE_MIN_MARGIN = float(os.environ.get("CASCADE_MIN_MARGIN", 0.7))
+CASCADE_AUDIT_RATE = float(os.environ.get("CASCADE_AUDIT_RATE", 0.02))
+
+# Compiled inference: every model is also wrapped in a tf.function traced for
+# these batch-size buckets at load time, and called instead of model.predict.
+# XLA_JIT=auto compiles with XLA only on GPU; on CPU the plain graph is usually faster
+COMPILED_INFERENCE = os.environ.get("COMPILED_INFERENCE", "true").lower() == "true"
+INFERENCE_BUCKETS = tuple(int(size) for size in os.environ.get("INFERENCE_BUCKETS", "1,4,8,16").split(","))
+XLA_JIT = os.environ.get("XLA_JIT", "auto").lower()
+XLA_JIT = XLA_JIT == "true" or (XLA_JIT == "auto" and bool(tf.config.list_physical_devices("GPU")))
+
+# Grad-CAM maps for requests with "cam": true; off skips tracing the gradient function at load
+GRAD_CAM = os.environ.get("GRAD_CAM", "true").lower() == "true"
+
+# Model administration endpoints are disabled unless a token is configured;
+# a positive watch interval reloads a model whenever its file changes
+MODEL_ADMIN_TOKEN = os.environ.get("MODEL_ADMIN_TOKEN", "")
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", 0))
+
+# /debug/memory, /profiles and the X-Profile header take the same token as model administration
+init_profiling(app, "model_server", admin_token=MODEL_ADMIN_TOKEN)
+init_memory_guard(app, "model_server", admin_token=MODEL_ADMIN_TOKEN)
 
 class LeafDetectionServer:
     def __init__(self, leaf_model_path: str, disease_model_path: str):
         """Initialize the server with both models"""
-        # Load both models
-        self.leaf_model = load_model(leaf_model_path)
-        self.disease_model = load_model(disease_model_path)
+        self.similarity_index = None
+        self.prefilter = None
+        self.cascade = None
         
         # Class names for leaf detection (adjust based on your actual classes)
         self.leaf_class_names = ['Non-tomato', 'tomato']
@@ -33,40 +109,278 @@ class LeafDetectionServer:
             'Tomato__Tomato_mosaic_virus',
             'Tomato_healthy'
         ]
+        
+        # Load both models through the registry so they can be swapped without a restart
+        self.registry = ModelRegistry(load_model)
+        self.registry.register_kind("leaf", self.leaf_class_names, prepare=self.prepare_model)
+        self.registry.register_kind("disease", self.disease_class_names, prepare=self.prepare_disease_model)
+        self.registry.load("leaf", leaf_model_path, os.environ.get("LEAF_MODEL_VERSION"))
+        self.registry.load("disease", disease_model_path, os.environ.get("DISEASE_MODEL_VERSION"))
+    
+    @property
+    def leaf_model(self):
+        """Leaf model version pinned by the current request, else the active one"""
+        return self.registry.current("leaf").model
+    
+    @property
+    def disease_model(self):
+        """Disease model version pinned by the current request, else the active one"""
+        return self.registry.current("disease").model
+    
+    @property
+    def disease_embedding_model(self):
+        return self.registry.current("disease").extras.get("embedding_model")
+    
+    def run_leaf_model(self, batch: np.ndarray) -> np.ndarray:
+        """Run the leaf model on a batch, recording per-version stats"""
+        check_deadline("leaf_gate_inference")
+        version = self.registry.current("leaf")
+        with timed("leaf_gate_inference"):
+            start = time.perf_counter()
+            predictions = self.inference_model(version).predict(batch, verbose=0)
+        version.record(time.perf_counter() - start, predictions)
+        return predictions
+    
+    def compile_model(self, model):
+        """Bucketed XLA-compiled wrapper of model, or None when compiled inference is off"""
+        if not COMPILED_INFERENCE or model is None:
+            return None
+        return CompiledModel(model, INFERENCE_BUCKETS, jit_compile=XLA_JIT)
+    
+    def prepare_model(self, model) -> dict:
+        """Objects built once per loaded leaf or cascade model version"""
+        return {"compiled": self.compile_model(model)}
+    
+    def prepare_disease_model(self, model) -> dict:
+        """Also the same forward pass returning the penultimate-layer embedding, and Grad-CAM"""
+        embedding_model = self.build_embedding_model(model)
+        return {
+            "compiled": self.compile_model(model),
+            "embedding_model": embedding_model,
+            "compiled_embedding": self.compile_model(embedding_model),
+            "grad_cam": GradCAM.for_model(model) if GRAD_CAM else None
+        }
+    
+    @staticmethod
+    def inference_model(version, compiled_key: str = "compiled", keras_model=None):
+        """The compiled wrapper of a version's model when there is one, else the Keras model"""
+        return version.extras.get(compiled_key) or keras_model or version.model
+    
+    def build_embedding_model(self, model):
+        """Wrap model so it outputs [embedding, probabilities], or None if it has no flat penultimate layer"""
+        for layer in reversed(model.layers[:-1]):
+            if len(layer.output.shape) == 2:
+                return tf.keras.Model(model.inputs, [layer.output, model.outputs[0]])
+        return None
+    
+    def enable_similarity_index(self, directory: str) -> SimilarityIndex:
+        """Open the similar-case index and start indexing predictions"""
+        if self.disease_embedding_model is None:
+            raise ValueError("disease_model has no flat penultimate layer to index")
+        embedding_dim = int(self.disease_embedding_model.outputs[0].shape[-1])
+        self.similarity_index = SimilarityIndex(
+            directory,
+            input_dim=embedding_dim,
+            dim=int(os.environ.get("SIMILARITY_DIM", 128)),
+            nprobe=int(os.environ.get("SIMILARITY_NPROBE", 16))
+        )
+        return self.similarity_index
+    
+    def run_disease_model(self, batch: np.ndarray, with_embedding: bool = False) -> tuple:
+        """Run disease_model on a batch and return (embeddings or None, probabilities)"""
+        check_deadline("disease_inference")
+        version = self.registry.current("disease")
+        embedding_model = version.extras.get("embedding_model")
+        with timed("disease_inference"):
+            start = time.perf_counter()
+            if with_embedding and embedding_model is not None:
+                model = self.inference_model(version, "compiled_embedding", embedding_model)
+                embeddings, predictions = model.predict(batch, verbose=0)
+            else:
+                embeddings, predictions = None, self.inference_model(version).predict(batch, verbose=0)
+        version.record(time.perf_counter() - start, predictions)
+        return embeddings, predictions
+    
+    def run_disease_cam(self, batch: np.ndarray) -> tuple:
+        """(probabilities, uint8 activation maps, map peaks) from disease_model's forward and backward pass
+        
+        The maps and peaks are None when Grad-CAM is off or the model has no convolutional feature map.
+        """
+        version = self.registry.current("disease")
+        grad_cam = version.extras.get("grad_cam")
+        if grad_cam is None:
+            return self.run_disease_model(batch)[1], None, None
+        check_deadline("disease_inference")
+        with timed("disease_cam"):
+            start = time.perf_counter()
+            predictions, cams, peaks = grad_cam(batch)
+        version.record(time.perf_counter() - start, predictions)
+        return predictions, cams, peaks
+    
+    def enable_cascade(self, model_path: str, policy: CascadePolicy) -> None:
+        """Answer disease predictions with a small model first, escalating doubtful images"""
+        self.registry.register_kind("cascade", self.disease_class_names, prepare=self.prepare_model)
+        self.registry.load("cascade", model_path, os.environ.get("CASCADE_MODEL_VERSION"))
+        self.cascade = policy
+    
+    def run_cascade(self, batch: np.ndarray, views: int = 1) -> np.ndarray:
+        """Disease probabilities from the cascade model, with doubtful images re-run on disease_model
+        
+        Rows come in groups of `views` per image (TTA); each image is judged on
+        its mean probabilities and escalated as a whole.
+        """
+        check_deadline("cascade_inference")
+        version = self.registry.current("cascade")
+        with timed("cascade_inference"):
+            start = time.perf_counter()
+            predictions = self.inference_model(version).predict(batch, verbose=0)
+        version.record(time.perf_counter() - start, predictions)
+        
+        per_image = predictions.reshape(-1, views, predictions.shape[-1]).mean(axis=1)
+        escalate, audit = self.cascade.decide(per_image)
+        both = escalate | audit
+        if both.any():
+            rows = np.repeat(both, views)
+            _, full = self.run_disease_model(batch[rows])
+            self.cascade.record_agreement(per_image[both], full.reshape(-1, views, full.shape[-1]).mean(axis=1),
+                                          escalate[both])
+            # Audited images get the full model's answer too, since it was computed anyway
+            predictions[rows] = full
+        return predictions
+    
+    def disease_probabilities(self, batch: np.ndarray, views: int = 1, with_embedding: bool = False) -> tuple:
+        """(embeddings or None, probabilities), through the cascade unless it is off or an embedding is needed"""
+        if self.cascade is None or with_embedding:
+            # Embeddings come from disease_model's penultimate layer, so the cascade cannot answer these
+            return self.run_disease_model(batch, with_embedding)
+        return None, self.run_cascade(batch, views)
+    
+    def decode_image(self, image_data: str) -> Image.Image:
+        """Decode base64 image data to an RGB PIL image"""
+        with timed("decode"):
+            img_bytes = base64.b64decode(image_data)
+            img = Image.open(io.BytesIO(img_bytes))
+            
+            # Convert to RGB (important for RGBA images)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            return img
     
     def process_image(self, image_data: str) -> np.ndarray:
         """Process base64 image data"""
+        check_deadline("preprocess")
         # Decode base64 image
-        img_bytes = base64.b64decode(image_data)
-        img = Image.open(io.BytesIO(img_bytes))
-        
-        # Convert to RGB (important for RGBA images)
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        # Resize and preprocess
-        img = img.resize((224, 224))
-        img_array = img_to_array(img)
-        img_array = np.expand_dims(img_array, axis=0)
-        return img_array / 255.0
-    
-    def is_tomato_leaf(self, image_data: str) -> tuple:
-        """Check if image contains a tomato leaf"""
-        processed_image = self.process_image(image_data)
-        predictions = self.leaf_model.predict(processed_image, verbose=0)
+        return self.image_to_array(self.decode_image(image_data))
+    
+    def image_to_array(self, img: Image.Image) -> np.ndarray:
+        """Resize a decoded image into a (1, 224, 224, 3) model input"""
+        with timed("preprocess"):
+            img = img.resize((224, 224))
+            img_array = img_to_array(img)
+            img_array = np.expand_dims(img_array, axis=0)
+            return img_array / 255.0
+    
+    def is_tomato_leaf(self, image_data: str, img: Image.Image = None) -> tuple:
+        """Check if image contains a tomato leaf, reusing img if it is already decoded"""
+        processed_image = self.image_to_array(img) if img is not None else self.process_image(image_data)
+        predictions = self.run_leaf_model(processed_image)
         predicted_class = self.leaf_class_names[np.argmax(predictions[0])]
         confidence = float(np.max(predictions[0]))
         
         # Return True if it's a tomato leaf, along with confidence
         return predicted_class == 'tomato', confidence, predicted_class
     
-    def predict_disease(self, image_data: str) -> dict:
-        """Predict disease from image data"""
-        processed_image = self.process_image(image_data)
-        predictions = self.disease_model.predict(processed_image, verbose=0)
-        predicted_class = self.disease_class_names[np.argmax(predictions[0])]
-        confidence = float(np.max(predictions[0]))
-        all_probabilities = [float(p) for p in predictions[0]]
+    def augment_views(self, img: Image.Image, views: int) -> np.ndarray:
+        """Build a (views, 224, 224, 3) batch of flips, crops and small rotations
+        
+        The first view is the plain resize used without TTA. The rest come from
+        a single 256x256 resize, so only two full-resolution resizes are paid.
+        Rotations are 8 degrees: the centre 224x224 of a 256x256 square turned
+        by up to 8.3 degrees lies inside the square, so no black corner shows.
+        """
+        with timed("preprocess"):
+            base = np.asarray(img.resize((224, 224)), dtype=np.float32)
+            large_img = img.resize((256, 256))
+            large = np.asarray(large_img, dtype=np.float32)
+            
+            candidates = [
+                lambda: base,
+                lambda: base[:, ::-1],
+                lambda: large[16:240, 16:240],
+                lambda: np.asarray(large_img.rotate(8, resample=Image.BILINEAR), dtype=np.float32)[16:240, 16:240],
+                lambda: np.asarray(large_img.rotate(-8, resample=Image.BILINEAR), dtype=np.float32)[16:240, 16:240],
+                lambda: base[::-1, :],
+                lambda: large[:224, :224],
+                lambda: large[32:, 32:]
+            ]
+            batch = np.stack([make_view() for make_view in candidates[:views]])
+            return batch / 255.0
+    
+    def predict_disease(self, image_data: str, tta_views: int = 0, with_embedding: bool = False,
+                        with_cam: bool = False):
+        """Predict disease from image data
+        
+        With tta_views > 1 the augmented views go through disease_model as one
+        batch and the mean probability is reported, along with how much the
+        views disagreed. With with_embedding, returns (result, embedding) where
+        embedding comes from the same forward pass (averaged over TTA views).
+        With the cascade enabled and no embedding or map needed, the cascade
+        model answers first and only doubtful images reach disease_model.
+        With with_cam, the result carries the Grad-CAM map of the unaugmented view.
+        """
+        if tta_views > 1:
+            check_deadline("preprocess")
+            batch = self.augment_views(self.decode_image(image_data), min(tta_views, MAX_TTA_VIEWS))
+        else:
+            batch = self.process_image(image_data)
+        cams = None
+        if with_cam and len(batch) > 1:
+            # Only the unaugmented view's map is returned, so only that view pays for the backward pass
+            embeddings, predictions = self.run_disease_model(batch, with_embedding=with_embedding)
+            _, cams, peaks = self.run_disease_cam(batch[:1])
+        elif with_cam:
+            predictions, cams, peaks = self.run_disease_cam(batch)
+            embeddings = self.run_disease_model(batch, with_embedding=True)[0] if with_embedding else None
+        else:
+            embeddings, predictions = self.disease_probabilities(batch, len(batch), with_embedding)
+        
+        if tta_views > 1:
+            result = self.disease_result(predictions.mean(axis=0))
+            result["tta"] = self.tta_summary(predictions)
+            embedding = None if embeddings is None else embeddings.mean(axis=0)
+        else:
+            result = self.disease_result(predictions[0])
+            embedding = None if embeddings is None else embeddings[0]
+        if cams is not None:
+            # The first view is the plain resize, so its map lines up with the photo
+            result["cam"] = encode_cam(cams[0], peaks[0])
+        
+        if with_embedding:
+            return result, embedding
+        return result
+    
+    def tta_summary(self, predictions: np.ndarray) -> dict:
+        """Uncertainty of a batch of per-view probabilities
+        
+        uncertainty is the entropy of the mean distribution normalized to [0, 1];
+        agreement is the fraction of views voting for the mean's top class.
+        """
+        mean = predictions.mean(axis=0)
+        top_class = int(np.argmax(mean))
+        entropy = -float(np.sum(mean * np.log(np.clip(mean, 1e-12, 1.0))))
+        return {
+            "views": int(predictions.shape[0]),
+            "uncertainty": entropy / float(np.log(len(mean))),
+            "agreement": float(np.mean(np.argmax(predictions, axis=1) == top_class)),
+            "confidence_std": float(np.std(predictions[:, top_class]))
+        }
+    
+    def disease_result(self, probabilities) -> dict:
+        """Build the disease response from one row of disease_model output"""
+        probabilities = np.asarray(probabilities)
+        predicted_class = self.disease_class_names[np.argmax(probabilities)]
+        confidence = float(np.max(probabilities))
+        all_probabilities = [float(p) for p in probabilities]
         
         return {
             "predicted_class": predicted_class,
@@ -75,30 +389,294 @@ class LeafDetectionServer:
             "class_names": self.disease_class_names
         }
     
-    def process_request(self, image_data: str) -> dict:
-        """Process the request by first checking if it's a tomato leaf"""
+    def parse_edge_result(self, edge_result) -> dict:
+        """Check the "edge" field of a request; returns its probabilities as arrays or raises ValueError
+        
+        Each probability list must have one finite value in [0, 1] per class of
+        its model and sum to 1, so a caller cannot pass arbitrary confidences
+        off as model output.
+        """
+        if edge_result is None:
+            return {}
+        if not isinstance(edge_result, dict):
+            raise ValueError("edge must be an object")
+        expected = {"leaf_probabilities": self.leaf_class_names, "disease_probabilities": self.disease_class_names}
+        unknown = set(edge_result) - set(expected)
+        if unknown:
+            raise ValueError(f"Unknown edge fields: {', '.join(sorted(unknown))}")
+        parsed = {}
+        for key, class_names in expected.items():
+            if key not in edge_result:
+                continue
+            values = edge_result[key]
+            if (not isinstance(values, list) or len(values) != len(class_names)
+                    or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)):
+                raise ValueError(f"{key} must be a list of {len(class_names)} numbers")
+            probabilities = np.asarray(values, dtype=np.float64)
+            if not np.isfinite(probabilities).all() or (probabilities < 0).any() or (probabilities > 1).any():
+                raise ValueError(f"{key} must be between 0 and 1")
+            if abs(probabilities.sum() - 1) > EDGE_SUM_TOLERANCE:
+                raise ValueError(f"{key} must sum to 1, not {probabilities.sum():.3f}")
+            parsed[key] = probabilities
+        return parsed
+    
+    def edge_leaf_result(self, edge_result: dict) -> tuple:
+        """Interpret leaf-gate output computed on a Raspberry Pi, same shape as is_tomato_leaf"""
+        probabilities = edge_result["leaf_probabilities"]
+        predicted_class = self.leaf_class_names[np.argmax(probabilities)]
+        return predicted_class == 'tomato', float(np.max(probabilities)), predicted_class
+    
+    def process_request(self, image_data: str, edge_result: dict = None, tta_views: int = 0,
+                        store: bool = True, include_embedding: bool = False, include_cam: bool = False) -> dict:
+        """Process the request by first checking if it's a tomato leaf
+        
+        edge_result carries model outputs already computed by edge_inference.py
+        on a Raspberry Pi, as returned by parse_edge_result; the matching model
+        is skipped here when present, and "edge_inference" says which ones were.
+        tta_views > 1 enables test-time augmentation for the disease prediction.
+        With the similarity index enabled and store set, the prediction's
+        embedding is indexed and its id returned as analysis_id. include_cam
+        adds a Grad-CAM map unless the disease probabilities came from the edge.
+        """
+        # Every model call of this request uses the same versions, even across a hot swap
+        with self.registry.pin() as versions:
+            result = self._process_request(image_data, edge_result, tta_views, store, include_embedding,
+                                           include_cam)
+        result["model_versions"] = {kind: version.version for kind, version in versions.items()}
+        return result
+    
+    def _process_request(self, image_data: str, edge_result: dict, tta_views: int,
+                         store: bool, include_embedding: bool, include_cam: bool = False) -> dict:
+        """process_request with model versions already pinned"""
         # First check if it's a tomato leaf
-        is_tomato, confidence, leaf_class = self.is_tomato_leaf(image_data)
+        edge_result = edge_result or {}
+        if "leaf_probabilities" in edge_result:
+            is_tomato, confidence, leaf_class = self.edge_leaf_result(edge_result)
+        else:
+            img = self.decode_image(image_data)
+            prefilter = self.run_prefilter(img)
+            if prefilter and prefilter["outcome"] == "reject" and not prefilter["audit"]:
+                return self.prefilter_reject_result(prefilter)
+            is_tomato, confidence, leaf_class = self.is_tomato_leaf(image_data, img)
+            if prefilter and prefilter["audit"]:
+                # Audited rejects get the model's answer
+                self.prefilter.record_audit(is_tomato)
         
         if not is_tomato:
-            return {
-                "error": "Not a tomato leaf image",
-                "detail": f"Detected as '{leaf_class}' with {confidence*100:.2f}% confidence",
-                "is_valid_tomato": False
-            }
+            return self.not_tomato_result(leaf_class, confidence)
         
         # If it is a tomato leaf, then predict the disease
-        disease_result = self.predict_disease(image_data)
+        edge_disease = edge_result.get("disease_probabilities")
+        embedding = None
+        if edge_disease is not None:
+            disease_result = self.disease_result(edge_disease)
+        else:
+            if include_embedding or (store and self.similarity_index is not None):
+                disease_result, embedding = self.predict_disease(image_data, tta_views, with_embedding=True,
+                                                                 with_cam=include_cam)
+            else:
+                disease_result = self.predict_disease(image_data, tta_views, with_cam=include_cam)
         disease_result["is_valid_tomato"] = True
         disease_result["tomato_confidence"] = confidence
+        disease_result["edge_inference"] = {
+            "leaf": "leaf_probabilities" in edge_result,
+            "disease": edge_disease is not None
+        }
+        
+        if embedding is not None:
+            if include_embedding:
+                disease_result["embedding"] = [float(v) for v in embedding]
+            if store and self.similarity_index is not None:
+                disease_result["analysis_id"] = self.index_analysis(embedding, disease_result)
         
         return disease_result
+    
+    def run_prefilter(self, img: Image.Image):
+        """Colour prefilter decision for a decoded image, or None when the prefilter is off"""
+        if self.prefilter is None:
+            return None
+        with timed("leaf_prefilter"):
+            return self.prefilter.check(img)
+    
+    def prefilter_reject_result(self, prefilter: dict) -> dict:
+        """Response for an image the colour prefilter rejected"""
+        return {
+            "error": "Not a tomato leaf image",
+            "detail": f"Only {prefilter['leaf_fraction']*100:.1f}% of the image is leaf-coloured",
+            "is_valid_tomato": False,
+            "prefilter": prefilter
+        }
+    
+    def not_tomato_result(self, leaf_class: str, confidence: float) -> dict:
+        """Response for an image the leaf model rejected"""
+        return {
+            "error": "Not a tomato leaf image",
+            "detail": f"Detected as '{leaf_class}' with {confidence*100:.2f}% confidence",
+            "is_valid_tomato": False
+        }
+    
+    def process_request_batch(self, images: list, include_cam: bool = False) -> list:
+        """process_request for several images with one leaf and one disease model call"""
+        with self.registry.pin() as versions:
+            results = self._process_request_batch(images, include_cam)
+        model_versions = {kind: version.version for kind, version in versions.items()}
+        for result in results:
+            result["model_versions"] = model_versions
+        return results
+    
+    def _process_request_batch(self, images: list, include_cam: bool = False) -> list:
+        """process_request_batch with model versions already pinned"""
+        results = [None] * len(images)
+        kept, arrays, audited = [], [], set()
+        for i, image_data in enumerate(images):
+            check_deadline("preprocess")
+            img = self.decode_image(image_data)
+            prefilter = self.run_prefilter(img)
+            if prefilter and prefilter["outcome"] == "reject":
+                if not prefilter["audit"]:
+                    results[i] = self.prefilter_reject_result(prefilter)
+                    continue
+                audited.add(i)
+            kept.append(i)
+            arrays.append(self.image_to_array(img))
+        if not kept:
+            return results
+        
+        batch = np.concatenate(arrays)
+        leaf_predictions = self.run_leaf_model(batch)
+        tomato_indices = []
+        for row, (i, predictions) in enumerate(zip(kept, leaf_predictions)):
+            leaf_class = self.leaf_class_names[np.argmax(predictions)]
+            confidence = float(np.max(predictions))
+            if i in audited:
+                self.prefilter.record_audit(leaf_class == 'tomato')
+            if leaf_class == 'tomato':
+                tomato_indices.append((i, row, confidence))
+            else:
+                results[i] = self.not_tomato_result(leaf_class, confidence)
+        
+        if tomato_indices:
+            tomato_batch = batch[[row for _, row, _ in tomato_indices]]
+            cams = None
+            if include_cam:
+                disease_predictions, cams, peaks = self.run_disease_cam(tomato_batch)
+            else:
+                _, disease_predictions = self.disease_probabilities(tomato_batch)
+            for j, ((i, _, confidence), probabilities) in enumerate(zip(tomato_indices, disease_predictions)):
+                result = self.disease_result(probabilities)
+                if cams is not None:
+                    result["cam"] = encode_cam(cams[j], peaks[j])
+                result["is_valid_tomato"] = True
+                result["tomato_confidence"] = confidence
+                result["edge_inference"] = {"leaf": False, "disease": False}
+                results[i] = result
+        return results
+    
+    def frame_hash(self, image_data: str) -> int:
+        """64-bit difference hash of a frame, from a reduced-scale decode"""
+        with timed("frame_hash"):
+            img = Image.open(io.BytesIO(base64.b64decode(image_data)))
+            # JPEG frames decode straight at 1/8 scale or smaller
+            img.draft('L', (64, 64))
+            pixels = np.asarray(img.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+            bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+            return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    
+    def index_analysis(self, embedding: np.ndarray, disease_result: dict) -> int:
+        """Add a prediction to the similar-case index and return its id"""
+        with timed("similarity_index_add"):
+            return self.similarity_index.add(embedding, {
+                "predicted_class": disease_result["predicted_class"],
+                "confidence": disease_result["confidence"],
+                "timestamp": time.time(),
+                "request_id": current_request_id(),
+                "model_version": self.registry.current("disease").version
+            })
+    
+    def find_similar(self, image_data: str = None, analysis_id: int = None, k: int = 5,
+                     nprobe: int = None, exact: bool = False) -> dict:
+        """k nearest stored analyses to a new image or to a stored analysis"""
+        query = {}
+        if analysis_id is not None:
+            vector = self.similarity_index.get_vector(analysis_id)
+            query = {"analysis_id": analysis_id, **self.similarity_index.get_metadata(analysis_id)}
+            # The query itself is always its own nearest neighbour
+            k += 1
+        else:
+            disease_result, embedding = self.predict_disease(image_data, with_embedding=True)
+            vector = self.similarity_index.project(embedding)[0]
+            query = {"predicted_class": disease_result["predicted_class"], "confidence": disease_result["confidence"]}
+        
+        with timed("similarity_search"):
+            neighbours = self.similarity_index.search(vector=vector, k=k, nprobe=nprobe, exact=exact)
+        if analysis_id is not None:
+            neighbours = [n for n in neighbours if n["id"] != analysis_id][:k - 1]
+        return {"query": query, "neighbours": neighbours, "index": self.similarity_index.stats()}
 
 # Initialize server with paths to both models
 server = LeafDetectionServer(
-    leaf_model_path="./leaf_detection_model_fine_tuned.h5",
-    disease_model_path="./plant_disease_model.h5"
+    leaf_model_path=os.environ.get("LEAF_MODEL_PATH", "./leaf_detection_model_fine_tuned.h5"),
+    disease_model_path=os.environ.get("DISEASE_MODEL_PATH", "./plant_disease_model.h5")
 )
+if SIMILARITY_INDEX_DIR:
+    server.enable_similarity_index(SIMILARITY_INDEX_DIR)
+if LEAF_PREFILTER:
+    server.prefilter = LeafPrefilter(LEAF_PREFILTER_REJECT_BELOW, LEAF_PREFILTER_BORDERLINE_BELOW, LEAF_PREFILTER_AUDIT_RATE)
+if CASCADE_MODEL_PATH:
+    server.enable_cascade(CASCADE_MODEL_PATH, CascadePolicy(CASCADE_MIN_CONFIDENCE, CASCADE_MIN_MARGIN, CASCADE_AUDIT_RATE))
+if MODEL_WATCH_INTERVAL > 0:
+    server.registry.watch(MODEL_WATCH_INTERVAL)
+
+# Published by /classes; compact responses carry only the version
+CLASSES = {"leaf": server.leaf_class_names, "disease": server.disease_class_names}
+CLASSES_VERSION = classes_version(CLASSES)
+
+@app.before_request
+def _reset_deadline():
+    # Worker threads can be reused across requests
+    set_deadline(None)
+
+def request_deadline(data: dict) -> Deadline:
+    """Deadline from the X-Request-Deadline-Ms header or a deadline_ms field, else the default
+
+    Raises ValueError when the request gives a deadline that is not a positive number.
+    """
+    deadline_ms = request.headers.get(DEADLINE_HEADER)
+    if deadline_ms is None:
+        deadline_ms = (data or {}).get('deadline_ms')
+    if deadline_ms is None:
+        deadline_ms = DEFAULT_DEADLINE_MS
+    elif isinstance(deadline_ms, (str, int, float)) and not isinstance(deadline_ms, bool):
+        try:
+            deadline_ms = float(deadline_ms)
+        except ValueError:
+            deadline_ms = math.nan
+        if not 0 < deadline_ms < math.inf:
+            raise ValueError(f"{DEADLINE_HEADER} or deadline_ms must be a positive number of milliseconds")
+    else:
+        raise ValueError(f"{DEADLINE_HEADER} or deadline_ms must be a positive number of milliseconds")
+    deadline = Deadline(float(deadline_ms) / 1000.0)
+    set_deadline(deadline)
+    return deadline
+
+def overloaded_response(error: Overloaded):
+    """503 with a Retry-After header"""
+    response = jsonify({"error": str(error), "reason": error.reason, "retry_after": error.retry_after})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
+def deadline_response(error: DeadlineExceeded):
+    """504 for a request whose deadline passed before a stage could start"""
+    return jsonify({"error": str(error), "stage": error.stage}), 504
+
+def prediction_response(result: dict, status: int = 200, compact_result: bool = False, top_k: int = 0):
+    """A prediction in the encoding the Accept header asks for, compacted if requested"""
+    media_type = negotiate(request.headers.get("Accept"))
+    if compact_result:
+        result = compact(result, CLASSES_VERSION, top_k, binary=media_type != JSON)
+    if media_type == JSON:
+        return jsonify(result), status
+    return Response(encode(result, media_type), status=status, mimetype=media_type)
 
 @app.route('/predict', methods=['POST'])
 def predict():
@@ -108,25 +686,298 @@ def predict():
         if 'image' not in data:
             return jsonify({"error": "No image data provided"}), 400
         
-        # Process the image through both models
-        result = server.process_request(data['image'])
+        # "tta": true uses the default number of views, an integer picks the count
+        tta = data.get('tta', 0)
+        if not isinstance(tta, (bool, int)) or tta < 0:
+            return jsonify({"error": "tta must be true, false or a number of views"}), 400
+        tta_views = DEFAULT_TTA_VIEWS if tta is True else int(tta)
+        
+        # "compact": true drops the class names, "top_k" keeps k probabilities
+        compact_result = data.get('compact', False)
+        if not isinstance(compact_result, bool):
+            return jsonify({"error": "compact must be true or false"}), 400
+        top_k = data.get('top_k', 0)
+        if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 0:
+            return jsonify({"error": "top_k must be a non-negative integer"}), 400
+        
+        try:
+            edge_result = server.parse_edge_result(data.get('edge'))
+        except ValueError as e:
+            return jsonify({"error": f"Invalid edge result: {e}"}), 400
+        
+        try:
+            deadline = request_deadline(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        # Process the image through both models, reusing any outputs computed on the edge
+        with admission.admit(deadline):
+            result = server.process_request(
+                data['image'], edge_result, tta_views,
+                store=data.get('store', True), include_embedding=bool(data.get('embedding', False)),
+                include_cam=bool(data.get('cam', False))
+            )
         
         # Return appropriate response
-        if result.get("is_valid_tomato", False):
-            return jsonify(result)
-        else:
-            return jsonify(result), 400
+        status = 200 if result.get("is_valid_tomato", False) else 400
+        return prediction_response(result, status, compact_result, top_k)
+    
+    except Overloaded as e:
+        return overloaded_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
+    except Exception as e:
+        import traceback
+        error_details = traceback.format_exc()
+        print(f"Error processing request {current_request_id()}: {error_details}")
+        return jsonify({"error": str(e), "details": error_details}), 500
+
+def stream_predictions(lines, batch_size: int, threshold: int, max_skipped: int, include_cam: bool = False):
+    """Turn an iterable of NDJSON frame lines into per-frame results, in arrival order
     
+    A frame whose dHash is within threshold bits of the last inferred frame
+    reuses that frame's result. Other frames are inferred in batches of
+    batch_size, or sooner on a {"flush": true} line or the end of the stream.
+    A batch the server is too busy for gets an error line per frame, and the
+    stream goes on with the next one.
+    """
+    pending = []      # (frame_id, image_data) waiting for the next batch
+    outbox = []       # results in arrival order; duplicates point at a pending frame
+    results = {}      # frame_id -> result of an inferred frame
+    stats = {"frames": 0, "inferred": 0, "duplicates": 0, "batches": 0, "overloaded": 0}
+    reference = None  # (frame_id, hash) of the last frame sent for inference
+    skipped = 0
+    
+    def flush():
+        nonlocal reference
+        if pending:
+            try:
+                with admission.admit():
+                    batch_results = server.process_request_batch([image for _, image in pending], include_cam)
+                stats["batches"] += 1
+                stats["inferred"] += len(pending)
+            except Overloaded as e:
+                error = {"error": str(e), "reason": e.reason, "retry_after": e.retry_after}
+                batch_results = [error] * len(pending)
+                stats["overloaded"] += len(pending)
+                # Later frames must not reuse a frame that was never inferred
+                if reference is not None and any(frame_id == reference[0] for frame_id, _ in pending):
+                    reference = None
+            for (frame_id, _), result in zip(pending, batch_results):
+                results[frame_id] = result
+            pending.clear()
+        for frame_id, source, distance in outbox:
+            if source is None:
+                yield {"frame_id": frame_id, **results[frame_id]}
+            else:
+                yield {"frame_id": frame_id, **results[source], "duplicate_of": source, "hash_distance": distance}
+        outbox.clear()
+        # Only the current reference can be reused by later frames
+        for frame_id in list(results):
+            if reference is None or frame_id != reference[0]:
+                del results[frame_id]
+    
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            message = json.loads(line)
+        except ValueError:
+            yield {"error": "Invalid JSON line"}
+            continue
+        if not isinstance(message, dict):
+            yield {"error": "Each line must be a JSON object"}
+            continue
+        if message.get("flush"):
+            yield from flush()
+            continue
+        if 'image' not in message:
+            yield {"error": "No image data provided", "frame_id": message.get("frame_id")}
+            continue
+        
+        frame_id = message.get("frame_id", stats["frames"])
+        stats["frames"] += 1
+        try:
+            frame_hash = server.frame_hash(message['image'])
+        except Exception as e:
+            yield {"error": f"Could not decode frame: {e}", "frame_id": frame_id}
+            continue
+        
+        distance = bin(frame_hash ^ reference[1]).count("1") if reference else None
+        if distance is not None and distance <= threshold and skipped < max_skipped:
+            skipped += 1
+            stats["duplicates"] += 1
+            outbox.append((frame_id, reference[0], distance))
+            if not pending:
+                yield from flush()
+            continue
+        
+        skipped = 0
+        reference = (frame_id, frame_hash)
+        pending.append((frame_id, message['image']))
+        outbox.append((frame_id, None, None))
+        if len(pending) >= batch_size:
+            yield from flush()
+    
+    yield from flush()
+    stats["skipped_fraction"] = stats["duplicates"] / stats["frames"] if stats["frames"] else 0.0
+    yield {"summary": stats}
+
+@app.route('/predict_stream', methods=['POST'])
+def predict_stream():
+    """Scan a stream of frames sent as NDJSON lines, answering with NDJSON results as batches complete"""
+    try:
+        batch_size = max(1, int(request.args.get('batch_size', STREAM_BATCH_SIZE)))
+        threshold = int(request.args.get('threshold', STREAM_HASH_THRESHOLD))
+        max_skipped = int(request.args.get('max_skipped', STREAM_MAX_SKIPPED))
+        top_k = int(request.args.get('top_k', 0))
+    except ValueError:
+        return jsonify({"error": "batch_size, threshold, max_skipped and top_k must be integers"}), 400
+    compact_results = request.args.get('compact', 'false').lower() in ('1', 'true')
+    include_cam = request.args.get('cam', 'false').lower() in ('1', 'true')
+    
+    def generate():
+        try:
+            for result in stream_predictions(request.stream, batch_size, threshold, max_skipped, include_cam):
+                if compact_results:
+                    result = compact(result, CLASSES_VERSION, top_k)
+                yield json.dumps(result) + "\n"
+        except Exception as e:
+            import traceback
+            print(f"Error processing stream {current_request_id()}: {traceback.format_exc()}")
+            yield json.dumps({"error": str(e)}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/similar', methods=['POST'])
+def similar():
+    """Find stored analyses that look like a new image or a stored analysis"""
+    if server.similarity_index is None:
+        return jsonify({"error": "Similarity index is not enabled (set SIMILARITY_INDEX_DIR)"}), 503
+    try:
+        data = request.get_json()
+        if 'image' not in data and 'analysis_id' not in data:
+            return jsonify({"error": "Provide image data or an analysis_id"}), 400
+        
+        k = min(max(int(data.get('k', 5)), 1), MAX_SIMILAR_RESULTS)
+        nprobe = int(data['nprobe']) if 'nprobe' in data else None
+        analysis_id = int(data['analysis_id']) if 'analysis_id' in data else None
+        try:
+            deadline = request_deadline(data) if analysis_id is None else None
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            if analysis_id is None:
+                # Image queries run disease_model, so they queue like /predict
+                with admission.admit(deadline):
+                    result = server.find_similar(data.get('image'), None, k, nprobe, bool(data.get('exact', False)))
+            else:
+                result = server.find_similar(None, analysis_id, k, nprobe, bool(data.get('exact', False)))
+        except KeyError:
+            return jsonify({"error": f"Unknown analysis_id {analysis_id}"}), 404
+        return jsonify(result)
+    
+    except Overloaded as e:
+        return overloaded_response(e)
+    except DeadlineExceeded as e:
+        return deadline_response(e)
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
-        print(f"Error processing request: {error_details}")
+        print(f"Error processing request {current_request_id()}: {error_details}")
         return jsonify({"error": str(e), "details": error_details}), 500
 
+def model_admin_error(kind: str):
+    """Error response unless the request may administer models of this kind"""
+    if not MODEL_ADMIN_TOKEN:
+        return jsonify({"error": "Model administration is disabled (set MODEL_ADMIN_TOKEN)"}), 403
+    if request.headers.get("X-Admin-Token") != MODEL_ADMIN_TOKEN:
+        return jsonify({"error": "Invalid or missing X-Admin-Token"}), 401
+    if kind not in server.registry.kinds():
+        return jsonify({"error": f"Unknown model kind '{kind}'"}), 404
+    return None
+
+@app.route('/models', methods=['GET'])
+def list_models():
+    """Active, candidate and previous model versions with per-version stats"""
+    return jsonify(server.registry.describe())
+
+@app.route('/models/<kind>/load', methods=['POST'])
+def load_model_version(kind):
+    """Load a model file in the background as the new active version or as a candidate"""
+    error = model_admin_error(kind)
+    if error:
+        return error
+    data = request.get_json() or {}
+    if 'path' not in data:
+        return jsonify({"error": "No model path provided"}), 400
+    if not os.path.exists(data['path']):
+        return jsonify({"error": f"Model file not found: {data['path']}"}), 400
+    try:
+        fraction = float(data['fraction']) if 'fraction' in data else None
+        job = server.registry.load_async(kind, data['path'], data.get('version'), bool(data.get('candidate', False)), fraction)
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 409
+    return jsonify(job), 202
+
+@app.route('/models/<kind>/promote', methods=['POST'])
+def promote_model_version(kind):
+    """Make the candidate version active"""
+    error = model_admin_error(kind)
+    if error:
+        return error
+    try:
+        return jsonify({"active": server.registry.promote(kind).version})
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 409
+
+@app.route('/models/<kind>/rollback', methods=['POST'])
+def rollback_model_version(kind):
+    """Swap the previously active version back in"""
+    error = model_admin_error(kind)
+    if error:
+        return error
+    try:
+        return jsonify({"active": server.registry.rollback(kind).version})
+    except KeyError as e:
+        return jsonify({"error": e.args[0]}), 409
+
+@app.route('/models/<kind>/candidate', methods=['POST', 'DELETE'])
+def update_candidate(kind):
+    """Change the candidate's traffic fraction, or remove the candidate"""
+    error = model_admin_error(kind)
+    if error:
+        return error
+    if request.method == 'DELETE':
+        try:
+            server.registry.remove_candidate(kind)
+        except KeyError as e:
+            return jsonify({"error": e.args[0]}), 409
+    else:
+        data = request.get_json() or {}
+        if 'fraction' not in data:
+            return jsonify({"error": "No fraction provided"}), 400
+        server.registry.set_candidate_fraction(kind, float(data['fraction']))
+    return jsonify(server.registry.describe()[kind])
+
+@app.route('/classes', methods=['GET'])
+def classes():
+    """Class name lists behind the classes_version of compact responses"""
+    if request.headers.get("If-None-Match", "").strip('"') == CLASSES_VERSION:
+        return "", 304
+    response = jsonify({"version": CLASSES_VERSION, **CLASSES})
+    response.headers["ETag"] = f'"{CLASSES_VERSION}"'
+    return response
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Simple health check endpoint"""
-    return jsonify({"status": "healthy"})
+    return jsonify({
+        "status": "healthy",
+        "admission": admission.stats(),
+        "cascade": server.cascade.stats() if server.cascade else None
+    })
 
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,321 @@
+"""Incremental approximate nearest-neighbour index over disease_model embeddings.
+
+Embeddings are reduced with a fixed random orthogonal projection (default
+1280 -> 128 dimensions), L2-normalized and appended as float16 rows to a
+memory-mapped file, so a million stored analyses take ~256 MB on disk and
+only the pages touched by a query are read.
+
+Search is IVF-flat over cosine similarity: once `train_size` vectors exist,
+spherical k-means centroids partition the vectors into inverted lists and a
+query only scans the `nprobe` lists closest to it. Below that size, and for
+exact comparisons, a brute-force scan is used. Centroids are trained on a
+background thread, first when `train_size` is reached and again whenever the
+index has grown by `retrain_factor` since the last training. Searches scan
+everything until the first training finishes.
+
+Files in the index directory:
+    vectors.f16      float16 (capacity, dim) memmap
+    assignments.i32  int32 list id per vector (-1 until trained)
+    projection.npy   (input_dim, dim) projection matrix
+    centroids.npy    (n_lists, dim) float32 centroids, once trained
+    meta.jsonl       one JSON metadata record per vector; its line count is the index size
+"""
+import json
+import os
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+class SimilarityIndex:
+    """IVF-flat index of float16, memory-mapped embedding vectors"""
+
+    def __init__(self, directory: str, input_dim: int, dim: int = 128, nprobe: int = 8,
+                 train_size: int = 10000, retrain_factor: float = 4.0, seed: int = 0):
+        self.directory = directory
+        self.input_dim = input_dim
+        self.dim = min(dim, input_dim)
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.retrain_factor = retrain_factor
+        self._lock = threading.RLock()
+        self._training = False
+        os.makedirs(directory, exist_ok=True)
+
+        self.projection = self._load_projection(seed)
+        self.count, self._meta_offsets = self._load_metadata()
+        self.capacity = 0
+        self.vectors = None
+        self.assignments = None
+        self._ensure_capacity(max(self.count, 1024))
+
+        self.centroids = None
+        self.trained_count = 0
+        self._lists: List[np.ndarray] = []
+        self._list_sizes = np.zeros(0, dtype=np.int64)
+        centroids_path = os.path.join(directory, "centroids.npy")
+        if os.path.exists(centroids_path):
+            self.centroids = np.load(centroids_path)
+            self.trained_count = self.count
+            self._rebuild_lists()
+
+    # Storage
+
+    def _load_projection(self, seed: int) -> np.ndarray:
+        """Load or create the fixed projection from model space to index space"""
+        path = os.path.join(self.directory, "projection.npy")
+        if os.path.exists(path):
+            projection = np.load(path)
+            if projection.shape != (self.input_dim, self.dim):
+                raise ValueError(f"Index at {self.directory} was built for {projection.shape}, not {(self.input_dim, self.dim)}")
+            return projection
+        rng = np.random.default_rng(seed)
+        # Orthonormal columns preserve angles well in expectation (Johnson-Lindenstrauss)
+        q, _ = np.linalg.qr(rng.standard_normal((self.input_dim, self.dim)))
+        projection = q.astype(np.float32)
+        np.save(path, projection)
+        return projection
+
+    def _load_metadata(self) -> Tuple[int, array]:
+        """Count committed records and remember where each metadata line starts"""
+        path = os.path.join(self.directory, "meta.jsonl")
+        offsets = array("q")
+        if os.path.exists(path):
+            position = 0
+            with open(path, "rb+") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    offsets.append(position)
+                    position += len(line)
+                # Drop a partial line left by a crash mid-write
+                f.truncate(position)
+        return len(offsets), offsets
+
+    def _open_memmap(self, name: str, dtype, shape) -> np.memmap:
+        """Open (creating or growing) a raw memmap file"""
+        path = os.path.join(self.directory, name)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    def _ensure_capacity(self, needed: int) -> None:
+        """Grow the memmaps geometrically so appends stay amortized O(1)"""
+        if needed <= self.capacity:
+            return
+        capacity = max(needed, self.capacity * 2, 1024)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.assignments.flush()
+        old_capacity = self.capacity
+        self.vectors = self._open_memmap("vectors.f16", np.float16, (capacity, self.dim))
+        self.assignments = self._open_memmap("assignments.i32", np.int32, (capacity,))
+        self.assignments[max(old_capacity, self.count):] = -1
+        self.capacity = capacity
+
+    def project(self, embedding: np.ndarray) -> np.ndarray:
+        """Map model embeddings (n, input_dim) to normalized index vectors (n, dim)"""
+        projected = np.atleast_2d(np.asarray(embedding, dtype=np.float32)) @ self.projection
+        norms = np.linalg.norm(projected, axis=1, keepdims=True)
+        return projected / np.maximum(norms, 1e-12)
+
+    # Inverted lists
+
+    def _rebuild_lists(self) -> None:
+        """Rebuild the in-memory inverted lists from the assignments file"""
+        assignments = np.asarray(self.assignments[:self.count])
+        order = np.argsort(assignments, kind="stable").astype(np.int32)
+        bounds = np.searchsorted(assignments[order], np.arange(len(self.centroids) + 1))
+        self._lists = [order[bounds[i]:bounds[i + 1]].copy() for i in range(len(self.centroids))]
+        self._list_sizes = np.array([len(ids) for ids in self._lists], dtype=np.int64)
+
+    def _append_to_list(self, list_id: int, vector_id: int) -> None:
+        """Append to an inverted list, doubling its backing array when full"""
+        ids = self._lists[list_id]
+        size = self._list_sizes[list_id]
+        if size == len(ids):
+            grown = np.empty(max(16, 2 * len(ids)), dtype=np.int32)
+            grown[:size] = ids[:size]
+            ids = self._lists[list_id] = grown
+        ids[size] = vector_id
+        self._list_sizes[list_id] = size + 1
+
+    def _assign(self, vectors: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+        """Nearest centroid by inner product for each row, in chunks"""
+        result = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), chunk):
+            block = np.asarray(vectors[start:start + chunk], dtype=np.float32)
+            result[start:start + chunk] = np.argmax(block @ centroids.T, axis=1)
+        return result
+
+    def _train_centroids(self, n: int, iterations: int = 10, sample_size: int = 65536, seed: int = 0) -> np.ndarray:
+        """Spherical k-means on a sample of the first n vectors"""
+        n_lists = int(np.clip(4 * np.sqrt(n), 16, 4096))
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(n, size=min(n, sample_size), replace=False))
+        sample = np.asarray(self.vectors[sample_ids], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=min(n_lists, len(sample)), replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = self._assign(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = np.bincount(labels, minlength=len(centroids)) == 0
+            # Re-seed empty clusters from random samples
+            sums[empty] = sample[rng.choice(len(sample), size=int(empty.sum()))]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        return centroids.astype(np.float32)
+
+    def train(self) -> None:
+        """(Re)train centroids over the current vectors and reassign everything"""
+        with self._lock:
+            n = self.count
+        if n == 0:
+            return
+        centroids = self._train_centroids(n)
+        assignments = self._assign(self.vectors[:n], centroids)
+
+        with self._lock:
+            # Vectors added while training are assigned with the new centroids
+            if self.count > n:
+                assignments = np.concatenate([assignments, self._assign(self.vectors[n:self.count], centroids)])
+            self.assignments[:self.count] = assignments
+            self.assignments.flush()
+            self.centroids = centroids
+            np.save(os.path.join(self.directory, "centroids.npy"), centroids)
+            self.trained_count = self.count
+            self._rebuild_lists()
+
+    def _maybe_train(self) -> None:
+        """Train in the background once train_size is reached, and again as the index grows"""
+        with self._lock:
+            if self._training:
+                return
+            first = self.centroids is None and self.count >= self.train_size
+            grown = self.centroids is not None and self.count >= self.trained_count * self.retrain_factor
+            if not (first or grown):
+                return
+            self._training = True
+
+        def run_training():
+            try:
+                self.train()
+            finally:
+                self._training = False
+
+        # Searches keep using the old lists, or the exact scan, until the new ones are swapped in
+        threading.Thread(target=run_training, name="similarity-train", daemon=True).start()
+
+    # Public API
+
+    def add(self, embedding: np.ndarray, metadata: Optional[Dict] = None) -> int:
+        """Add one model embedding with its metadata and return its id"""
+        return self.add_batch(np.atleast_2d(embedding), [metadata or {}])[0]
+
+    def add_batch(self, embeddings: np.ndarray, metadata: Optional[List[Dict]] = None) -> List[int]:
+        """Add a batch of model embeddings (n, input_dim) and return their ids"""
+        vectors = self.project(embeddings)
+        metadata = metadata or [{} for _ in range(len(vectors))]
+        if len(metadata) != len(vectors):
+            raise ValueError(f"Got {len(metadata)} metadata records for {len(vectors)} embeddings")
+
+        with self._lock:
+            start = self.count
+            ids = list(range(start, start + len(vectors)))
+            self._ensure_capacity(start + len(vectors))
+            self.vectors[start:start + len(vectors)] = vectors.astype(np.float16)
+            if self.centroids is not None:
+                list_ids = self._assign(vectors, self.centroids)
+                self.assignments[start:start + len(vectors)] = list_ids
+                for list_id, vector_id in zip(list_ids, ids):
+                    self._append_to_list(int(list_id), vector_id)
+
+            # Writing the metadata lines commits the records
+            lines = [(json.dumps(dict(record, id=vector_id)) + "\n").encode("utf-8")
+                     for record, vector_id in zip(metadata, ids)]
+            with open(os.path.join(self.directory, "meta.jsonl"), "ab") as f:
+                position = f.tell()
+                for line in lines:
+                    self._meta_offsets.append(position)
+                    position += len(line)
+                f.write(b"".join(lines))
+            self.count += len(vectors)
+        self._maybe_train()
+        return ids
+
+    def get_vector(self, vector_id: int) -> np.ndarray:
+        """Stored index-space vector for an id"""
+        if not 0 <= vector_id < self.count:
+            raise KeyError(vector_id)
+        return np.asarray(self.vectors[vector_id], dtype=np.float32)
+
+    def get_metadata(self, vector_id: int) -> Dict:
+        """Metadata record for an id"""
+        if not 0 <= vector_id < self.count:
+            raise KeyError(vector_id)
+        with open(os.path.join(self.directory, "meta.jsonl"), "rb") as f:
+            f.seek(self._meta_offsets[vector_id])
+            return json.loads(f.readline())
+
+    def search(self, embedding: Optional[np.ndarray] = None, k: int = 5, vector: Optional[np.ndarray] = None,
+               nprobe: Optional[int] = None, exact: bool = False) -> List[Dict]:
+        """Return the k most similar stored analyses, best first
+
+        Pass a model-space `embedding`, or an index-space `vector` (e.g. from
+        get_vector) to query with a stored analysis.
+        """
+        query = self.project(embedding)[0] if vector is None else np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            count = self.count
+            if count == 0:
+                return []
+            if exact or self.centroids is None:
+                candidates = None
+            else:
+                probe = min(nprobe or self.nprobe, len(self.centroids))
+                closest_lists = np.argpartition(-(self.centroids @ query), probe - 1)[:probe]
+                candidates = np.concatenate([self._lists[i][:self._list_sizes[i]] for i in closest_lists])
+
+        if candidates is None:
+            scores = np.empty(count, dtype=np.float32)
+            for start in range(0, count, 65536):
+                block = np.asarray(self.vectors[start:min(start + 65536, count)], dtype=np.float32)
+                scores[start:start + len(block)] = block @ query
+            candidates = np.arange(count)
+        else:
+            if len(candidates) == 0:
+                return []
+            # Sorted ids turn the gather into mostly sequential page reads
+            candidates.sort()
+            scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query
+
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {"id": int(candidates[i]), "score": float(scores[i]), "metadata": self.get_metadata(int(candidates[i]))}
+            for i in top
+        ]
+
+    def stats(self) -> Dict:
+        """Size and training state of the index"""
+        with self._lock:
+            return {
+                "count": self.count,
+                "dim": self.dim,
+                "lists": 0 if self.centroids is None else len(self.centroids),
+                "trained_count": self.trained_count,
+                "training": self._training,
+                "nprobe": self.nprobe,
+                "disk_bytes": self.capacity * self.dim * 2
+            }
+
+    def flush(self) -> None:
+        """Flush memmapped data to disk"""
+        with self._lock:
+            self.vectors.flush()
+            self.assignments.flush()
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Plant Monitoring System - Edge Inference
+Runs quantized TFLite versions of the leaf (and optionally disease) model on
+the Raspberry Pi against camera frames. Frames that the leaf gate rejects are
+dropped on the device; frames that pass are uploaded to the central model
+server together with the on-device model outputs.
+
+Commands:
+- convert:   quantize a Keras .h5 model to .tflite (run on a workstation)
+- run:       capture frames, gate them and upload the ones that pass
+- benchmark: time the gate on synthetic frames (works on x86 with the same runtime)
+
+Environment variables are loaded from a .env file
+"""
+
+import argparse
+import base64
+import io
+import json
+import logging
+import os
+import time
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import requests
+from dotenv import load_dotenv
+from PIL import Image
+
+# Prefer the small tflite-runtime wheel on the Pi, fall back to full TensorFlow
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    try:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    except ImportError:
+        Interpreter = None
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("edge_inference")
+
+# Must match LeafDetectionServer in models/server.py
+INPUT_SIZE = (224, 224)
+LEAF_CLASS_NAMES = ['Non-tomato', 'tomato']
+
+
+def convert_to_tflite(model_path: str, output_path: str, quantization: str = "dynamic",
+                      calibration_dir: Optional[str] = None, calibration_samples: int = 100) -> str:
+    """Convert a Keras .h5 model to a quantized TFLite flatbuffer
+
+    quantization is one of 'none', 'dynamic' (int8 weights), 'float16' or
+    'int8' (full integer, needs calibration_dir with representative images).
+    """
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(model_path)
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+
+    if quantization == "dynamic":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        if not calibration_dir:
+            raise ValueError("int8 quantization requires a calibration image directory")
+        paths = list(_iter_image_paths(calibration_dir))[:calibration_samples]
+        if not paths:
+            raise ValueError(f"No calibration images found in {calibration_dir}")
+
+        def representative_dataset():
+            for path in paths:
+                frame = np.asarray(Image.open(path).convert('RGB'))
+                yield [preprocess_frame(frame).astype(np.float32)]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.uint8
+    elif quantization != "none":
+        raise ValueError(f"Unknown quantization mode: {quantization}")
+
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    logger.info(f"Wrote {quantization} TFLite model to {output_path} ({len(tflite_model) / 1e6:.1f} MB)")
+    return output_path
+
+
+def _iter_image_paths(directory: str) -> Iterator[str]:
+    """Yield image file paths below a directory"""
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                yield os.path.join(root, name)
+
+
+def preprocess_frame(frame: np.ndarray) -> np.ndarray:
+    """Resize an RGB uint8 frame the same way as the model server, batch of one in [0, 1]"""
+    img = Image.fromarray(frame).resize(INPUT_SIZE)
+    return np.expand_dims(np.asarray(img, dtype=np.float32), axis=0) / 255.0
+
+
+class TFLiteClassifier:
+    """Thin wrapper around a TFLite interpreter for a single image classifier"""
+
+    def __init__(self, model_path: str, num_threads: int = 4):
+        """Load the model and allocate tensors"""
+        if Interpreter is None:
+            raise ImportError("Install tflite-runtime or tensorflow to run edge inference")
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_details = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()[0]
+
+    def predict(self, batch: np.ndarray) -> np.ndarray:
+        """Run one preprocessed float batch of one through the model and return the output row"""
+        input_dtype = self.input_details['dtype']
+        if input_dtype != np.float32:
+            # Full-integer models expect quantized input
+            scale, zero_point = self.input_details['quantization']
+            batch = np.clip(np.round(batch / scale + zero_point), 0, 255).astype(input_dtype)
+
+        self.interpreter.set_tensor(self.input_details['index'], batch)
+        self.interpreter.invoke()
+        output = self.interpreter.get_tensor(self.output_details['index'])[0]
+
+        if self.output_details['dtype'] != np.float32:
+            scale, zero_point = self.output_details['quantization']
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output
+
+
+class EdgeLeafGate:
+    """On-device leaf gate with optional local disease classification"""
+
+    def __init__(self, config: Dict):
+        """Load the quantized models named in the configuration"""
+        self.config = config
+        self.leaf_model = TFLiteClassifier(config["leaf_model"], config["num_threads"])
+        self.disease_model = None
+        if config.get("disease_model"):
+            self.disease_model = TFLiteClassifier(config["disease_model"], config["num_threads"])
+
+        self.frames_seen = 0
+        self.frames_dropped = 0
+
+    def process_frame(self, frame: np.ndarray) -> Optional[Dict]:
+        """Return the model outputs for a frame, or None if the gate drops it"""
+        self.frames_seen += 1
+        batch = preprocess_frame(frame)
+
+        leaf_probabilities = self.leaf_model.predict(batch)
+        tomato_confidence = float(leaf_probabilities[LEAF_CLASS_NAMES.index('tomato')])
+        if tomato_confidence < self.config["leaf_threshold"]:
+            self.frames_dropped += 1
+            return None
+
+        result = {"leaf_probabilities": [float(p) for p in leaf_probabilities]}
+        if self.disease_model is not None:
+            result["disease_probabilities"] = [float(p) for p in self.disease_model.predict(batch)]
+        return result
+
+
+def encode_frame(frame: np.ndarray, quality: int = 90) -> str:
+    """JPEG-encode an RGB frame as base64 for the /predict endpoint"""
+    buffer = io.BytesIO()
+    Image.fromarray(frame).save(buffer, format='JPEG', quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+def upload_frame(server_url: str, frame: np.ndarray, edge_result: Dict, timeout: float) -> Optional[Dict]:
+    """Send a gated frame and its on-device outputs to the central model server"""
+    try:
+        response = requests.post(
+            f"{server_url}/predict",
+            json={"image": encode_frame(frame), "edge": edge_result},
+            timeout=timeout
+        )
+        return response.json()
+    except Exception as e:
+        logger.error(f"Failed to upload frame: {e}")
+        return None
+
+
+def iter_camera_frames(camera_index: int = 0) -> Iterator[np.ndarray]:
+    """Yield RGB frames from the Pi camera, or from a V4L2/USB camera via OpenCV"""
+    try:
+        from picamera2 import Picamera2
+    except ImportError:
+        Picamera2 = None
+
+    if Picamera2 is not None:
+        camera = Picamera2()
+        camera.configure(camera.create_still_configuration(main={"format": "RGB888"}))
+        camera.start()
+        try:
+            while True:
+                yield camera.capture_array()
+        finally:
+            camera.stop()
+    else:
+        import cv2
+        capture = cv2.VideoCapture(camera_index)
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    logger.warning("Failed to read frame from camera")
+                    time.sleep(1)
+                    continue
+                yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        finally:
+            capture.release()
+
+
+def run(config: Dict) -> None:
+    """Capture, gate and upload frames until interrupted"""
+    gate = EdgeLeafGate(config)
+    logger.info(f"Edge gate running, uploading to {config['server_url']}")
+
+    try:
+        for frame in iter_camera_frames(config["camera_index"]):
+            edge_result = gate.process_frame(frame)
+            if edge_result is None:
+                logger.debug("Frame dropped by leaf gate")
+            else:
+                result = upload_frame(config["server_url"], frame, edge_result, config["upload_timeout"])
+                if result:
+                    logger.info(f"Server result: {result.get('predicted_class', result.get('error'))}")
+            time.sleep(config["capture_interval"])
+    except KeyboardInterrupt:
+        logger.info("Edge inference stopped by user")
+    finally:
+        logger.info(f"Frames seen: {gate.frames_seen}, dropped on device: {gate.frames_dropped}")
+
+
+def benchmark(config: Dict, iterations: int, resolution: List[int]) -> Dict:
+    """Time the gate on synthetic frames and return latency percentiles in milliseconds"""
+    gate = EdgeLeafGate(config)
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, size=(resolution[1], resolution[0], 3), dtype=np.uint8)
+
+    # Warm up the interpreter before timing
+    for _ in range(3):
+        gate.process_frame(frame)
+
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        gate.process_frame(frame)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    latencies = np.array(latencies)
+    results = {
+        "iterations": iterations,
+        "resolution": resolution,
+        "disease_model": bool(config.get("disease_model")),
+        "mean_ms": round(float(latencies.mean()), 2),
+        "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "fps": round(1000.0 / float(latencies.mean()), 1)
+    }
+    logger.info(f"Edge gate benchmark: {json.dumps(results)}")
+    return results
+
+
+def load_config_from_env() -> Dict:
+    """Load edge inference configuration from environment variables"""
+    return {
+        "server_url": os.getenv("EDGE_SERVER_URL", "http://localhost:5000"),
+        "leaf_model": os.getenv("EDGE_LEAF_MODEL", "leaf_model.tflite"),
+        "disease_model": os.getenv("EDGE_DISEASE_MODEL") or None,
+        "leaf_threshold": float(os.getenv("EDGE_LEAF_THRESHOLD", 0.5)),
+        "num_threads": int(os.getenv("EDGE_NUM_THREADS", 4)),
+        "camera_index": int(os.getenv("EDGE_CAMERA_INDEX", 0)),
+        "capture_interval": float(os.getenv("EDGE_CAPTURE_INTERVAL", 5)),
+        "upload_timeout": float(os.getenv("EDGE_UPLOAD_TIMEOUT", 30))
+    }
+
+
+def main():
+    """Main function for the edge inference commands"""
+    parser = argparse.ArgumentParser(description='Plant Monitoring System - Edge Inference')
+    parser.add_argument('-e', '--env', type=str, default='.env', help='Path to .env file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help='Quantize a Keras model to TFLite')
+    convert_parser.add_argument('--model', required=True, help='Path to the Keras .h5 model')
+    convert_parser.add_argument('--output', required=True, help='Path of the .tflite file to write')
+    convert_parser.add_argument('--quantization', choices=['none', 'dynamic', 'float16', 'int8'], default='dynamic')
+    convert_parser.add_argument('--calibration-dir', help='Representative images for int8 quantization')
+
+    subparsers.add_parser('run', help='Capture, gate and upload camera frames')
+
+    benchmark_parser = subparsers.add_parser('benchmark', help='Time the gate on synthetic frames')
+    benchmark_parser.add_argument('--iterations', type=int, default=100)
+    benchmark_parser.add_argument('--resolution', type=int, nargs=2, default=[1280, 720], metavar=('WIDTH', 'HEIGHT'))
+    benchmark_parser.add_argument('--output', help='Optional path to write the results as JSON')
+
+    args = parser.parse_args()
+
+    if os.path.exists(args.env):
+        load_dotenv(args.env)
+    config = load_config_from_env()
+
+    try:
+        if args.command == 'convert':
+            convert_to_tflite(args.model, args.output, args.quantization, args.calibration_dir)
+        elif args.command == 'run':
+            run(config)
+        elif args.command == 'benchmark':
+            results = benchmark(config, args.iterations, args.resolution)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    json.dump(results, f, indent=2)
+    except Exception as e:
+        logger.critical(f"Unhandled exception in edge inference: {e}", exc_info=True)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,9 +1,60 @@
+// Samples every soil moisture probe at a fixed rate and sends each reading as
+// an 8-byte binary frame (decoded by soil_serial.py on the Pi):
+//   0xA5 0x5A | channel | sequence (uint16 LE) | reading (uint16 LE) | CRC-8 of bytes 2-6
+// Sequence numbers count per channel, so the Pi can tell how many frames were lost.
+// setup() first sends a boot frame on channel 0xFF, so the Pi can tell a reset from lost frames.
+
+const uint8_t PROBE_PINS[] = {A0};              // One entry per probe; the index is the channel
+const uint8_t NUM_PROBES = sizeof(PROBE_PINS);
+const uint8_t BOOT_CHANNEL = 0xFF;              // Reading is NUM_PROBES, sequence is always 0
+const unsigned long SAMPLE_PERIOD_US = 2000;    // 500 readings per second per probe
+// 8 bytes x 500 Hz = 4 KB/s per probe; 115200 baud carries about 11.5 KB/s
+
+uint16_t sequence[NUM_PROBES];
+unsigned long nextSample;
+
+uint8_t crc8(const uint8_t *data, uint8_t length) {
+  uint8_t crc = 0;
+  for (uint8_t i = 0; i < length; i++) {
+    crc ^= data[i];
+    for (uint8_t bit = 0; bit < 8; bit++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : crc << 1;
+    }
+  }
+  return crc;
+}
+
+void writeFrame(uint8_t channel, uint16_t seq, uint16_t reading) {
+  uint8_t frame[8];
+  frame[0] = 0xA5;
+  frame[1] = 0x5A;
+  frame[2] = channel;
+  frame[3] = seq & 0xFF;
+  frame[4] = seq >> 8;
+  frame[5] = reading & 0xFF;
+  frame[6] = reading >> 8;
+  frame[7] = crc8(frame + 2, 5);
+  Serial.write(frame, sizeof(frame));
+}
+
+void sendFrame(uint8_t channel, uint16_t reading) {
+  writeFrame(channel, sequence[channel], reading);
+  sequence[channel]++;
+}
+
 void setup() {
-  Serial.begin(9600);
+  Serial.begin(115200);
+  writeFrame(BOOT_CHANNEL, 0, NUM_PROBES);
+  nextSample = micros();
 }
 
 void loop() {
-  int moisture = analogRead(A0);  // Read analog value from sensor
-  Serial.println(moisture);       // Send to Serial
-  delay(2000);                    // Delay between readings
-}
\ No newline at end of file
+  // Fixed schedule rather than delay(), so the rate does not drift with the time spent sending
+  if ((long)(micros() - nextSample) < 0) {
+    return;
+  }
+  nextSample += SAMPLE_PERIOD_US;
+  for (uint8_t channel = 0; channel < NUM_PROBES; channel++) {
+    sendFrame(channel, analogRead(PROBE_PINS[channel]));
+  }
+}
@@ -7,7 +7,7 @@ and publishes them to an MQTT broker.
 Sensors:
 - DHT11 (temperature & humidity) on GPIO4
 - BH1750 (light intensity) on I2C
-- Soil moisture sensor connected via Arduino
+- Soil moisture probes connected via Arduino (binary frames, see soil_serial.py)
 
 Environment variables are loaded from a .env file
 """
@@ -22,9 +22,15 @@ import serial
 import logging
 import os
 import argparse
-from typing import Dict, Union, Optional, Tuple
+import socket
+import threading
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Union, Optional, Tuple
 from dotenv import load_dotenv
 
+from soil_serial import SerialFrameReader
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -39,6 +45,58 @@ ERROR_HUMIDITY = -999.9
 ERROR_LIGHT = -999.9
 ERROR_SOIL = -999.9
 
+# Snapshot keys and their error values, in publish order
+SENSOR_ERROR_VALUES = {
+    "temperature": ERROR_TEMP,
+    "humidity": ERROR_HUMIDITY,
+    "light_intensity": ERROR_LIGHT,
+    "soil_moisture": ERROR_SOIL
+}
+
+
+class SensorStats:
+    """Read latency and error-rate bookkeeping for a single sensor"""
+
+    def __init__(self, name: str, window: int = 100):
+        """Keep the last `window` read latencies for the given sensor"""
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.reads = 0
+        self.errors = 0
+        self.last_success = None
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, success: bool) -> None:
+        """Record the outcome of one read"""
+        with self._lock:
+            self.reads += 1
+            self.latencies.append(latency)
+            if success:
+                self.last_success = time.time()
+            else:
+                self.errors += 1
+
+    def summary(self) -> Dict[str, float]:
+        """Return read count, error rate and latency figures in milliseconds"""
+        with self._lock:
+            latencies = sorted(self.latencies)
+            reads, errors, last_success = self.reads, self.errors, self.last_success
+
+        summary = {
+            "reads": reads,
+            "errors": errors,
+            "error_rate": round(errors / reads, 3) if reads else 0.0,
+            "latency_avg_ms": None,
+            "latency_p95_ms": None,
+            "latency_max_ms": None,
+            "seconds_since_success": round(time.time() - last_success, 1) if last_success else None
+        }
+        if latencies:
+            summary["latency_avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 2)
+            summary["latency_p95_ms"] = round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 2)
+            summary["latency_max_ms"] = round(latencies[-1] * 1000, 2)
+        return summary
+
 
 class SensorSystem:
     """Main class for handling sensor readings and MQTT communications"""
@@ -46,14 +104,33 @@ class SensorSystem:
     def __init__(self, config: Dict):
         """Initialize the sensor system with the given configuration"""
         self.config = config
+        self.running = False
+
+        # Scheduler state: latest good value per key, guarded by a lock so that
+        # a slow sensor thread never blocks the publisher or the other sensors
+        self._stop_event = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._snapshot_lock = threading.Lock()
+        self._latest: Dict[str, Tuple[float, float]] = {}
+        self._soil_lock = threading.Lock()
+        self._soil_samples: List[int] = []
+        # Binary protocol: the frame reader owns the port; per-probe read positions in its ring
+        self.soil_reader: Optional[SerialFrameReader] = None
+        self._soil_cursors: Dict[int, int] = {}
+        names = ("dht11", "bh1750", "soil")
+        if self.config["arduino"].get("protocol") == "ascii":
+            names += ("serial",)
+        self.stats = {name: SensorStats(name) for name in names}
+
         self._setup_mqtt()
         self._setup_sensors()
-        self.running = False
 
     def _setup_mqtt(self) -> None:
         """Set up the MQTT client connection"""
         mqtt_config = self.config["mqtt"]
         self.mqtt_client = mqtt.Client()
+        self.mqtt_client.on_connect = self._on_mqtt_connect
+        self.mqtt_client.on_message = self._on_mqtt_message
         try:
             self.mqtt_client.connect(
                 mqtt_config["broker"],
@@ -66,6 +143,32 @@ class SensorSystem:
             logger.error(f"Failed to connect to MQTT broker: {e}")
             # Continue without MQTT - data will still be displayed locally
 
+    def _on_mqtt_connect(self, client, userdata, flags, rc) -> None:
+        """Subscribe to on-demand snapshot requests and announce this Pi once connected"""
+        client.subscribe(self.config["mqtt"].get("request_topic", "sensor/request"))
+        self._announce(client)
+
+    def _announce(self, client) -> None:
+        """Publish a retained discovery record for tomatoApp/ok.py; its timestamp tells a live Pi from a stale record"""
+        announce_topic = self.config["mqtt"].get("announce_topic")
+        if not announce_topic:
+            return
+        try:
+            hostname = socket.gethostname()
+            mac = ":".join(f"{(uuid.getnode() >> shift) & 0xff:02x}" for shift in range(40, -8, -8))
+            # The local address of the broker connection is the one other devices can reach
+            ip = client.socket().getsockname()[0]
+            payload = json.dumps({"ip": ip, "hostname": hostname, "mac": mac, "timestamp": time.time()})
+            client.publish(f"{announce_topic}/{hostname}", payload, retain=True)
+            logger.info(f"Announced {hostname} at {ip} on {announce_topic}")
+        except Exception as e:
+            logger.warning(f"Failed to publish discovery announcement: {e}")
+
+    def _on_mqtt_message(self, client, userdata, message) -> None:
+        """Answer a snapshot request immediately from the latest readings"""
+        if self.running:
+            self.publish_data(self.get_snapshot())
+
     def _setup_sensors(self) -> None:
         """Set up connections to all sensors"""
         # DHT11 Setup (GPIO4)
@@ -95,6 +198,8 @@ class SensorSystem:
             )
             time.sleep(2)  # Give Arduino time to reset
             logger.info(f"Connected to Arduino on {arduino_config['port']}")
+            if arduino_config.get("protocol", "binary") == "binary":
+                self.soil_reader = SerialFrameReader(self.arduino, capacity=arduino_config.get("buffer_size", 4096))
         except serial.SerialException as e:
             logger.error(f"Arduino connection error: {e}")
             self.arduino = None
@@ -128,36 +233,87 @@ class SensorSystem:
             logger.warning(f"Error reading BH1750: {e}")
             return ERROR_LIGHT
 
+    def _raw_to_moisture_percent(self, raw_value: float) -> float:
+        """Convert a raw Arduino reading to 0-100% where 100% is wettest"""
+        soil_config = self.config["sensors"]["soil_moisture"]
+        min_value = soil_config["min_value"]
+        max_value = soil_config["max_value"]
+
+        if raw_value <= min_value:
+            return 100.0
+        elif raw_value >= max_value:
+            return 0.0
+        else:
+            moisture_percent = (max_value - raw_value) / (max_value - min_value) * 100.0
+            return round(moisture_percent, 1)
+
+    def _read_serial_line(self) -> Optional[int]:
+        """Read and parse a single line from the Arduino, None on timeout or bad data"""
+        start = time.perf_counter()
+        try:
+            line = self.arduino.readline().decode('utf-8').strip()
+        except Exception as e:
+            self.stats["serial"].record(time.perf_counter() - start, False)
+            logger.warning(f"Error reading Arduino: {e}")
+            return None
+
+        if not line:
+            return None
+        try:
+            raw_value = int(line)
+        except ValueError:
+            self.stats["serial"].record(time.perf_counter() - start, False)
+            logger.debug(f"Discarding malformed Arduino line: {line!r}")
+            return None
+
+        self.stats["serial"].record(time.perf_counter() - start, True)
+        return raw_value
+
     def read_soil_moisture(self) -> float:
-        """Read soil moisture from Arduino-connected sensor"""
+        """Read soil moisture from Arduino-connected sensor
+
+        With the binary protocol, the frame reader thread fills a ring buffer
+        per probe; this averages each probe's readings since the previous
+        call and returns the mean over the probes. With the ASCII protocol,
+        while the scheduler is running the serial port is drained by a
+        background thread and this returns the average of everything received
+        since the previous call. Otherwise every line already queued in the
+        serial buffer is read and averaged.
+        """
         if self.arduino is None or not self.arduino.is_open:
             return ERROR_SOIL
+        if self.soil_reader is not None:
+            return self._read_soil_frames()
 
-        if self.arduino.in_waiting:
+        if self._drain_thread_alive():
+            with self._soil_lock:
+                samples, self._soil_samples = self._soil_samples, []
+        else:
+            samples = []
             try:
-                line = self.arduino.readline().decode('utf-8').strip()
-                raw_value = int(line)
-                
-                # Convert to percentage using configured min/max values
-                soil_config = self.config["sensors"]["soil_moisture"]
-                min_value = soil_config["min_value"]
-                max_value = soil_config["max_value"]
-                
-                # Convert to 0-100% where 100% is wettest and 0% is driest
-                if raw_value <= min_value:
-                    return 100.0
-                elif raw_value >= max_value:
-                    return 0.0
-                else:
-                    moisture_percent = (max_value - raw_value) / (max_value - min_value) * 100.0
-                    return round(moisture_percent, 1)
-                    
+                while self.arduino.in_waiting:
+                    raw_value = self._read_serial_line()
+                    if raw_value is not None:
+                        samples.append(raw_value)
             except Exception as e:
                 logger.warning(f"Error reading Arduino: {e}")
-                return ERROR_SOIL
 
         # If no data available
-        return ERROR_SOIL
+        if not samples:
+            return ERROR_SOIL
+        return self._raw_to_moisture_percent(sum(samples) / len(samples))
+
+    def _read_soil_frames(self) -> float:
+        """Mean moisture over the probes that sent readings since the previous call"""
+        ring = self.soil_reader.ring
+        probes = []
+        for channel in range(ring.channels):
+            _, values, self._soil_cursors[channel] = ring.read(channel, self._soil_cursors.get(channel, 0))
+            if len(values):
+                probes.append(self._raw_to_moisture_percent(float(values.mean())))
+        if not probes:
+            return ERROR_SOIL
+        return round(sum(probes) / len(probes), 1)
 
     def read_all_sensors(self) -> Dict[str, float]:
         """Read all sensor values and return as dictionary"""
@@ -172,6 +328,132 @@ class SensorSystem:
             "soil_moisture": soil
         }
 
+    def _drain_thread_alive(self) -> bool:
+        """Return True if the serial drain thread owns the Arduino port"""
+        return any(t.name == "serial-drain" and t.is_alive() for t in self._threads)
+
+    def _serial_drain_loop(self) -> None:
+        """Continuously drain the Arduino serial port into the soil sample buffer"""
+        max_samples = self.config["sampling"].get("soil_max_samples", 1000)
+        while not self._stop_event.is_set():
+            if self.arduino is None or not self.arduino.is_open:
+                self._stop_event.wait(1.0)
+                continue
+            # readline() blocks for at most the configured serial timeout
+            raw_value = self._read_serial_line()
+            if raw_value is None:
+                continue
+            with self._soil_lock:
+                self._soil_samples.append(raw_value)
+                if len(self._soil_samples) > max_samples:
+                    del self._soil_samples[:-max_samples]
+
+    def _sample_loop(self, stats_name: str, reader: Callable[[], Dict[str, float]], interval: float) -> None:
+        """Sample one sensor on its own cadence and merge good values into the snapshot"""
+        while not self._stop_event.is_set():
+            start = time.perf_counter()
+            try:
+                values = reader()
+            except Exception as e:
+                logger.error(f"Unexpected error in {stats_name} sampler: {e}")
+                values = {}
+            elapsed = time.perf_counter() - start
+
+            good = {key: value for key, value in values.items() if value != SENSOR_ERROR_VALUES[key]}
+            self.stats[stats_name].record(elapsed, bool(good) and len(good) == len(values))
+            if good:
+                now = time.time()
+                with self._snapshot_lock:
+                    for key, value in good.items():
+                        self._latest[key] = (value, now)
+
+            self._stop_event.wait(max(0.0, interval - elapsed))
+
+    def _sensor_schedule(self) -> Dict[str, Tuple[Callable[[], Dict[str, float]], float]]:
+        """Map each sampler to its reader and interval in seconds"""
+        sampling = self.config["sampling"]
+        default = sampling["interval"]
+
+        def read_dht() -> Dict[str, float]:
+            temperature, humidity = self.read_temperature_humidity()
+            return {"temperature": temperature, "humidity": humidity}
+
+        return {
+            "dht11": (read_dht, sampling.get("dht_interval") or default),
+            "bh1750": (lambda: {"light_intensity": self.read_light()}, sampling.get("light_interval") or default),
+            "soil": (lambda: {"soil_moisture": self.read_soil_moisture()}, sampling.get("soil_interval") or default)
+        }
+
+    def start_sampling(self) -> None:
+        """Start one sampler thread per sensor plus the serial drain thread"""
+        self._stop_event.clear()
+        self._threads = []
+        if self.soil_reader is not None:
+            self.soil_reader.start()
+        elif self.arduino is not None:
+            self._threads.append(threading.Thread(target=self._serial_drain_loop, name="serial-drain", daemon=True))
+        for name, (reader, interval) in self._sensor_schedule().items():
+            self._threads.append(threading.Thread(
+                target=self._sample_loop,
+                args=(name, reader, interval),
+                name=f"sampler-{name}",
+                daemon=True
+            ))
+        for thread in self._threads:
+            thread.start()
+        logger.info(f"Started {len(self._threads)} sensor threads")
+
+    def stop_sampling(self) -> None:
+        """Signal sampler threads to stop and wait briefly for them"""
+        self._stop_event.set()
+        if self.soil_reader is not None:
+            self.soil_reader.stop()
+        for thread in self._threads:
+            thread.join(timeout=5)
+        self._threads = []
+
+    def get_snapshot(self) -> Dict[str, float]:
+        """Return the latest value of every sensor, or its error value if stale"""
+        max_age = self.config["sampling"].get("max_age")
+        now = time.time()
+        with self._snapshot_lock:
+            latest = dict(self._latest)
+
+        snapshot = {}
+        for key, error_value in SENSOR_ERROR_VALUES.items():
+            value, timestamp = latest.get(key, (error_value, 0.0))
+            snapshot[key] = value if not max_age or now - timestamp <= max_age else error_value
+        return snapshot
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """Return per-sensor read latency and error-rate statistics, and the soil link's frame counts"""
+        stats = {name: stats.summary() for name, stats in self.stats.items()}
+        if self.soil_reader is not None:
+            stats["soil_link"] = self.soil_reader.stats()
+        return stats
+
+    def publish_stats(self) -> None:
+        """Log sensor statistics and publish them to the stats topic"""
+        stats = self.get_stats()
+        link = stats.get("soil_link")
+        if link:
+            logger.info(
+                f"Soil link: frames={link['frames']}, dropped={link['dropped']}, "
+                f"crc_errors={link['crc_errors']}, probes={len(link['channels'])}"
+            )
+        for name, summary in stats.items():
+            if name == "soil_link":
+                continue
+            logger.info(
+                f"Sensor stats {name}: reads={summary['reads']}, "
+                f"error_rate={summary['error_rate']:.1%}, "
+                f"avg={summary['latency_avg_ms']}ms, p95={summary['latency_p95_ms']}ms"
+            )
+        try:
+            self.mqtt_client.publish(self.config["mqtt"].get("stats_topic", "sensor/stats"), json.dumps(stats))
+        except Exception as e:
+            logger.error(f"Failed to publish sensor stats: {e}")
+
     def format_readings(self, readings: Dict[str, float]) -> Dict[str, str]:
         """Format sensor readings for display, with error indicators"""
         formatted = {}
@@ -182,9 +464,10 @@ class SensorSystem:
         return formatted
 
     def publish_data(self, data: Dict[str, float]) -> None:
-        """Publish sensor data to MQTT broker"""
-        payload = json.dumps(data)
-        topic = self.config["mqtt"]["topic"]
+        """Publish sensor data to MQTT broker, tagged with this Pi's device ID"""
+        device_id = self.config["mqtt"]["device_id"]
+        payload = json.dumps({**data, "device_id": device_id, "timestamp": time.time()})
+        topic = self.config["mqtt"]["topic"].format(device_id=device_id)
         
         try:
             self.mqtt_client.publish(topic, payload)
@@ -196,11 +479,16 @@ class SensorSystem:
         """Main loop to read sensors and publish data"""
         self.running = True
         logger.info("Starting sensor monitoring loop")
+        self.start_sampling()
+        stats_interval = self.config["sampling"].get("stats_interval", 60)
+        last_stats = time.monotonic()
+        announce_interval = self.config["mqtt"].get("announce_interval", 60)
+        last_announce = time.monotonic()
         
         try:
             while self.running:
-                # Read all sensor data
-                sensor_data = self.read_all_sensors()
+                # Consolidated snapshot of the latest reading from every sampler
+                sensor_data = self.get_snapshot()
                 
                 # Publish data to MQTT
                 self.publish_data(sensor_data)
@@ -213,6 +501,15 @@ class SensorSystem:
                     f"Light={formatted_data['light_intensity']}, "
                     f"Soil Moisture={formatted_data['soil_moisture']}"
                 )
+
+                if stats_interval and time.monotonic() - last_stats >= stats_interval:
+                    self.publish_stats()
+                    last_stats = time.monotonic()
+
+                if announce_interval and time.monotonic() - last_announce >= announce_interval:
+                    if self.mqtt_client.is_connected():
+                        self._announce(self.mqtt_client)
+                    last_announce = time.monotonic()
                 
                 # Wait for next reading
                 time.sleep(self.config["sampling"]["interval"])
@@ -226,6 +523,7 @@ class SensorSystem:
         """Clean up resources before exiting"""
         logger.info("Cleaning up resources")
         self.running = False
+        self.stop_sampling()
         
         # Close Arduino connection if open
         if self.arduino and self.arduino.is_open:
@@ -241,6 +539,12 @@ class SensorSystem:
             logger.error(f"Error disconnecting MQTT client: {e}")
 
 
+def optional_float_env(name: str) -> Optional[float]:
+    """Float value of an environment variable, or None when it is unset or empty"""
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
 def load_config_from_env() -> Dict:
     """Load configuration from environment variables"""
     config = {
@@ -248,7 +552,14 @@ def load_config_from_env() -> Dict:
             "broker": os.getenv("MQTT_BROKER"),
             "port": int(os.getenv("MQTT_PORT", 1883)),
             "keepalive": int(os.getenv("MQTT_KEEPALIVE", 60)),
-            "topic": os.getenv("MQTT_TOPIC", "sensor/data")
+            # "{device_id}" is replaced, so the backend can tell several Pis apart by topic
+            "topic": os.getenv("MQTT_TOPIC", "sensor/{device_id}/data"),
+            "device_id": os.getenv("DEVICE_ID") or socket.gethostname(),
+            "request_topic": os.getenv("MQTT_REQUEST_TOPIC", "sensor/request"),
+            "stats_topic": os.getenv("MQTT_STATS_TOPIC", "sensor/stats"),
+            "announce_topic": os.getenv("MQTT_ANNOUNCE_TOPIC", "discovery/raspberry_pi"),
+            # Re-announced this often so the record stays younger than ok.py's TTL
+            "announce_interval": float(os.getenv("MQTT_ANNOUNCE_INTERVAL", 60))
         },
         "sensors": {
             "soil_moisture": {
@@ -261,11 +572,22 @@ def load_config_from_env() -> Dict:
         },
         "arduino": {
             "port": os.getenv("ARDUINO_PORT", "/dev/ttyACM0"),
-            "baudrate": int(os.getenv("ARDUINO_BAUDRATE", 9600)),
-            "timeout": int(os.getenv("ARDUINO_TIMEOUT", 1))
+            "baudrate": int(os.getenv("ARDUINO_BAUDRATE", 115200)),
+            "timeout": int(os.getenv("ARDUINO_TIMEOUT", 1)),
+            # "binary" for the framed moisture_sensor.ino, "ascii" for sketches that print one number per line
+            "protocol": os.getenv("ARDUINO_PROTOCOL", "binary"),
+            # Readings kept per probe between soil samples
+            "buffer_size": int(os.getenv("SOIL_BUFFER_SIZE", 4096))
         },
         "sampling": {
-            "interval": int(os.getenv("SAMPLING_INTERVAL", 2))
+            "interval": int(os.getenv("SAMPLING_INTERVAL", 2)),
+            # Per-sensor intervals fall back to SAMPLING_INTERVAL when unset
+            "dht_interval": optional_float_env("DHT_INTERVAL"),
+            "light_interval": optional_float_env("LIGHT_INTERVAL"),
+            "soil_interval": optional_float_env("SOIL_INTERVAL"),
+            # Readings older than this many seconds are published as errors
+            "max_age": float(os.getenv("SENSOR_MAX_AGE", 30)),
+            "stats_interval": float(os.getenv("STATS_INTERVAL", 60))
         }
     }
     return config
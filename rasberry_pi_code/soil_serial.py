@@ -0,0 +1,506 @@
+#!/usr/bin/env python3
+"""
+Plant Monitoring System - Binary Soil Probe Link
+Decodes the framed binary protocol of moisture_sensor.ino. The sketch used to
+print one ASCII line per reading every two seconds, and the Pi parsed each
+line with readline() and int(). The sketch now samples every probe at a fixed
+rate and sends each reading as an 8-byte frame:
+
+    offset  size  field
+    0       2     sync bytes 0xA5 0x5A
+    2       1     channel (probe index)
+    3       2     sequence number, per channel, little-endian, wraps at 65536
+    5       2     10-bit ADC reading, little-endian
+    7       1     CRC-8 (polynomial 0x07) of bytes 2-6
+
+setup() sends one boot frame on channel 0xFF (sequence 0, the number of
+probes as the reading) before any readings, so the Pi can tell a restarted
+sketch from lost frames.
+
+SerialFrameReader drains the port on a background thread. FrameDecoder checks
+whole runs of aligned frames at once with NumPy, so the common case costs one
+table lookup per byte. After a bad checksum or a lost byte, it skips ahead to
+the next sync pair. Decoded readings go into a SampleRing: one fixed-size
+ring buffer per channel. A gap in a channel's sequence numbers counts the
+frames lost in between. A boot frame counts as an Arduino reset. So does a gap
+longer than the time since the channel's last frame could hold, which
+catches a restart whose boot frame was lost.
+
+Commands:
+- fake:      emulate the Arduino on a pseudo-terminal, for running the Pi code without hardware
+- monitor:   print link statistics for a real or fake port
+- benchmark: decode throughput, and an end-to-end run against a fake device with drops and corruption
+
+Environment variables are loaded from a .env file
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import pty
+import threading
+import time
+import tty
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("soil_serial")
+
+# Must match moisture_sensor.ino
+SYNC = b"\xa5\x5a"
+FRAME_SIZE = 8
+MAX_CHANNELS = 8
+BOOT_CHANNEL = 0xFF
+# Highest per-channel rate a sketch is expected to send; longer gaps than this allows are restarts
+MAX_RATE_HZ = 1000.0
+# Frames a gap may exceed that rate by, for jitter in when reads return
+GAP_SLACK = 64
+
+
+def _crc8_table() -> np.ndarray:
+    table = np.zeros(256, dtype=np.uint8)
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table[byte] = crc
+    return table
+
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data: bytes) -> int:
+    crc = 0
+    for byte in data:
+        crc = int(CRC8_TABLE[crc ^ byte])
+    return crc
+
+
+def encode_frame(channel: int, sequence: int, value: int) -> bytes:
+    """One frame as the sketch sends it"""
+    body = bytes((channel, sequence & 0xFF, (sequence >> 8) & 0xFF, value & 0xFF, (value >> 8) & 0xFF))
+    return SYNC + body + bytes((crc8(body),))
+
+
+class FrameDecoder:
+    """Incremental frame decoder with resynchronization after corrupt or lost bytes"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.discarded_bytes = 0
+
+    def feed(self, data: bytes) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Decode every complete frame in the data so far; returns (channels, sequences, values)"""
+        self._buffer += data
+        buffer = self._buffer
+        decoded = []
+        pos = 0
+        while len(buffer) - pos >= FRAME_SIZE:
+            if buffer[pos] != SYNC[0] or buffer[pos + 1] != SYNC[1]:
+                found = buffer.find(SYNC, pos + 1)
+                # Keep a trailing first sync byte: its partner may be in the next read
+                skip_to = found if found >= 0 else len(buffer) - 1
+                self.discarded_bytes += skip_to - pos
+                pos = skip_to
+                continue
+
+            count = (len(buffer) - pos) // FRAME_SIZE
+            raw = np.frombuffer(bytes(buffer[pos:pos + count * FRAME_SIZE]), dtype=np.uint8).reshape(count, FRAME_SIZE)
+            crc = np.zeros(count, dtype=np.uint8)
+            for column in range(2, 7):
+                crc = CRC8_TABLE[crc ^ raw[:, column]]
+            valid = (raw[:, 0] == SYNC[0]) & (raw[:, 1] == SYNC[1]) & (crc == raw[:, 7])
+            good = count if valid.all() else int(np.argmin(valid))
+            if good:
+                decoded.append(raw[:good])
+                pos += good * FRAME_SIZE
+            if good < count:
+                if raw[good, 0] == SYNC[0] and raw[good, 1] == SYNC[1]:
+                    self.crc_errors += 1
+                # Look for the next sync pair inside the bad frame too
+                self.discarded_bytes += 1
+                pos += 1
+        del buffer[:pos]
+
+        if not decoded:
+            empty = np.zeros(0, dtype=np.uint16)
+            return empty.astype(np.uint8), empty, empty
+        frames = np.concatenate(decoded)
+        self.frames += len(frames)
+        sequences = frames[:, 3].astype(np.uint16) | (frames[:, 4].astype(np.uint16) << 8)
+        values = frames[:, 5].astype(np.uint16) | (frames[:, 6].astype(np.uint16) << 8)
+        return frames[:, 2].copy(), sequences, values
+
+
+class SampleRing:
+    """Per-channel ring buffers of readings with sequence-gap accounting"""
+
+    def __init__(self, channels: int = MAX_CHANNELS, capacity: int = 4096, max_rate_hz: float = MAX_RATE_HZ):
+        self.capacity = capacity
+        self.max_rate_hz = max_rate_hz
+        self.timestamps = np.zeros((channels, capacity), dtype=np.float64)
+        self.values = np.zeros((channels, capacity), dtype=np.uint16)
+        self.written = np.zeros(channels, dtype=np.int64)
+        self.last_sequence = np.full(channels, -1, dtype=np.int64)
+        self.dropped = np.zeros(channels, dtype=np.int64)
+        self.resets = np.zeros(channels, dtype=np.int64)
+        self.boots = 0
+        self.unknown_channel = 0
+        self._lock = threading.Lock()
+
+    @property
+    def channels(self) -> int:
+        return len(self.written)
+
+    def add(self, timestamp: float, channels: np.ndarray, sequences: np.ndarray, values: np.ndarray) -> None:
+        """Append decoded frames that arrived at `timestamp`"""
+        with self._lock:
+            start = 0
+            # Frames before a boot frame belong to the previous run of the sketch
+            for boot in np.flatnonzero(channels == BOOT_CHANNEL):
+                self._add_run(timestamp, channels[start:boot], sequences[start:boot], values[start:boot])
+                self.boots += 1
+                started = self.last_sequence >= 0
+                self.resets[started] += 1
+                self.last_sequence[:] = -1
+                start = boot + 1
+            self._add_run(timestamp, channels[start:], sequences[start:], values[start:])
+
+    def _add_run(self, timestamp: float, channels: np.ndarray, sequences: np.ndarray, values: np.ndarray) -> None:
+        for channel in np.unique(channels):
+            mask = channels == channel
+            if channel >= self.channels:
+                self.unknown_channel += int(mask.sum())
+                continue
+            sequence = sequences[mask].astype(np.int64)
+            previous = np.concatenate(([self.last_sequence[channel]], sequence[:-1]))
+            gaps = (sequence - previous - 1) & 0xFFFF
+            # No gap to measure before the first frame of a channel
+            gaps[previous < 0] = 0
+            # Every frame in this read was sent after the channel's last frame arrived
+            last_timestamp = self.timestamps[channel, (self.written[channel] - 1) % self.capacity]
+            limit = max(0.0, timestamp - last_timestamp) * self.max_rate_hz + GAP_SLACK
+            restarts = gaps > limit
+            self.resets[channel] += int(restarts.sum())
+            self.dropped[channel] += int(gaps[~restarts].sum())
+            self.last_sequence[channel] = sequence[-1]
+
+            count = len(sequence)
+            slots = (self.written[channel] + np.arange(count)) % self.capacity
+            self.values[channel, slots] = values[mask]
+            self.timestamps[channel, slots] = timestamp
+            self.written[channel] += count
+
+    def read(self, channel: int, cursor: int) -> Tuple[np.ndarray, np.ndarray, int]:
+        """Readings written after `cursor`; returns (timestamps, values, new cursor)
+
+        Readings overwritten before they were read are skipped.
+        """
+        with self._lock:
+            written = int(self.written[channel])
+            start = max(cursor, written - self.capacity)
+            slots = (start + np.arange(written - start)) % self.capacity
+            return self.timestamps[channel, slots], self.values[channel, slots], written
+
+    def latest(self, channel: int, count: int) -> np.ndarray:
+        """The last `count` readings of a channel, oldest first"""
+        with self._lock:
+            written = int(self.written[channel])
+            count = min(count, written, self.capacity)
+            return self.values[channel, (written - count + np.arange(count)) % self.capacity]
+
+
+class SerialFrameReader:
+    """Background thread that decodes frames from a serial port into a SampleRing"""
+
+    def __init__(self, port, channels: int = MAX_CHANNELS, capacity: int = 4096, read_size: int = 4096):
+        """port is an open pyserial Serial (or anything with read() and in_waiting)"""
+        self.port = port
+        self.ring = SampleRing(channels, capacity)
+        self.decoder = FrameDecoder()
+        self.read_size = read_size
+        self.read_errors = 0
+        self.started = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self.started = time.monotonic()
+        self._thread = threading.Thread(target=self._loop, name="serial-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def _loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                # Blocks for one byte at most the port timeout, then takes whatever else is queued
+                data = self.port.read(max(1, min(self.port.in_waiting, self.read_size)))
+            except Exception as e:
+                self.read_errors += 1
+                logger.warning(f"Error reading Arduino: {e}")
+                self._stop_event.wait(1.0)
+                continue
+            if data:
+                channels, sequences, values = self.decoder.feed(data)
+                if len(channels):
+                    self.ring.add(time.time(), channels, sequences, values)
+
+    def stats(self) -> Dict:
+        """Frame, loss and error counts, and the receive rate of each channel that has sent anything"""
+        elapsed = time.monotonic() - self.started if self.started else 0.0
+        ring = self.ring
+        channels = {}
+        for channel in np.flatnonzero(ring.written):
+            received = int(ring.written[channel])
+            expected = received + int(ring.dropped[channel])
+            channels[int(channel)] = {
+                "frames": received,
+                "dropped": int(ring.dropped[channel]),
+                "loss_rate": round(int(ring.dropped[channel]) / expected, 4) if expected else 0.0,
+                "resets": int(ring.resets[channel]),
+                "rate_hz": round(received / elapsed, 1) if elapsed else None
+            }
+        return {
+            "frames": self.decoder.frames,
+            "dropped": int(ring.dropped.sum()),
+            "crc_errors": self.decoder.crc_errors,
+            "boots": ring.boots,
+            "discarded_bytes": self.decoder.discarded_bytes,
+            "unknown_channel": ring.unknown_channel,
+            "read_errors": self.read_errors,
+            "channels": channels
+        }
+
+
+class FakeArduino:
+    """Emulates moisture_sensor.ino on a pseudo-terminal, with optional lost and corrupted frames"""
+
+    def __init__(self, channels: int = 4, rate_hz: float = 200.0, drop_rate: float = 0.0,
+                 corrupt_rate: float = 0.0, seed: int = 0, first_sequence: int = 0):
+        self.channels = channels
+        self.rate_hz = rate_hz
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self._rng = np.random.default_rng(seed)
+        self._master, self._slave = pty.openpty()
+        # No echo or newline translation, like a USB serial device
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.sent = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.restarts = 0
+        self._sequence = [first_sequence & 0xFFFF] * channels
+        self._restart: Optional[bool] = None
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def restart(self, send_boot: bool = True) -> None:
+        """Reset the sketch before the next round: sequences start from 0, after a boot frame unless send_boot is False"""
+        self._restart = send_boot
+
+    def frames(self) -> bytes:
+        """One round of readings, one frame per channel"""
+        data = bytearray()
+        if self._restart is not None:
+            if self._restart:
+                data += encode_frame(BOOT_CHANNEL, 0, self.channels)
+            self._sequence = [0] * self.channels
+            self.restarts += 1
+            self._restart = None
+        for channel in range(self.channels):
+            sequence = self._sequence[channel]
+            self._sequence[channel] = (sequence + 1) & 0xFFFF
+            value = int(400 + 100 * channel + self._rng.integers(0, 20))
+            if self._rng.random() < self.drop_rate:
+                self.dropped += 1
+                continue
+            frame = bytearray(encode_frame(channel, sequence, value))
+            if self._rng.random() < self.corrupt_rate:
+                frame[int(self._rng.integers(2, FRAME_SIZE))] ^= 0x10
+                self.corrupted += 1
+            data += frame
+            self.sent += 1
+        return bytes(data)
+
+    def start(self) -> None:
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="fake-arduino", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def close(self) -> None:
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _loop(self) -> None:
+        period = 1.0 / self.rate_hz
+        next_round = time.monotonic()
+        while not self._stop_event.is_set():
+            os.write(self._master, self.frames())
+            next_round += period
+            delay = next_round - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(delay)
+
+
+def open_port(port: str, baudrate: int, timeout: float = 1.0):
+    import serial
+    return serial.Serial(port, baudrate, timeout=timeout)
+
+
+def run_benchmark(args) -> Dict:
+    """Decoder throughput on clean and corrupted streams, then a pty run with injected loss"""
+    results = {}
+    rng = np.random.default_rng(0)
+    clean = b"".join(encode_frame(i % 4, i // 4, int(v)) for i, v in enumerate(rng.integers(0, 1024, args.frames)))
+    noisy = bytearray(clean)
+    for index in rng.choice(len(noisy), len(noisy) // 1000, replace=False):
+        noisy[index] ^= 0x5A
+
+    for label, stream in (("clean", clean), ("corrupted_0.1pct_bytes", bytes(noisy))):
+        decoder = FrameDecoder()
+        start = time.perf_counter()
+        for offset in range(0, len(stream), args.chunk_size):
+            decoder.feed(stream[offset:offset + args.chunk_size])
+        elapsed = time.perf_counter() - start
+        results[f"decode_{label}"] = {
+            "frames": decoder.frames,
+            "frames_per_s": round(decoder.frames / elapsed),
+            "crc_errors": decoder.crc_errors,
+            "discarded_bytes": decoder.discarded_bytes
+        }
+
+    # The previous protocol: one ASCII line per reading, parsed with readline() and int()
+    lines = io.BytesIO(b"".join(b"%d\r\n" % v for v in rng.integers(0, 1024, args.frames)))
+    start = time.perf_counter()
+    parsed = sum(1 for line in iter(lines.readline, b"") if int(line.decode('utf-8').strip()) >= 0)
+    results["decode_ascii_lines"] = {"frames": parsed, "frames_per_s": round(parsed / (time.perf_counter() - start))}
+
+    # Start near the middle of the sequence range: a restart from there used to look like 25000 lost frames
+    fake = FakeArduino(args.channels, args.rate, args.drop_rate, args.corrupt_rate, first_sequence=40000)
+    port = open_port(fake.port, args.baudrate, timeout=0.1)
+    reader = SerialFrameReader(port)
+    reader.start()
+    fake.start()
+    time.sleep(args.seconds / 3)
+    fake.restart()
+    time.sleep(args.seconds / 3)
+    # A restart whose boot frame was lost is caught by the gap being longer than the elapsed time allows
+    fake.restart(send_boot=False)
+    time.sleep(args.seconds / 3)
+    fake.stop()
+    time.sleep(0.5)
+    reader.stop()
+    port.close()
+    fake.close()
+    stats = reader.stats()
+    results["pty"] = {
+        "channels": args.channels,
+        "rate_hz_per_channel": args.rate,
+        "sent": fake.sent,
+        "injected_drops": fake.dropped,
+        "injected_corruptions": fake.corrupted,
+        "received": stats["frames"],
+        "detected_drops": stats["dropped"],
+        "injected_restarts": fake.restarts,
+        "boot_frames": stats["boots"],
+        "detected_resets_per_channel": {channel: summary["resets"] for channel, summary in stats["channels"].items()},
+        "crc_errors": stats["crc_errors"],
+        "receive_rate_hz": {channel: summary["rate_hz"] for channel, summary in stats["channels"].items()}
+    }
+    return results
+
+
+def main():
+    """Run the fake device, the link monitor or the benchmark"""
+    parser = argparse.ArgumentParser(description='Plant Monitoring System - Binary Soil Probe Link')
+    parser.add_argument('-e', '--env', type=str, default='.env', help='Path to .env file')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fake_parser = subparsers.add_parser('fake', help='Emulate the Arduino on a pseudo-terminal')
+    fake_parser.add_argument('--channels', type=int, default=4)
+    fake_parser.add_argument('--rate', type=float, default=200.0, help='Readings per second per channel')
+    fake_parser.add_argument('--drop-rate', type=float, default=0.0)
+    fake_parser.add_argument('--corrupt-rate', type=float, default=0.0)
+
+    monitor_parser = subparsers.add_parser('monitor', help='Print link statistics once a second')
+    monitor_parser.add_argument('--port', default=None, help='Serial port (default: ARDUINO_PORT)')
+
+    bench_parser = subparsers.add_parser('benchmark', help='Measure decoding and loss detection')
+    bench_parser.add_argument('--frames', type=int, default=200000)
+    bench_parser.add_argument('--chunk-size', type=int, default=512, help='Bytes per simulated read')
+    bench_parser.add_argument('--channels', type=int, default=4)
+    bench_parser.add_argument('--rate', type=float, default=500.0, help='Readings per second per channel')
+    bench_parser.add_argument('--drop-rate', type=float, default=0.01)
+    bench_parser.add_argument('--corrupt-rate', type=float, default=0.005)
+    bench_parser.add_argument('--seconds', type=float, default=3.0)
+    bench_parser.add_argument('--output', help='Write the results as JSON')
+
+    args = parser.parse_args()
+    if os.path.exists(args.env):
+        from dotenv import load_dotenv
+        load_dotenv(args.env)
+    args.baudrate = int(os.getenv("ARDUINO_BAUDRATE", 115200))
+
+    if args.command == 'fake':
+        fake = FakeArduino(args.channels, args.rate, args.drop_rate, args.corrupt_rate)
+        fake.start()
+        print(f"Fake Arduino on {fake.port}; run the Pi code with ARDUINO_PORT={fake.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fake.close()
+    elif args.command == 'monitor':
+        port = open_port(args.port or os.getenv("ARDUINO_PORT", "/dev/ttyACM0"), args.baudrate)
+        reader = SerialFrameReader(port)
+        reader.start()
+        try:
+            while True:
+                time.sleep(1)
+                print(json.dumps(reader.stats()))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            reader.stop()
+            port.close()
+    elif args.command == 'benchmark':
+        results = run_benchmark(args)
+        print(json.dumps(results, indent=2))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -9,12 +9,13 @@ import AnimatedReanimated, { useAnimatedStyle, useSharedValue, withTiming, FadeI
 import { LinearGradient } from 'expo-linear-gradient';
 
 const STATUSBAR_HEIGHT = Platform.OS === 'android' ? StatusBar.currentHeight || 24 : 0;
+const RENDER_URL = 'http://192.168.107.180:8000/render';
 
 export default function DiseaseDetails() {
   const systemColorScheme = useColorScheme(); // System theme (light or dark)
   const [theme, setTheme] = useState(systemColorScheme); // Manual theme override
   const route = useRoute();
-  const { result } = route.params as { result: any };
+  const { result, imageBase64 } = route.params as { result: any; imageBase64?: string };
   const [analysisImage, setAnalysisImage] = useState<string | null>(null);
   const [saving, setSaving] = useState(false);
   const [permissionGranted, setPermissionGranted] = useState(false);
@@ -66,8 +67,24 @@ export default function DiseaseDetails() {
   const pulseOpacity = pulseAnim.interpolate({ inputRange: [0, 1], outputRange: [0.4, 0] });
   const bounceTranslateY = bounceAnim.interpolate({ inputRange: [0, 1], outputRange: [0, -10] });
 
+  // /analyze returns the compact analysis; the figure is rendered by the backend only when needed
+  const fetchAnalysisImage = async (): Promise<string | null> => {
+    if (analysisImage) return analysisImage;
+    if (!result.analysis || !imageBase64) return null;
+    const response = await fetch(RENDER_URL, {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ image: imageBase64, analysis: result.analysis }),
+    });
+    if (!response.ok) throw new Error(`Render failed with status ${response.status}`);
+    const data = await response.json();
+    const imageUri = `data:image/png;base64,${data.analysis_image}`;
+    setAnalysisImage(imageUri);
+    return imageUri;
+  };
+
   const saveImage = async () => {
-    if (!analysisImage) return;
+    if (!analysisImage && !result.analysis) return;
     try {
       setSaving(true);
       if (!permissionGranted) {
@@ -79,7 +96,9 @@ export default function DiseaseDetails() {
         }
         setPermissionGranted(true);
       }
-      const base64Data = analysisImage.split(',')[1] || analysisImage;
+      const image = await fetchAnalysisImage();
+      if (!image) throw new Error('No analysis image');
+      const base64Data = image.split(',')[1] || image;
       const fileName = `tomato_disease_${result.detection.disease.replace(/\s+/g, '_')}_${new Date().getTime()}.jpg`;
       const fileUri = FileSystem.documentDirectory + fileName;
       await FileSystem.writeAsStringAsync(fileUri, base64Data, { encoding: FileSystem.EncodingType.Base64 });
@@ -94,10 +113,12 @@ export default function DiseaseDetails() {
   };
 
   const shareImage = async () => {
-    if (!analysisImage) return;
+    if (!analysisImage && !result.analysis) return;
     try {
       setSaving(true);
-      const base64Data = analysisImage.split(',')[1] || analysisImage;
+      const image = await fetchAnalysisImage();
+      if (!image) throw new Error('No analysis image');
+      const base64Data = image.split(',')[1] || image;
       const fileName = `tomato_disease_analysis.jpg`;
       const fileUri = FileSystem.documentDirectory + fileName;
       await FileSystem.writeAsStringAsync(fileUri, base64Data, { encoding: FileSystem.EncodingType.Base64 });
@@ -202,7 +223,7 @@ export default function DiseaseDetails() {
           </TouchableOpacity>
         </AnimatedReanimated.View>
 
-        {analysisImage && (
+        {(analysisImage || (result.analysis && imageBase64)) && (
           <AnimatedReanimated.View entering={FadeInDown.delay(200).duration(800)}>
             <View style={styles.imageInfoContainer}>
               <View style={styles.imageInfoLeft}>
@@ -0,0 +1,194 @@
+"""Asynchronous analysis jobs for the mobile backend.
+
+A full /analyze call (prediction, leaf analysis, sensor or weather reads and
+recommendations) can take long enough for a mobile connection to drop it.
+With `"async": true`, the backend creates a Job instead, runs the pipeline on
+a background thread and returns the job ID at once. Each finished stage
+merges its part of the response into job.result, so the client can show the
+prediction before the severity and recommendations are ready. The client can
+poll GET /jobs/<id> or follow GET /jobs/<id>/events (server-sent events).
+
+JobStore is bounded. A finished job is kept for `ttl` seconds after it
+completes, and the oldest finished jobs are evicted first when the store is
+full. Eviction happens lazily on access, so no sweeper thread is needed.
+"""
+import contextvars
+import copy
+import json
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, Optional
+
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from instrumentation import REGISTRY
+
+JOBS_TOTAL = REGISTRY.counter("tomato_analysis_jobs_total", "Analysis jobs by final status", ("status",))
+JOBS_ACTIVE = REGISTRY.gauge("tomato_analysis_jobs_active", "Analysis jobs queued or running")
+
+FINAL_STATUSES = ("done", "failed")
+
+
+class JobStoreFull(Exception):
+    """Every slot in the store holds an unfinished job"""
+
+
+class JobFailed(Exception):
+    """A pipeline failure to report to the client with an HTTP status and extra fields"""
+
+    def __init__(self, message: str, status: int = 500, **fields):
+        super().__init__(message)
+        self.status = status
+        self.fields = fields
+
+
+def merge(target: Dict, partial: Dict) -> None:
+    """Recursively merge a stage's partial response into the accumulated one"""
+    for key, value in partial.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = value
+
+
+class Job:
+    """One pipeline run; every change bumps `version` and wakes event-stream readers"""
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = "queued"
+        self.stage = None
+        self.stages = []
+        self.result: Dict = {}
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def _changed(self) -> None:
+        self.version += 1
+        self._cond.notify_all()
+
+    def start(self) -> None:
+        with self._cond:
+            self.status = "running"
+            self._changed()
+
+    def update(self, stage: str, partial: Dict) -> None:
+        """Record a finished stage and merge its part of the response"""
+        with self._cond:
+            merge(self.result, partial)
+            self.stage = stage
+            self.stages.append(stage)
+            self._changed()
+
+    def finish(self, error: Optional[Dict] = None) -> None:
+        with self._cond:
+            self.status = "failed" if error else "done"
+            self.error = error
+            self.finished = time.time()
+            self._changed()
+
+    def snapshot(self) -> Dict:
+        with self._cond:
+            return {
+                "job_id": self.id,
+                "status": self.status,
+                "stage": self.stage,
+                "stages": list(self.stages),
+                "result": copy.deepcopy(self.result),
+                "error": self.error,
+                "created": self.created,
+                "finished": self.finished
+            }
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Block until the job changes past `version` or timeout; returns the current version"""
+        with self._cond:
+            self._cond.wait_for(lambda: self.version > version, timeout)
+            return self.version
+
+    def events(self, keepalive: float = 15.0) -> Iterator[str]:
+        """Server-sent events: one per stage, then the final status; comments keep idle connections open"""
+        seen_version, sent_stages = 0, 0
+        while True:
+            version = self.wait(seen_version, keepalive)
+            if version == seen_version:
+                yield ": keepalive\n\n"
+                continue
+            seen_version = version
+            snapshot = self.snapshot()
+            for stage in snapshot["stages"][sent_stages:]:
+                yield f"event: {stage}\ndata: {json.dumps(snapshot['result'])}\n\n"
+            sent_stages = len(snapshot["stages"])
+            if snapshot["status"] in FINAL_STATUSES:
+                yield f"event: {snapshot['status']}\ndata: {json.dumps(snapshot)}\n\n"
+                return
+
+
+class JobStore:
+    """Bounded job store with TTL eviction of finished jobs and a worker pool to run them"""
+
+    def __init__(self, workers: int = 4, max_jobs: int = 1000, ttl: float = 600.0):
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="analysis-job")
+
+    def _evict(self, now: float) -> None:
+        """Drop expired jobs, then the oldest finished ones while the store is full; caller holds the lock"""
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished is not None and now - job.finished > self.ttl]:
+            del self._jobs[job_id]
+        if len(self._jobs) >= self.max_jobs:
+            for job_id in [job_id for job_id, job in self._jobs.items() if job.finished is not None]:
+                del self._jobs[job_id]
+                if len(self._jobs) < self.max_jobs:
+                    break
+
+    def submit(self, pipeline: Callable, *args) -> Job:
+        """Run pipeline(job, *args) in the background; it reports stages with job.update()"""
+        job = Job()
+        with self._lock:
+            self._evict(time.time())
+            if len(self._jobs) >= self.max_jobs:
+                raise JobStoreFull(f"{self.max_jobs} analysis jobs are still running")
+            self._jobs[job.id] = job
+        JOBS_ACTIVE.inc(1)
+
+        def run():
+            job.start()
+            error = None
+            try:
+                pipeline(job, *args)
+            except JobFailed as e:
+                error = {"error": str(e), "status": e.status, **e.fields}
+            except Exception as e:
+                error = {"error": f"An error occurred: {str(e)}", "status": 500}
+            job.finish(error)
+            JOBS_ACTIVE.dec(1)
+            JOBS_TOTAL.inc(1, job.status)
+
+        # Runs in a copy of the request's context, so the request ID still reaches the model server
+        self._executor.submit(contextvars.copy_context().run, run)
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            self._evict(time.time())
+            return self._jobs.get(job_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "jobs": len(statuses),
+            "running": statuses.count("running"),
+            "queued": statuses.count("queued"),
+            "max_jobs": self.max_jobs,
+            "ttl_s": self.ttl
+        }
@@ -0,0 +1,242 @@
+"""Warm process pool for the CPU-heavy leaf analysis in the mobile backend.
+
+process_image_analysis runs OpenCV, scikit-image, mahotas, SciPy and
+matplotlib. Much of that holds the GIL, and pyplot is not thread-safe, so
+concurrent /analyze requests serialize when it runs in the Flask request
+threads. AnalysisPool runs it in worker processes instead:
+
+- The pool is sized to the CPU count. Workers are started up front and run one
+  warm-up analysis, so requests never pay for interpreter start-up, library
+  imports or matplotlib's font cache.
+- The backend decodes the image and copies the pixels once into a
+  multiprocessing.shared_memory block. Only the block's name, the shape and
+  the prediction are pickled to the worker.
+- At most `max_pending` jobs may be queued or running. Beyond that, submit()
+  raises AnalysisPoolBusy at once instead of letting work pile up.
+- Each job has a timeout. A job still queued when it expires is cancelled. A
+  job already running keeps its slot until the worker finishes it, because a
+  single pool worker cannot be interrupted.
+
+Stage timings recorded inside a worker are sent back with the result and
+recorded in the backend's /metrics, so the dashboards look the same either way.
+
+analyze() sends back an AnalysisResult of a few KB. The figure is drawn only
+when render() asks for it, in a worker too, because pyplot is not thread-safe.
+"""
+import logging
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+
+from analysis_result import AnalysisResult
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from instrumentation import REGISTRY, STAGE_SECONDS, timed
+from tomato_disease_client import EnhancedTomatoDiseaseClient
+
+logger = logging.getLogger("tomato-disease-backend")
+
+POOL_PENDING = REGISTRY.gauge("tomato_analysis_pool_pending", "Analysis jobs queued or running in the process pool")
+POOL_REJECTED = REGISTRY.counter(
+    "tomato_analysis_pool_rejected_total",
+    "Analysis jobs refused because the queue was full, or abandoned after their timeout",
+    ("reason",)
+)
+
+# The analysis client of this worker process, created by _init_worker
+_worker_client = None
+
+
+class AnalysisPoolBusy(Exception):
+    """Every job slot is taken; retry after retry_after seconds"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Analysis pool is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class AnalysisTimeout(Exception):
+    """An analysis job did not finish within the pool's timeout"""
+
+
+def _init_worker() -> None:
+    """Import the analysis libraries and warm them up once per worker process"""
+    global _worker_client
+    import cv2
+    # Parallelism comes from the processes; OpenCV's own threads would oversubscribe the cores
+    cv2.setNumThreads(1)
+
+    _worker_client = EnhancedTomatoDiseaseClient("", "", "")
+    output_dir = _worker_client.output_dir
+    warmup_dir = tempfile.mkdtemp(prefix="analysis-warmup-")
+    try:
+        _worker_client.output_dir = warmup_dir
+        warmup = np.zeros((64, 64, 3), dtype=np.uint8)
+        warmup[16:48, 16:48] = (60, 140, 50)
+        _worker_client.analyze_image(warmup, {"predicted_class": "Tomato_healthy", "confidence": 1.0})
+    finally:
+        _worker_client.output_dir = output_dir
+        shutil.rmtree(warmup_dir, ignore_errors=True)
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _with_shared_image(shm_name: str, shape: Tuple[int, ...], work: Callable):
+    """Run work(image) on the image in a shared memory block; returns (output, stage seconds)"""
+    before = STAGE_SECONDS.summary()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    image = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    error = None
+    try:
+        output = work(image)
+    except Exception as e:
+        # Keep only the message: the traceback's frames hold views of the shared block
+        error = f"{type(e).__name__}: {e}"
+    # The block cannot be closed while an array still points into it
+    del image
+    shm.close()
+    if error is not None:
+        raise RuntimeError(error)
+
+    stages = {}
+    for labels, stats in STAGE_SECONDS.summary().items():
+        previous = before.get(labels, {"count": 0, "sum": 0.0})
+        if stats["count"] > previous["count"]:
+            stages[labels[0]] = stats["sum"] - previous["sum"]
+    return output, stages
+
+
+def _analyze_job(shm_name: str, shape: Tuple[int, ...], prediction_result: Dict) -> Tuple[Dict, Dict[str, float]]:
+    """AnalysisResult of a shared image, as a dict so the full-resolution masks stay in the worker"""
+    return _with_shared_image(shm_name, shape, lambda image: _worker_client.analyze(image, prediction_result).to_dict())
+
+
+def _render_job(shm_name: str, shape: Tuple[int, ...], result: Dict, save_path: Optional[str]) -> Tuple[str, Dict]:
+    """Render the analysis figure of a shared image; returns the absolute PNG path"""
+    # Absolute, in case the worker's working directory differs from the backend's
+    return _with_shared_image(shm_name, shape, lambda image: os.path.abspath(
+        _worker_client.render_analysis(image, AnalysisResult.from_dict(result), save_path)
+    ))
+
+
+class AnalysisPool:
+    """Bounded, warm ProcessPoolExecutor for process_image_analysis"""
+
+    def __init__(self, workers: Optional[int] = None, max_pending: Optional[int] = None, timeout: float = 60.0):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or 2 * self.workers
+        self.timeout = timeout
+        self.pending = 0
+        # Smoothed seconds per job, used for Retry-After
+        self.service_time = 1.0
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._restart_lock = threading.Lock()
+        # spawn, not fork: the backend has Flask, MQTT and HTTP threads that must not be forked mid-operation
+        self._context = multiprocessing.get_context("spawn")
+        self._executor = self._start()
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(self.workers, mp_context=self._context, initializer=_init_worker)
+        # One call per worker makes the executor start all of them now, and waits for their warm-up
+        pids = {future.result() for future in [executor.submit(_ready) for _ in range(self.workers)]}
+        logger.info(f"Analysis pool ready with {len(pids)} worker processes")
+        return executor
+
+    def _release(self, shm: shared_memory.SharedMemory) -> None:
+        """Free a finished, failed or cancelled job's shared memory and slot"""
+        shm.close()
+        shm.unlink()
+        with self._lock:
+            self.pending -= 1
+            POOL_PENDING.set(self.pending)
+        self._slots.release()
+
+    def submit(self, job: Callable, image: np.ndarray, *args) -> Future:
+        """Queue job(shm_name, shape, *args) on an RGB uint8 image; the future resolves to (output, stages)"""
+        if not self._slots.acquire(blocking=False):
+            POOL_REJECTED.inc(1, "queue_full")
+            # Queued jobs drain about `workers` at a time
+            raise AnalysisPoolBusy(max(1, math.ceil(self.service_time * self.max_pending / self.workers)))
+
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        np.ndarray(image.shape, dtype=np.uint8, buffer=shm.buf)[...] = image
+        with self._lock:
+            self.pending += 1
+            POOL_PENDING.set(self.pending)
+        try:
+            future = self._executor.submit(job, shm.name, image.shape, *args)
+        except BaseException:
+            self._release(shm)
+            raise
+        future.add_done_callback(lambda _: self._release(shm))
+        return future
+
+    def analyze(self, image_path: str, prediction_result: Dict) -> AnalysisResult:
+        """EnhancedTomatoDiseaseClient.analyze on an image file, in a worker"""
+        with timed("decode"):
+            image = EnhancedTomatoDiseaseClient.load_image(image_path)
+        return AnalysisResult.from_dict(self._run(_analyze_job, image, prediction_result))
+
+    def render(self, image_path: str, result: AnalysisResult, save_path: Optional[str] = None) -> str:
+        """EnhancedTomatoDiseaseClient.render_analysis on an image file, in a worker"""
+        with timed("decode"):
+            image = EnhancedTomatoDiseaseClient.load_image(image_path)
+        return self._run(_render_job, image, result.to_dict(), save_path)
+
+    def _run(self, job: Callable, image: np.ndarray, *args):
+        """Submit a job and wait for its output within the timeout"""
+        executor = self._executor
+        start = time.perf_counter()
+        with timed("analysis_pool"):
+            future = self.submit(job, image, *args)
+            del image
+            try:
+                output, stages = future.result(timeout=self.timeout)
+            except FutureTimeout:
+                future.cancel()
+                POOL_REJECTED.inc(1, "timeout")
+                raise AnalysisTimeout(f"Analysis did not finish within {self.timeout}s")
+            except BrokenProcessPool:
+                self._restart(executor)
+                raise
+
+        self.service_time = 0.8 * self.service_time + 0.2 * (time.perf_counter() - start)
+        for stage, seconds in stages.items():
+            STAGE_SECONDS.observe(seconds, stage)
+        return output
+
+    def _restart(self, broken: ProcessPoolExecutor) -> None:
+        """Replace the executor after a worker died; only the first caller does it"""
+        # Not self._lock: shutting down cancels queued jobs, whose callbacks take it
+        with self._restart_lock:
+            if self._executor is not broken:
+                return
+            logger.error("An analysis worker died, restarting the analysis pool")
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "timeout_s": self.timeout,
+                "service_time_ms": round(self.service_time * 1000, 1)
+            }
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
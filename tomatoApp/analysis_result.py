@@ -0,0 +1,212 @@
+"""Compact, serializable results of the leaf analysis.
+
+process_image_analysis used to return only the path of a 300-dpi, four-panel
+PNG and the severity. The /analyze response then carried that PNG as base64,
+megabytes per analysis. AnalysisResult carries what the picture showed, as
+data:
+
+- The leaf and disease masks, downscaled so the longer side is at most
+  `MASK_MAX_SIDE` pixels. Each mask is run-length encoded, or bit-packed
+  when that is smaller (speckled masks).
+- The disease regions: the connected components of the full-resolution
+  disease mask, largest first, as bounding boxes in image pixels with their
+  areas.
+- The leaf and disease areas, severity, and the Grad-CAM map when one was used.
+
+to_dict() is usually a few KB of JSON, so the mobile app can draw overlays
+itself. The rendered figure is produced only when asked for, by
+EnhancedTomatoDiseaseClient.render_analysis.
+
+Run-length counts alternate between runs of 0 and 1 in row-major order,
+starting with a (possibly empty) run of 0. Bit-packed masks are
+numpy.packbits of the row-major mask, base64-encoded.
+
+/render gets the result back from the app, so from_dict() checks every
+field it decodes and raises ValueError when the masks do not add up.
+"""
+import base64
+import json
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from response_format import decode_map
+
+MASK_MAX_SIDE = 256
+MAX_REGIONS = 32
+# Largest encoded mask side accepted back from a client
+MAX_DECODED_SIDE = 4096
+
+
+def rle_encode(mask: np.ndarray) -> Dict:
+    flat = mask.ravel().astype(bool)
+    boundaries = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts))
+    return {"shape": list(mask.shape), "counts": counts.tolist()}
+
+
+def _mask_shape(encoded: Dict) -> Tuple[int, int]:
+    shape = encoded["shape"]
+    if (not isinstance(shape, (list, tuple)) or len(shape) != 2
+            or not all(isinstance(v, int) and 0 < v <= MAX_DECODED_SIDE for v in shape)):
+        raise ValueError(f"Mask shape must be two sides between 1 and {MAX_DECODED_SIDE}, not {shape!r}")
+    return shape[0], shape[1]
+
+
+def rle_decode(encoded: Dict) -> np.ndarray:
+    shape = _mask_shape(encoded)
+    counts = np.asarray(encoded["counts"], dtype=np.int64)
+    if counts.ndim != 1 or (counts < 0).any() or counts.sum() != shape[0] * shape[1]:
+        raise ValueError(f"Run-length counts do not cover a {shape[0]}x{shape[1]} mask")
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(shape)
+
+
+def bits_encode(mask: np.ndarray) -> Dict:
+    packed = np.packbits(mask.ravel().astype(bool))
+    return {"shape": list(mask.shape), "bits": base64.b64encode(packed.tobytes()).decode('ascii')}
+
+
+def bits_decode(encoded: Dict) -> np.ndarray:
+    shape = _mask_shape(encoded)
+    packed = np.frombuffer(base64.b64decode(encoded["bits"], validate=True), dtype=np.uint8)
+    size = shape[0] * shape[1]
+    if len(packed) != (size + 7) // 8:
+        raise ValueError(f"Packed bits do not cover a {shape[0]}x{shape[1]} mask")
+    return np.unpackbits(packed, count=size).astype(bool).reshape(shape)
+
+
+def encode_mask(mask: np.ndarray) -> Dict:
+    """Run-length or bit-packed encoding of a mask, whichever is shorter as JSON"""
+    rle = rle_encode(mask)
+    bits = bits_encode(mask)
+    return rle if len(json.dumps(rle["counts"])) <= len(bits["bits"]) else bits
+
+
+def decode_mask(encoded: Dict, shape: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """Boolean mask from encode_mask(), optionally resized to shape (height, width)"""
+    import cv2
+    mask = rle_decode(encoded) if "counts" in encoded else bits_decode(encoded)
+    if shape is not None and tuple(mask.shape) != tuple(shape):
+        mask = cv2.resize(mask.astype(np.uint8), (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST) > 0
+    return mask
+
+
+def downscale_mask(mask: np.ndarray, max_side: int = MASK_MAX_SIDE) -> np.ndarray:
+    """Boolean mask whose longer side is at most max_side; a pixel is set if half its area was"""
+    import cv2
+    height, width = mask.shape
+    scale = max_side / max(height, width)
+    mask = mask > 0
+    if scale >= 1:
+        return mask
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(mask.astype(np.float32), size, interpolation=cv2.INTER_AREA) >= 0.5
+
+
+def find_regions(disease_mask: np.ndarray, leaf_area: int, max_regions: int = MAX_REGIONS) -> Tuple[List[Dict], int]:
+    """The largest connected disease regions as bounding boxes and areas, and the total region count"""
+    import cv2
+    count, _, stats, _ = cv2.connectedComponentsWithStats((disease_mask > 0).astype(np.uint8), connectivity=8)
+    stats = stats[1:]
+    order = np.argsort(stats[:, cv2.CC_STAT_AREA])[::-1][:max_regions]
+    regions = [{
+        "bbox": [int(v) for v in stats[i, :4]],
+        "area": int(stats[i, cv2.CC_STAT_AREA]),
+        "leaf_fraction": round(float(stats[i, cv2.CC_STAT_AREA]) / leaf_area, 5) if leaf_area else 0.0
+    } for i in order]
+    return regions, count - 1
+
+
+class AnalysisResult:
+    """Severity, masks and disease regions of one analyzed leaf image"""
+
+    def __init__(self, predicted_class: str, confidence: float, severity: float, image_shape: List[int],
+                 leaf_area: int, disease_area: int, leaf_mask: Dict, disease_mask: Dict, regions: List[Dict],
+                 region_count: int, method: str, cam: Optional[Dict] = None):
+        self.predicted_class = predicted_class
+        self.confidence = confidence
+        self.severity = severity
+        self.image_shape = image_shape
+        self.leaf_area = leaf_area
+        self.disease_area = disease_area
+        self.leaf_mask = leaf_mask
+        self.disease_mask = disease_mask
+        self.regions = regions
+        self.region_count = region_count
+        self.method = method
+        self.cam = cam
+        # Full-resolution masks of a fresh analysis, for rendering in the same process; never serialized
+        self.full_masks: Optional[Tuple[np.ndarray, np.ndarray]] = None
+
+    @classmethod
+    def from_masks(cls, prediction_result: Dict, leaf_mask: np.ndarray, disease_mask: np.ndarray, method: str,
+                   cam: Optional[Dict] = None, max_side: int = MASK_MAX_SIDE) -> "AnalysisResult":
+        leaf_area = int(np.count_nonzero(leaf_mask))
+        disease_area = int(np.count_nonzero(disease_mask))
+        regions, region_count = find_regions(disease_mask, leaf_area)
+        result = cls(
+            predicted_class=prediction_result["predicted_class"],
+            confidence=float(prediction_result["confidence"]),
+            severity=disease_area / leaf_area * 100 if leaf_area else 0.0,
+            image_shape=list(leaf_mask.shape[:2]),
+            leaf_area=leaf_area,
+            disease_area=disease_area,
+            leaf_mask=encode_mask(downscale_mask(leaf_mask, max_side)),
+            disease_mask=encode_mask(downscale_mask(disease_mask, max_side)),
+            regions=regions,
+            region_count=region_count,
+            method=method,
+            cam=cam
+        )
+        result.full_masks = (leaf_mask, disease_mask)
+        return result
+
+    def masks(self, shape: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """(leaf, disease) uint8 masks, 255 inside, at shape (height, width) or else the image's resolution"""
+        shape = tuple(shape or self.image_shape)
+        if self.full_masks is not None and self.full_masks[0].shape[:2] == shape:
+            return self.full_masks
+        return tuple(decode_mask(mask, shape).astype(np.uint8) * 255 for mask in (self.leaf_mask, self.disease_mask))
+
+    def to_dict(self) -> Dict:
+        return {
+            "predicted_class": self.predicted_class,
+            "confidence": self.confidence,
+            "severity": round(self.severity, 3),
+            "image_shape": self.image_shape,
+            "leaf_area": self.leaf_area,
+            "disease_area": self.disease_area,
+            "leaf_mask": self.leaf_mask,
+            "disease_mask": self.disease_mask,
+            "regions": self.regions,
+            "region_count": self.region_count,
+            "method": self.method,
+            "cam": self.cam
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "AnalysisResult":
+        """Inverse of to_dict(); raises KeyError when a field other than cam is missing, ValueError when one is invalid"""
+        result = cls(**{key: data[key] for key in (
+            "predicted_class", "confidence", "severity", "image_shape", "leaf_area", "disease_area",
+            "leaf_mask", "disease_mask", "regions", "region_count", "method"
+        )}, cam=data.get("cam"))
+        shape = result.image_shape
+        if (not isinstance(shape, list) or len(shape) != 2
+                or not all(isinstance(v, int) and v > 0 for v in shape)):
+            raise ValueError(f"image_shape must be [height, width], not {shape!r}")
+        result.severity = float(result.severity)
+        for mask in (result.leaf_mask, result.disease_mask):
+            if not isinstance(mask, dict):
+                raise ValueError("leaf_mask and disease_mask must be encoded masks")
+            # Decoded here so a bad mask is a bad request, not a failure halfway through rendering
+            decode_mask(mask)
+        if result.cam is not None:
+            if not isinstance(result.cam, dict):
+                raise ValueError("cam must be an encoded map")
+            decode_map(result.cam)
+        return result
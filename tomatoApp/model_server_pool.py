@@ -0,0 +1,335 @@
+"""Client-side load balancing across several model servers.
+
+SERVER_URL may list several models/server.py instances separated by commas.
+A ModelServerPool routes each request to one of them:
+
+- Least outstanding requests. The request goes to the endpoint with the fewest
+  requests in flight from this process. The queue length from the endpoint's
+  last /health answer is added, so load from other backends counts too. Ties
+  go to the lower smoothed latency.
+- Active health checks. A background thread polls GET /health every
+  `health_interval` seconds. Endpoints that fail the check are skipped until
+  a later check passes.
+- Passive ejection. After `eject_after` consecutive failures, an endpoint is
+  ejected for `eject_seconds`, growing with repeated ejections. Failures are
+  connection errors, 5xx answers other than 503, and answers slower than
+  `slow_seconds`. A 503 with Retry-After only parks the endpoint for that long.
+- Hedging. If the first endpoint has not answered after the pool's p95
+  latency, the same request goes to a second endpoint and the first good
+  answer wins. A connection error or 5xx also fails over to a second endpoint
+  at once. Hedges are capped at `max_hedge_ratio` of requests, so a slow
+  cluster does not get double the load.
+
+When every endpoint is ejected or unhealthy, the pool still routes among all
+of them rather than failing outright. The pool's stats() is shown on the
+backend's /health.
+"""
+import math
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import requests
+
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from instrumentation import REGISTRY
+
+MODEL_SERVER_REQUESTS = REGISTRY.counter(
+    "tomato_model_server_requests_total",
+    "Requests sent to each model server endpoint by outcome",
+    ("endpoint", "outcome")
+)
+MODEL_SERVER_OUTSTANDING = REGISTRY.gauge(
+    "tomato_model_server_outstanding",
+    "Requests in flight to each model server endpoint",
+    ("endpoint",)
+)
+MODEL_SERVER_EJECTIONS = REGISTRY.counter(
+    "tomato_model_server_ejections_total",
+    "Times an endpoint was ejected after consecutive failures",
+    ("endpoint",)
+)
+MODEL_SERVER_HEDGES = REGISTRY.counter(
+    "tomato_model_server_hedges_total",
+    "Second requests sent to another endpoint, because the first was slow or failed",
+    ("reason",)
+)
+
+
+def retry_after_seconds(value: Optional[str], default: float = 1.0) -> float:
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date
+
+    A missing or unparseable header gives `default`; a date in the past gives 0.
+    """
+    if not value:
+        return default
+    try:
+        seconds = float(value)
+        return max(seconds, 0.0) if math.isfinite(seconds) else default
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max((when - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+# Latencies kept for the hedge delay, and how many are needed before hedging starts
+LATENCY_WINDOW = 200
+MIN_LATENCY_SAMPLES = 20
+
+
+def parse_urls(urls: Union[str, Sequence[str]]) -> List[str]:
+    """Endpoint URLs from a comma-separated string or a list, without trailing slashes"""
+    if isinstance(urls, str):
+        urls = urls.split(",")
+    return [url.strip().rstrip("/") for url in urls if url.strip()]
+
+
+class Endpoint:
+    """Routing state of one model server"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.healthy = True
+        self.reported_queue = 0
+        self.latency = None  # smoothed seconds per successful request
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.unavailable_until = 0.0
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.unavailable_until
+
+    def score(self) -> tuple:
+        return (self.outstanding + self.reported_queue, self.latency or 0.0, random.random())
+
+    def describe(self, now: float) -> Dict:
+        return {
+            "url": self.url,
+            "available": self.available(now),
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "reported_queue": self.reported_queue,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "consecutive_failures": self.consecutive_failures,
+            "ejections": self.ejections,
+            "unavailable_for_s": round(max(0.0, self.unavailable_until - now), 1)
+        }
+
+
+class ModelServerPool:
+    """Health-aware, least-outstanding-requests routing with ejection and hedging"""
+
+    _shared: Dict[tuple, "ModelServerPool"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, urls: Union[str, Sequence[str]], health_interval: float = 5.0, eject_after: int = 3,
+                 eject_seconds: float = 30.0, slow_seconds: float = 10.0, hedge_after: Optional[float] = None,
+                 max_hedge_ratio: float = 0.1):
+        self.endpoints = [Endpoint(url) for url in parse_urls(urls)]
+        if not self.endpoints:
+            raise ValueError("No model server URLs given")
+        self.health_interval = health_interval
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.slow_seconds = slow_seconds
+        # Fixed hedge delay in seconds; None uses the p95 of recent latencies
+        self.hedge_after = hedge_after
+        self.max_hedge_ratio = max_hedge_ratio
+        self.requests = 0
+        self.hedges = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        # Two requests at most per call, and hedge losers keep running until their timeout
+        self._executor = ThreadPoolExecutor(max_workers=8 * len(self.endpoints), thread_name_prefix="model-server")
+        self._stopped = threading.Event()
+        if len(self.endpoints) > 1 and health_interval > 0:
+            threading.Thread(target=self._health_loop, name="model-server-health", daemon=True).start()
+
+    @classmethod
+    def shared(cls, urls: Union[str, Sequence[str]]) -> "ModelServerPool":
+        """One pool per set of URLs for the whole process, so routing state outlives each client"""
+        key = tuple(parse_urls(urls))
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(key)
+            return cls._shared[key]
+
+    @property
+    def url(self) -> str:
+        return self.endpoints[0].url
+
+    def choose(self, exclude: Sequence[Endpoint] = ()) -> Optional[Endpoint]:
+        """The available endpoint with the least load, else the least-loaded one outside `exclude`"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude]
+            available = [endpoint for endpoint in candidates if endpoint.available(now)]
+            candidates = available or candidates
+            return min(candidates, key=Endpoint.score) if candidates else None
+
+    def available(self, exclude: Sequence[Endpoint] = ()) -> bool:
+        """Whether an endpoint outside `exclude` can take a request now"""
+        now = time.monotonic()
+        with self._lock:
+            return any(endpoint.available(now) for endpoint in self.endpoints if endpoint not in exclude)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait for the first endpoint before hedging, or None to not hedge"""
+        if len(self.endpoints) < 2:
+            return None
+        with self._lock:
+            if self.hedges >= self.max_hedge_ratio * self.requests:
+                return None
+            if self.hedge_after is not None:
+                return self.hedge_after
+            if len(self._latencies) < MIN_LATENCY_SAMPLES:
+                return None
+            return float(np.percentile(self._latencies, 95))
+
+    def _send(self, endpoint: Endpoint, method: str, path: str, timeout: float, **kwargs):
+        """One request to one endpoint; returns the response or the exception it raised"""
+        with self._lock:
+            endpoint.outstanding += 1
+        MODEL_SERVER_OUTSTANDING.inc(1, endpoint.url)
+        start = time.monotonic()
+        try:
+            outcome = requests.request(method, endpoint.url + path, timeout=(min(5.0, timeout), timeout), **kwargs)
+        except requests.RequestException as e:
+            outcome = e
+        finally:
+            MODEL_SERVER_OUTSTANDING.dec(1, endpoint.url)
+        self._record(endpoint, outcome, time.monotonic() - start)
+        return outcome
+
+    def _record(self, endpoint: Endpoint, outcome, seconds: float) -> None:
+        """Update latency and failure state after a request finishes"""
+        now = time.monotonic()
+        if isinstance(outcome, Exception):
+            result = "error"
+        elif outcome.status_code == 503:
+            result = "busy"
+        elif outcome.status_code >= 500:
+            result = "error"
+        elif seconds > self.slow_seconds:
+            result = "slow"
+        else:
+            result = "ok"
+        MODEL_SERVER_REQUESTS.inc(1, endpoint.url, result)
+
+        with self._lock:
+            endpoint.outstanding -= 1
+            if result == "busy":
+                retry_after = retry_after_seconds(outcome.headers.get("Retry-After"))
+                endpoint.unavailable_until = max(endpoint.unavailable_until, now + retry_after)
+                return
+            if not isinstance(outcome, Exception):
+                endpoint.latency = seconds if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * seconds
+                if result != "error":
+                    self._latencies.append(seconds)
+            if result == "ok":
+                endpoint.consecutive_failures = 0
+                endpoint.ejections = 0
+                return
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.eject_after and now >= endpoint.unavailable_until:
+                endpoint.ejections += 1
+                endpoint.consecutive_failures = 0
+                endpoint.unavailable_until = now + self.eject_seconds * min(endpoint.ejections, 10)
+                MODEL_SERVER_EJECTIONS.inc(1, endpoint.url)
+                print(f"Ejected model server {endpoint.url} for {self.eject_seconds * min(endpoint.ejections, 10):.0f}s")
+
+    def request(self, method: str, path: str, timeout: float, hedge: bool = False,
+                hedge_json=None, **kwargs) -> requests.Response:
+        """Send a request to the best endpoint, failing over or hedging to a second one
+
+        hedge_json replaces the JSON body of the second request, for requests
+        with side effects that should only happen once. Returns the first
+        answer below 500, else the last answer. Raises the last connection
+        error if no endpoint answered.
+        """
+        deadline = time.monotonic() + timeout
+        primary = self.choose()
+        with self._lock:
+            self.requests += 1
+        tried = [primary]
+        pending = {self._executor.submit(self._send, primary, method, path, timeout, **kwargs)}
+        delay = self.hedge_delay() if hedge else None
+        outcome = None
+
+        while pending:
+            can_hedge = delay is not None and len(tried) < 2
+            done, pending = wait(pending, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                outcome = future.result()
+                if isinstance(outcome, requests.Response) and outcome.status_code < 500:
+                    return outcome
+            remaining = deadline - time.monotonic()
+            # Nothing finished within the hedge delay, or the only request failed
+            reason = "failover" if done and not pending else "hedge" if not done and can_hedge else None
+            backup = self.choose(exclude=tried) if reason and len(tried) < 2 and remaining > 0 else None
+            if backup is None:
+                # Only wait for what is already in flight
+                delay = None
+                continue
+            tried.append(backup)
+            if reason == "hedge":
+                with self._lock:
+                    self.hedges += 1
+                if hedge_json is not None:
+                    kwargs = {**kwargs, "json": hedge_json}
+            MODEL_SERVER_HEDGES.inc(1, reason)
+            pending.add(self._executor.submit(self._send, backup, method, path, remaining, **kwargs))
+
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def post(self, path: str, timeout: float, **kwargs) -> requests.Response:
+        return self.request("POST", path, timeout, **kwargs)
+
+    def get(self, path: str, timeout: float, **kwargs) -> requests.Response:
+        return self.request("GET", path, timeout, **kwargs)
+
+    def check_health(self) -> None:
+        """Poll every endpoint's /health once"""
+        for endpoint in self.endpoints:
+            try:
+                response = requests.get(endpoint.url + "/health", timeout=2.0)
+                health = response.json() if response.status_code == 200 else {}
+            except (requests.RequestException, ValueError):
+                health = {}
+            with self._lock:
+                endpoint.healthy = health.get("status") == "healthy"
+                endpoint.reported_queue = int((health.get("admission") or {}).get("queued", 0))
+
+    def _health_loop(self) -> None:
+        while not self._stopped.wait(self.health_interval):
+            self.check_health()
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [endpoint.describe(now) for endpoint in self.endpoints]
+            requests_sent, hedges = self.requests, self.hedges
+        delay = self.hedge_delay()
+        return {
+            "endpoints": endpoints,
+            "requests": requests_sent,
+            "hedges": hedges,
+            "hedge_delay_ms": round(delay * 1000, 1) if delay is not None else None
+        }
+
+    def close(self) -> None:
+        self._stopped.set()
+        self._executor.shutdown(wait=False)
@@ -1,44 +1,245 @@
 import subprocess
-import platform
 import socket
+import argparse
+import ipaddress
+import json
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-def is_windows():
-    return platform.system().lower() == "windows"
+# Raspberry Pi Foundation / Raspberry Pi Trading OUIs
+PI_MAC_PREFIXES = ("b8:27:eb", "dc:a6:32", "e4:5f:01", "d8:3a:dd", "28:cd:c1", "2c:cf:67")
+# SSH, MQTT, the model server and the mobile backend
+DEFAULT_PROBE_PORTS = (22, 1883, 5000, 8000)
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".tomato_pi_cache.json")
+DEFAULT_CACHE_TTL = 300
+ANNOUNCE_TOPIC = "discovery/raspberry_pi"
 
-def ping(ip):
-    command = ["ping", "-n", "1", "-w", "200", ip] if is_windows() else ["ping", "-c", "1", "-W", "1", ip]
-    return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+def normalize_mac(mac):
+    """Lower-case, colon separated MAC, or None for incomplete ARP entries"""
+    if not mac:
+        return None
+    mac = mac.strip().lower().replace("-", ":")
+    if mac in ("00:00:00:00:00:00", "(incomplete)") or not re.fullmatch(r"([0-9a-f]{1,2}:){5}[0-9a-f]{1,2}", mac):
+        return None
+    return ":".join(part.zfill(2) for part in mac.split(":"))
+
+def read_arp_cache():
+    """Return {ip: mac} from the OS neighbour table without sending any packets"""
+    entries = {}
+    if os.path.exists("/proc/net/arp"):
+        with open("/proc/net/arp") as f:
+            next(f, None)  # header
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 4:
+                    mac = normalize_mac(fields[3])
+                    if mac:
+                        entries[fields[0]] = mac
+        return entries
+
+    output = subprocess.getoutput("arp -a")
+    for line in output.splitlines():
+        ip_match = re.search(r"(\d{1,3}(?:\.\d{1,3}){3})", line)
+        mac_match = re.search(r"(([0-9a-fA-F]{1,2}[:-]){5}[0-9a-fA-F]{1,2})", line)
+        if ip_match and mac_match:
+            mac = normalize_mac(mac_match.group(1))
+            if mac:
+                entries[ip_match.group(1)] = mac
+    return entries
+
+def probe_host(ip, ports=DEFAULT_PROBE_PORTS, timeout=0.5):
+    """TCP-connect probe: a host is up if any port accepts or actively refuses"""
+    for port in ports:
+        try:
+            with socket.create_connection((ip, port), timeout=timeout):
+                return True
+        except ConnectionRefusedError:
+            return True
+        except OSError:
+            continue
+    return False
 
 def get_hostname(ip):
     try:
         return socket.gethostbyaddr(ip)[0]
-    except:
+    except (socket.herror, socket.gaierror, OSError):
         return ""
 
-def get_mac(ip):
-    if is_windows():
-        arp_cmd = f"arp -a {ip}"
-        output = subprocess.getoutput(arp_cmd)
-        for line in output.splitlines():
-            if ip in line:
-                return line.split()[1]
-    return None
-
-def scan_network(base_ip):
-    print("🔍 Scanning for Raspberry Pi...")
-    for i in range(1, 255):
-        ip = f"{base_ip}.{i}"
-        if ping(ip):
-            hostname = get_hostname(ip)
-            mac = get_mac(ip)
-            # Check if the hostname or MAC suggests it's a Raspberry Pi
-            if "raspberrypi" in hostname.lower() or (mac and (mac.startswith("b8:27:eb") or mac.startswith("dc:a6:32"))):
-                print(f"🎯 Raspberry Pi FOUND at: {ip} | Hostname: {hostname} | MAC: {mac}")
-                return ip
-            else:
-                print(f"✅ Active: {ip} | Hostname: {hostname} | MAC: {mac}")
-    print("❌ Raspberry Pi NOT found.")
-    return None
-
-# CHANGE THIS BASE IP IF NEEDED (check from your hotspot or other device)
-scan_network("192.168.187")
+def get_mac(ip, arp_cache=None):
+    arp_cache = read_arp_cache() if arp_cache is None else arp_cache
+    return arp_cache.get(ip)
+
+def is_raspberry_pi(hostname, mac):
+    """Check if the hostname or MAC suggests it's a Raspberry Pi"""
+    return "raspberrypi" in (hostname or "").lower() or bool(mac and mac.startswith(PI_MAC_PREFIXES))
+
+def load_cache(cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL):
+    """Return cached {ip: host} entries younger than ttl seconds"""
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    now = time.time()
+    return {ip: host for ip, host in cached.items() if now - host.get("seen", 0) <= ttl}
+
+def save_cache(hosts, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL, replace=False):
+    """Merge discovered hosts into the cache file, dropping expired entries; replace drops all earlier entries"""
+    cached = {} if replace else load_cache(cache_path, ttl)
+    cached.update({host["ip"]: host for host in hosts})
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cached, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+def listen_for_announcements(broker, port=1883, topic=ANNOUNCE_TOPIC, wait=2.0, max_age=DEFAULT_CACHE_TTL):
+    """Collect retained announcements that raspberry_pi_server.py publishes on connect and then every minute
+
+    The broker keeps the last announcement of a Pi that has since gone away,
+    so announcements older than max_age seconds are ignored.
+    """
+    try:
+        import paho.mqtt.client as mqtt
+    except ImportError:
+        return []
+
+    hosts = {}
+    lock = threading.Lock()
+
+    def on_connect(client, userdata, flags, rc):
+        client.subscribe(f"{topic}/#")
+
+    def on_message(client, userdata, message):
+        try:
+            announcement = json.loads(message.payload.decode())
+        except ValueError:
+            return
+        timestamp = announcement.get("timestamp")
+        if not isinstance(timestamp, (int, float)) or time.time() - timestamp > max_age:
+            return
+        if announcement.get("ip"):
+            with lock:
+                hosts[announcement["ip"]] = {
+                    "ip": announcement["ip"],
+                    "hostname": announcement.get("hostname", ""),
+                    "mac": normalize_mac(announcement.get("mac")),
+                    "is_pi": True,
+                    "source": "mqtt",
+                    "seen": timestamp
+                }
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    try:
+        client.connect(broker, port, 10)
+        client.loop_start()
+        time.sleep(wait)
+        client.loop_stop()
+        client.disconnect()
+    except Exception as e:
+        print(f"⚠️ MQTT announce lookup failed: {e}")
+    return list(hosts.values())
+
+def resolve_mdns(names=("raspberrypi.local",)):
+    """Resolve .local names through the system resolver (avahi/Bonjour)"""
+    hosts = []
+    for name in names:
+        try:
+            ip = socket.gethostbyname(name)
+        except OSError:
+            continue
+        hosts.append({"ip": ip, "hostname": name, "mac": None, "is_pi": True, "source": "mdns", "seen": time.time()})
+    return hosts
+
+def scan_network(base_ip, max_workers=64, ports=DEFAULT_PROBE_PORTS, timeout=0.5):
+    """Probe every address of a /24 concurrently and return all active hosts"""
+    print(f"🔍 Scanning {base_ip}.0/24 for Raspberry Pi...")
+    subnet = ipaddress.ip_network(f"{base_ip}.0/24")
+    arp_before = read_arp_cache()
+
+    candidates = [str(ip) for ip in subnet.hosts()]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        alive = list(pool.map(lambda ip: ip in arp_before or probe_host(ip, ports, timeout), candidates))
+        active_ips = [ip for ip, up in zip(candidates, alive) if up]
+
+        # The connect attempts populate the neighbour table, so read it again
+        arp_cache = {**arp_before, **read_arp_cache()}
+        hostnames = list(pool.map(get_hostname, active_ips))
+
+    hosts = []
+    for ip, hostname in zip(active_ips, hostnames):
+        mac = arp_cache.get(ip)
+        host = {"ip": ip, "hostname": hostname, "mac": mac, "is_pi": is_raspberry_pi(hostname, mac),
+                "source": "scan", "seen": time.time()}
+        hosts.append(host)
+        if host["is_pi"]:
+            print(f"🎯 Raspberry Pi FOUND at: {ip} | Hostname: {hostname} | MAC: {mac}")
+        else:
+            print(f"✅ Active: {ip} | Hostname: {hostname} | MAC: {mac}")
+    return hosts
+
+def merge_hosts(*sources):
+    """Hosts from several lookups, one per IP; later lookups fill in a hostname or MAC the first one lacked"""
+    merged = {}
+    for hosts in sources:
+        for host in hosts:
+            known = merged.setdefault(host["ip"], dict(host))
+            for key in ("hostname", "mac"):
+                known[key] = known.get(key) or host.get(key)
+    return list(merged.values())
+
+def discover_pis(base_ip, broker=None, use_cache=True, cache_path=DEFAULT_CACHE_PATH, ttl=DEFAULT_CACHE_TTL,
+                 max_workers=64, timeout=0.5, quick=False, mdns_names=("raspberrypi.local",)):
+    """Find all Raspberry Pis from MQTT announcements, mDNS and a full scan of the /24
+
+    A Pi that announced itself or answers on mDNS is found even when the
+    scan cannot tell it from other hosts. With quick, the first of the cache,
+    the announcements and mDNS that finds any Pi is used and the scan is
+    skipped; that can miss Pis the faster lookups do not know about.
+    """
+    if use_cache and quick:
+        cached = [host for host in load_cache(cache_path, ttl).values()
+                  if host.get("is_pi") and host["ip"].startswith(f"{base_ip}.")]
+        if cached:
+            print(f"⚡ Using {len(cached)} cached Raspberry Pi(s)")
+            return cached
+
+    fast_path = merge_hosts(listen_for_announcements(broker, max_age=ttl) if broker else [], resolve_mdns(mdns_names))
+    if quick and fast_path:
+        pis = fast_path
+    else:
+        scanned = [host for host in scan_network(base_ip, max_workers=max_workers, timeout=timeout) if host["is_pi"]]
+        pis = merge_hosts(fast_path, scanned)
+
+    if pis:
+        # After a full scan, Pis it no longer finds are dropped from the cache
+        save_cache(pis, cache_path, ttl, replace=not quick)
+        for host in pis:
+            print(f"🎯 Raspberry Pi at: {host['ip']} | Hostname: {host['hostname']} | MAC: {host['mac']} | via {host['source']}")
+    else:
+        print("❌ Raspberry Pi NOT found.")
+    return pis
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discover Raspberry Pis on the local network")
+    # CHANGE THIS BASE IP IF NEEDED (check from your hotspot or other device)
+    parser.add_argument("base_ip", nargs="?", default="192.168.187", help="First three octets of the /24 to scan")
+    parser.add_argument("--broker", help="MQTT broker to check for Pi announcements before scanning")
+    parser.add_argument("--workers", type=int, default=64, help="Maximum concurrent probes")
+    parser.add_argument("--timeout", type=float, default=0.5, help="Per-port connect timeout in seconds")
+    parser.add_argument("--ttl", type=int, default=DEFAULT_CACHE_TTL, help="Seconds a cached result stays valid")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="Path of the discovery cache file")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached results in --quick mode")
+    parser.add_argument("--quick", action="store_true",
+                        help="Stop at the cache, announcements or mDNS when they find a Pi, without scanning")
+    parser.add_argument("--mdns-name", action="append", dest="mdns_names",
+                        help="A .local name to resolve (repeatable, default raspberrypi.local)")
+    args = parser.parse_args()
+
+    discover_pis(args.base_ip, broker=args.broker, use_cache=not args.no_cache, cache_path=args.cache,
+                 ttl=args.ttl, max_workers=args.workers, timeout=args.timeout, quick=args.quick,
+                 mdns_names=tuple(args.mdns_names or ("raspberrypi.local",)))
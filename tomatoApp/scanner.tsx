@@ -274,7 +274,8 @@ export default function Scanner() {
   };
 
   const navigateToDetailsScreen = (result: any) => {
-    navigation.navigate('DiseaseDetails', { result });
+    // The photo goes along so the details screen can ask /render for the analysis figure
+    navigation.navigate('DiseaseDetails', { result, imageBase64: selectedImageBase64 });
   };
 
   const checkDiseaseAsync = async () => {
@@ -0,0 +1,376 @@
+"""Sensor readings of every Raspberry Pi, kept as bounded time series.
+
+get_sensor_readings used to open a new MQTT connection per request, ask for a
+snapshot and keep only the first message from `sensor/data`, whichever Pi
+sent it. SensorIngest instead stays subscribed to the per-device topics
+(`sensor/<device_id>/data`, plus the legacy `sensor/data`). It feeds every
+message into a SensorStore, which keeps per device:
+
+- The last `capacity` raw samples in a ring buffer. Timestamps are a float64
+  array and the four readings are a float32 column block, with NaN where a
+  sensor failed.
+- Rollups at two resolutions: 1-minute buckets for `minute_buckets` minutes
+  and 1-hour buckets for `hour_buckets` hours. Each bucket holds the count,
+  sum, min and max of every field. A sample updates one bucket per
+  resolution, and a bucket is reset when the ring wraps around to it.
+
+Every array is allocated when a device is first seen, so memory per device is
+fixed (about 55 KB with the defaults). At most `max_devices` devices are
+kept; the one heard from least recently is dropped first. A window query
+such as the 24-hour humidity mean adds up at most one ring of buckets, so
+its cost does not depend on how fast the devices publish.
+
+Samples are timestamped when the backend receives them, so Pis with a wrong
+clock still line up.
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from instrumentation import REGISTRY
+
+logger = logging.getLogger("tomato-disease-backend")
+
+SENSOR_MESSAGES = REGISTRY.counter(
+    "tomato_sensor_messages_total",
+    "Sensor MQTT messages received by outcome",
+    ("outcome",)
+)
+SENSOR_DEVICES = REGISTRY.gauge("tomato_sensor_devices", "Sensor devices with readings in the store")
+
+FIELDS = ("temperature", "humidity", "light_intensity", "soil_moisture")
+# The Pi publishes -999.9 for a failed read
+ERROR_THRESHOLD = -900.0
+# Device ID for messages on the legacy topic without a device_id field
+DEFAULT_DEVICE = "default"
+
+MINUTE = 60
+HOUR = 3600
+
+
+def parse_readings(payload: Dict) -> np.ndarray:
+    """float32 vector of FIELDS from a message, NaN for missing, invalid or error values"""
+    values = np.full(len(FIELDS), np.nan, dtype=np.float32)
+    for i, field in enumerate(FIELDS):
+        try:
+            value = float(payload.get(field))
+        except (TypeError, ValueError):
+            continue
+        if value > ERROR_THRESHOLD:
+            values[i] = value
+    return values
+
+
+class Rollup:
+    """Ring of fixed-width time buckets with the count, sum, min and max of each field"""
+
+    def __init__(self, resolution: int, buckets: int):
+        self.resolution = resolution
+        # Bucket number (timestamp // resolution) each slot holds, -1 when empty
+        self.number = np.full(buckets, -1, dtype=np.int64)
+        self.count = np.zeros((buckets, len(FIELDS)), dtype=np.int32)
+        self.sum = np.zeros((buckets, len(FIELDS)), dtype=np.float64)
+        self.min = np.full((buckets, len(FIELDS)), np.inf, dtype=np.float32)
+        self.max = np.full((buckets, len(FIELDS)), -np.inf, dtype=np.float32)
+
+    @property
+    def span(self) -> int:
+        """Seconds of history the ring covers"""
+        return self.resolution * len(self.number)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.number, self.count, self.sum, self.min, self.max))
+
+    def add(self, timestamp: float, values: np.ndarray, present: np.ndarray) -> None:
+        number = int(timestamp // self.resolution)
+        slot = number % len(self.number)
+        if self.number[slot] != number:
+            if self.number[slot] > number:
+                # Older than anything the ring still holds
+                return
+            self.number[slot] = number
+            self.count[slot] = 0
+            self.sum[slot] = 0.0
+            self.min[slot] = np.inf
+            self.max[slot] = -np.inf
+        self.count[slot] += present
+        self.sum[slot] += np.where(present, values, 0.0)
+        np.fmin(self.min[slot], values, out=self.min[slot])
+        np.fmax(self.max[slot], values, out=self.max[slot])
+
+    def window(self, now: float, seconds: float) -> Dict[str, np.ndarray]:
+        """Count, mean, min and max per field over the buckets covering the last `seconds`"""
+        current = int(now // self.resolution)
+        first = current - max(1, int(np.ceil(seconds / self.resolution))) + 1
+        selected = (self.number >= first) & (self.number <= current)
+        count = self.count[selected].sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum[selected].sum(axis=0) / count
+        return {
+            "count": count,
+            "mean": mean,
+            "min": self.min[selected].min(axis=0, initial=np.inf),
+            "max": self.max[selected].max(axis=0, initial=-np.inf)
+        }
+
+    def series(self, now: float, seconds: float) -> List[Dict]:
+        """Buckets in the last `seconds`, oldest first, as {"timestamp", field: {"mean", "min", "max"}}"""
+        current = int(now // self.resolution)
+        first = current - max(1, int(np.ceil(seconds / self.resolution))) + 1
+        slots = np.flatnonzero((self.number >= first) & (self.number <= current))
+        series = []
+        for slot in slots[np.argsort(self.number[slots])]:
+            point = {"timestamp": float(self.number[slot] * self.resolution)}
+            for i, field in enumerate(FIELDS):
+                count = int(self.count[slot, i])
+                point[field] = {
+                    "mean": round(float(self.sum[slot, i] / count), 3),
+                    "min": round(float(self.min[slot, i]), 3),
+                    "max": round(float(self.max[slot, i]), 3)
+                } if count else None
+            series.append(point)
+        return series
+
+
+class DeviceSeries:
+    """Raw sample ring buffer and rollups of one sensor device"""
+
+    def __init__(self, device_id: str, capacity: int, minute_buckets: int, hour_buckets: int):
+        self.device_id = device_id
+        self.timestamps = np.zeros(capacity, dtype=np.float64)
+        self.values = np.full((capacity, len(FIELDS)), np.nan, dtype=np.float32)
+        self.head = 0  # slot the next sample goes to
+        self.size = 0
+        self.samples = 0  # total ever added
+        self.rollups = (Rollup(MINUTE, minute_buckets), Rollup(HOUR, hour_buckets))
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        return self.timestamps.nbytes + self.values.nbytes + sum(rollup.nbytes for rollup in self.rollups)
+
+    def add(self, timestamp: float, values: np.ndarray) -> None:
+        present = ~np.isnan(values)
+        with self.lock:
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = values
+            self.head = (self.head + 1) % len(self.timestamps)
+            self.size = min(self.size + 1, len(self.timestamps))
+            self.samples += 1
+            for rollup in self.rollups:
+                rollup.add(timestamp, values, present)
+
+    def latest(self) -> Optional[Dict]:
+        """Most recent good value of every field from the raw buffer, with the newest sample's time"""
+        with self.lock:
+            if not self.size:
+                return None
+            # Newest first
+            order = (self.head - 1 - np.arange(self.size)) % len(self.timestamps)
+            values = self.values[order]
+            timestamp = float(self.timestamps[order[0]])
+        reading = {}
+        for i, field in enumerate(FIELDS):
+            good = np.flatnonzero(~np.isnan(values[:, i]))
+            reading[field] = float(values[good[0], i]) if len(good) else None
+        reading["timestamp"] = timestamp
+        return reading
+
+    def rollup_for(self, seconds: float) -> Rollup:
+        """The finest rollup that covers `seconds`"""
+        minute, hour = self.rollups
+        return minute if seconds <= minute.span else hour
+
+    def window(self, seconds: float, now: Optional[float] = None) -> Dict[str, Dict]:
+        """{field: {"count", "mean", "min", "max"}} over the last `seconds`"""
+        now = time.time() if now is None else now
+        with self.lock:
+            summary = self.rollup_for(seconds).window(now, seconds)
+        result = {}
+        for i, field in enumerate(FIELDS):
+            count = int(summary["count"][i])
+            result[field] = {
+                "count": count,
+                "mean": round(float(summary["mean"][i]), 3) if count else None,
+                "min": round(float(summary["min"][i]), 3) if count else None,
+                "max": round(float(summary["max"][i]), 3) if count else None
+            }
+        return result
+
+    def history(self, seconds: float, resolution: str = "auto", now: Optional[float] = None) -> List[Dict]:
+        """Readings of the last `seconds`: raw samples, or "minute" / "hour" buckets"""
+        now = time.time() if now is None else now
+        with self.lock:
+            if resolution == "raw":
+                order = (self.head - self.size + np.arange(self.size)) % len(self.timestamps)
+                order = order[self.timestamps[order] > now - seconds]
+                timestamps, values = self.timestamps[order], self.values[order]
+            elif resolution in ("minute", "hour"):
+                return self.rollups[resolution == "hour"].series(now, seconds)
+            else:
+                return self.rollup_for(seconds).series(now, seconds)
+        return [
+            {"timestamp": float(timestamp),
+             **{field: None if np.isnan(value) else float(value) for field, value in zip(FIELDS, row)}}
+            for timestamp, row in zip(timestamps, values)
+        ]
+
+
+class SensorStore:
+    """Bounded per-device sensor time series with windowed rollups"""
+
+    def __init__(self, capacity: int = 1024, max_devices: int = 500, minute_buckets: int = 180,
+                 hour_buckets: int = 168):
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.minute_buckets = minute_buckets
+        self.hour_buckets = hour_buckets
+        # Least recently updated first
+        self._devices: "OrderedDict[str, DeviceSeries]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._updated = threading.Condition(self._lock)
+        self.evicted = 0
+
+    def add(self, device_id: str, values: np.ndarray, timestamp: Optional[float] = None) -> None:
+        """Record one sample; values is a FIELDS-ordered vector, see parse_readings()"""
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            series = self._devices.get(device_id)
+            if series is None:
+                if len(self._devices) >= self.max_devices:
+                    self._devices.popitem(last=False)
+                    self.evicted += 1
+                series = DeviceSeries(device_id, self.capacity, self.minute_buckets, self.hour_buckets)
+                self._devices[device_id] = series
+                SENSOR_DEVICES.set(len(self._devices))
+            else:
+                self._devices.move_to_end(device_id)
+        series.add(timestamp, values)
+        with self._updated:
+            self._updated.notify_all()
+
+    def device(self, device_id: Optional[str] = None) -> Optional[DeviceSeries]:
+        """A device's series, or the most recently updated device's when device_id is None"""
+        with self._lock:
+            if device_id is not None:
+                return self._devices.get(device_id)
+            return next(reversed(self._devices.values()), None)
+
+    def latest(self, device_id: Optional[str] = None) -> Optional[Dict]:
+        """Latest readings of a device with "device_id" and "age_seconds", or None"""
+        series = self.device(device_id)
+        reading = series.latest() if series is not None else None
+        if reading is None:
+            return None
+        reading["device_id"] = series.device_id
+        reading["age_seconds"] = round(time.time() - reading["timestamp"], 1)
+        return reading
+
+    def window_mean(self, field: str, seconds: float, device_id: Optional[str] = None) -> Optional[float]:
+        """Mean of one field over the last `seconds`, or None without samples"""
+        series = self.device(device_id)
+        return series.window(seconds)[field]["mean"] if series is not None else None
+
+    def wait_for_update(self, since: float, timeout: float, device_id: Optional[str] = None) -> bool:
+        """Block until a device (any device when None) has a sample newer than `since`"""
+        deadline = time.monotonic() + timeout
+        while True:
+            reading = self.latest(device_id)
+            if reading is not None and reading["timestamp"] > since:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self._updated:
+                self._updated.wait(remaining)
+
+    def devices(self) -> List[Dict]:
+        """Latest readings of every device, most recently updated first"""
+        with self._lock:
+            device_ids = list(reversed(self._devices))
+        readings = [self.latest(device_id) for device_id in device_ids]
+        return [reading for reading in readings if reading is not None]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            series = list(self._devices.values())
+            evicted = self.evicted
+        return {
+            "devices": len(series),
+            "max_devices": self.max_devices,
+            "evicted": evicted,
+            "samples": sum(s.samples for s in series),
+            "memory_bytes": sum(s.nbytes for s in series)
+        }
+
+
+class SensorIngest:
+    """Background MQTT subscriber that feeds every device's messages into a SensorStore"""
+
+    def __init__(self, store: SensorStore, broker: str, topics: Sequence[str], port: int = 1883,
+                 request_topic: str = "sensor/request"):
+        self.store = store
+        self.broker = broker
+        self.port = port
+        self.topics = [topic.strip() for topic in topics if topic.strip()]
+        self.request_topic = request_topic
+        self.connected = threading.Event()
+        self._client = None
+
+    def start(self) -> None:
+        """Connect in the background; paho keeps reconnecting until stop()"""
+        client = mqtt.Client()
+        client.on_connect = self._on_connect
+        client.on_disconnect = lambda client, userdata, rc: self.connected.clear()
+        client.on_message = self._on_message
+        client.connect_async(self.broker, self.port, 60)
+        client.loop_start()
+        self._client = client
+
+    def stop(self) -> None:
+        if self._client is not None:
+            self._client.loop_stop()
+            self._client.disconnect()
+            self._client = None
+
+    def request_readings(self) -> None:
+        """Ask every Pi for an immediate snapshot"""
+        if self._client is not None and self.connected.is_set():
+            self._client.publish(self.request_topic, "send_data")
+
+    def _on_connect(self, client, userdata, flags, rc) -> None:
+        if rc != 0:
+            logger.error(f"Sensor MQTT connection refused with result code {rc}")
+            return
+        for topic in self.topics:
+            client.subscribe(topic)
+        logger.info(f"Subscribed to {', '.join(self.topics)} on {self.broker}")
+        self.connected.set()
+
+    def _on_message(self, client, userdata, message) -> None:
+        try:
+            payload = json.loads(message.payload.decode())
+            if not isinstance(payload, dict):
+                raise ValueError("payload is not an object")
+        except (UnicodeDecodeError, ValueError) as e:
+            SENSOR_MESSAGES.inc(1, "invalid")
+            logger.warning(f"Ignoring sensor message on {message.topic}: {e}")
+            return
+        self.store.add(self.device_id(message.topic, payload), parse_readings(payload))
+        SENSOR_MESSAGES.inc(1, "ok")
+
+    @staticmethod
+    def device_id(topic: str, payload: Dict) -> str:
+        """The payload's device_id, else the topic level between "sensor/" and "/data" """
+        if payload.get("device_id"):
+            return str(payload["device_id"])
+        levels = topic.split("/")
+        return levels[1] if len(levels) == 3 else DEFAULT_DEVICE
@@ -0,0 +1,22 @@
+"""Makes the modules tomatoApp shares with the model server importable.
+
+instrumentation.py, profiling.py, response_format.py and memory_guard.py
+live in models/ and are used by both services. Importing this module puts
+models/ at the end of sys.path, so `from instrumentation import ...` finds
+them from tomatoApp without a copy or a symlink, which a Windows checkout
+or core.symlinks=false turns into a one-line text file.
+
+Every tomatoApp module that imports a shared module imports this one first,
+so each of them also works on its own (benchmarks, analysis pool workers).
+Set TOMATO_SHARED_DIR when models/ is not next to tomatoApp/.
+"""
+import os
+import sys
+
+SHARED_DIR = os.environ.get(
+    "TOMATO_SHARED_DIR",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+)
+
+if SHARED_DIR not in sys.path:
+    sys.path.append(SHARED_DIR)
@@ -1,25 +1,63 @@
 import requests
 import base64
-import matplotlib.pyplot as plt
 import numpy as np
 from datetime import datetime, timedelta
 from typing import Dict, List, Tuple, Union, Optional
 import os
-import cv2
-from skimage import exposure, feature, filters
-from skimage.feature import graycomatrix, graycoprops
-import matplotlib.cm as cm
-from scipy import ndimage
-import mahotas as mt
+import time
+# OpenCV, scikit-image, SciPy, mahotas and matplotlib take over a second to import and are only
+# needed for image analysis, so the methods that use them import them on first call. Prediction,
+# weather and recommendations never load them.
 # Import the disease database
 from tomato_disease_database import TOMATO_DISEASE_DATABASE
+import shared_modules  # noqa: F401  (puts models/ on sys.path)
+from instrumentation import timed, outgoing_headers, stage_report
+import response_format
+from model_server_pool import ModelServerPool, retry_after_seconds
+from analysis_result import AnalysisResult
+
+# Relative deadline understood by the model server's admission control
+DEADLINE_HEADER = "X-Request-Deadline-Ms"
+
+# Unscaled Grad-CAM activation (map / 255 * peak) from which a leaf pixel counts as diseased. It
+# depends on the disease model, so there is no default: calibrate it with the cam benchmark suite
+# on real photos. Until it is set, severity comes from the colour rules and the map is only drawn
+CAM_ACTIVATION_THRESHOLD = float(os.environ.get("CAM_ACTIVATION_THRESHOLD", 0))
+
+# Share of TTA views that must vote for the predicted class to keep its severity level. With
+# 8 views, two dissenting views are what a crop that misses the lesion gives; three or more
+# mean the class itself is in doubt, and the level drops by one
+MIN_TTA_AGREEMENT = 0.75
+
+# Base URL of the weather API; overridden to point at a local stub in soak tests
+WEATHER_API_URL = os.environ.get("WEATHER_API_URL", "http://api.weatherapi.com/v1")
 
 class EnhancedTomatoDiseaseClient:
-    def __init__(self, server_url: str, api_key: str, location: str):
-        """Initialize client with server URL and weather API credentials"""
+    # classes_version -> class lists from the model server's /classes, shared by every client
+    _classes: Dict[str, Dict] = {}
+
+    def __init__(self, server_url: Union[str, List[str]], api_key: str, location: str, tta_views: int = 0,
+                 request_timeout: float = 30.0, compact: bool = False, cam: bool = False):
+        """Initialize client with server URL and weather API credentials
+        
+        server_url may list several model servers, as a list or separated by
+        commas; requests are balanced across them by a shared ModelServerPool.
+        tta_views > 1 asks the model server for test-time augmentation, which
+        adds an uncertainty score to each prediction. request_timeout bounds
+        each call to the model server and the weather API, in seconds.
+        compact asks for the compact prediction format, binary-encoded when
+        msgpack or cbor2 is installed; send_image still returns the full form.
+        cam asks for the model's Grad-CAM map with each prediction, which
+        analyze_image draws and, once CAM_ACTIVATION_THRESHOLD is calibrated,
+        uses instead of the colour and texture rules.
+        """
         self.server_url = server_url
         self.api_key = api_key
         self.location = location
+        self.tta_views = tta_views
+        self.request_timeout = request_timeout
+        self.compact = compact
+        self.cam = cam
         self.disease_database = TOMATO_DISEASE_DATABASE
         self.output_dir = os.path.join("codes", "disease_detection_outputs")
         os.makedirs(self.output_dir, exist_ok=True)
@@ -32,17 +70,66 @@ class EnhancedTomatoDiseaseClient:
                 image_data = base64.b64encode(image_file.read()).decode('utf-8')
             
             # Send to server
-            response = requests.post(
-                f"{self.server_url}/predict",
-                json={"image": image_data}
-            )
+            payload = {"image": image_data}
+            headers = {}
+            if self.tta_views > 1:
+                payload["tta"] = self.tta_views
+            if self.cam:
+                payload["cam"] = True
+            if self.compact:
+                payload["compact"] = True
+                headers["Accept"] = ", ".join(response_format.available_media_types())
+            # A hedged copy must not add the same image to the similarity index twice
+            response = self._post_with_deadline("/predict", payload, headers, hedge_payload={**payload, "store": False})
             response.raise_for_status()
-            return response.json()
+            result = response_format.decode(response.content, response.headers.get("Content-Type"))
+            return self.expand_prediction(result)
             
         except Exception as e:
             print(f"Error sending image to server: {e}")
             return None
 
+    def expand_prediction(self, result: Dict) -> Dict:
+        """Turn a compact prediction back into the full form with class names and all probabilities"""
+        version = result.get("classes_version")
+        if version is None:
+            return result
+        if version not in self._classes:
+            response = self.server_pool.get("/classes", self.request_timeout, headers=outgoing_headers())
+            response.raise_for_status()
+            classes = response.json()
+            self._classes[classes["version"]] = classes
+            if classes["version"] != version:
+                raise ValueError(f"Model server classes changed from {version} to {classes['version']}")
+        return response_format.expand(result, self._classes[version]["disease"])
+
+    @property
+    def server_pool(self) -> ModelServerPool:
+        return ModelServerPool.shared(self.server_url)
+
+    def _post_with_deadline(self, path: str, payload: Dict, extra_headers: Optional[Dict] = None,
+                            hedge_payload: Optional[Dict] = None) -> requests.Response:
+        """POST within request_timeout, passing the remaining time to the server as a deadline
+        
+        The pool fails over or hedges to a second model server on its own. A
+        503 from every server tried, with a Retry-After that still fits in the
+        budget, is retried once.
+        """
+        deadline = time.monotonic() + self.request_timeout
+        for attempt in range(2):
+            remaining = deadline - time.monotonic()
+            headers = {**outgoing_headers(), **(extra_headers or {}), DEADLINE_HEADER: str(max(1, int(remaining * 1000)))}
+            response = self.server_pool.post(path, remaining, json=payload, headers=headers, hedge=True,
+                                             hedge_json=hedge_payload)
+            if response.status_code != 503 or not response.headers.get("Retry-After") or attempt == 1:
+                break
+            retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+            if retry_after >= deadline - time.monotonic():
+                break
+            print(f"Model server busy, retrying in {retry_after:g}s")
+            time.sleep(retry_after)
+        return response
+
     def validate_tomato_leaf(self, image_path: str) -> Dict:
         """Validate if the image contains a tomato leaf
         
@@ -57,9 +144,11 @@ class EnhancedTomatoDiseaseClient:
                 image_data = base64.b64encode(image_file.read()).decode('utf-8')
             
             # Send to server for leaf validation only
-            response = requests.post(
-                f"{self.server_url}/validate_leaf",
-                json={"image": image_data}
+            response = self.server_pool.post(
+                "/validate_leaf",
+                self.request_timeout,
+                json={"image": image_data},
+                headers=outgoing_headers()
             )
             response.raise_for_status()
             return response.json()
@@ -74,6 +163,8 @@ class EnhancedTomatoDiseaseClient:
 
     def extract_texture_features(self, image: np.ndarray) -> np.ndarray:
         """Extract Haralick texture features"""
+        import cv2
+        import mahotas as mt
         if len(image.shape) == 3:
             gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
         else:
@@ -83,6 +174,8 @@ class EnhancedTomatoDiseaseClient:
 
     def calculate_glcm_features(self, image: np.ndarray) -> Dict[str, float]:
         """Calculate GLCM features"""
+        import cv2
+        from skimage.feature import graycomatrix, graycoprops
         gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
         glcm = graycomatrix(gray, [1], [0], symmetric=True, normed=True)
         
@@ -96,6 +189,7 @@ class EnhancedTomatoDiseaseClient:
 
     def segment_leaf(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
         """Segment the leaf from background"""
+        import cv2
         lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
         a_channel = lab[:,:,1]
         _, binary = cv2.threshold(a_channel, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
@@ -114,6 +208,8 @@ class EnhancedTomatoDiseaseClient:
 
     def detect_disease_regions(self, image: np.ndarray, mask: np.ndarray, predicted_class: str) -> Tuple[np.ndarray, np.ndarray]:
         """Detect disease-affected regions"""
+        import cv2
+        from skimage import feature, filters
         hsv = cv2.cvtColor(image, cv2.COLOR_RGB2HSV)
         lab = cv2.cvtColor(image, cv2.COLOR_RGB2LAB)
         disease_mask = np.zeros_like(mask)
@@ -165,8 +261,38 @@ class EnhancedTomatoDiseaseClient:
         
         return disease_mask, heatmap
 
+    @staticmethod
+    def cam_activation(cam: Dict, shape: Tuple[int, int]) -> np.ndarray:
+        """Unscaled Grad-CAM activation of a response's "cam", resized to shape (height, width)"""
+        import cv2
+        activation = cv2.resize(response_format.decode_map(cam).astype(np.float32), (shape[1], shape[0]),
+                                interpolation=cv2.INTER_LINEAR)
+        return activation / 255.0 * float(cam.get("peak", 0.0))
+
+    def cam_disease_regions(self, image: np.ndarray, mask: np.ndarray, predicted_class: str,
+                            activation: np.ndarray,
+                            threshold: float = CAM_ACTIVATION_THRESHOLD) -> Tuple[np.ndarray, np.ndarray]:
+        """Disease regions from the model's class-activation map instead of colour and texture rules
+        
+        activation comes from cam_activation(). A pixel is diseased where it is
+        at least threshold; the map's own maximum is not used, because every
+        map reaches it, however small the lesions are.
+        """
+        import cv2
+        from matplotlib import cm
+        if 'healthy' in predicted_class:
+            # The map shows where the model saw a healthy leaf, not lesions
+            disease_mask = np.zeros_like(mask)
+        else:
+            disease_mask = cv2.bitwise_and(np.where(activation >= threshold, 255, 0).astype(np.uint8), mask)
+        heatmap = cm.jet(activation / max(float(activation.max()), 1e-12))[:, :, :3]
+        return disease_mask, heatmap
+
     def create_disease_heatmap(self, image: np.ndarray, disease_mask: np.ndarray) -> np.ndarray:
         """Create a heatmap of disease severity"""
+        from matplotlib import cm
+        from scipy import ndimage
+        from skimage import exposure
         mask_float = disease_mask.astype(float) / 255.0
         heatmap = ndimage.gaussian_filter(mask_float, sigma=3)
         heatmap = exposure.rescale_intensity(heatmap, out_range=(0, 1))
@@ -175,74 +301,125 @@ class EnhancedTomatoDiseaseClient:
 
     def process_image_analysis(self, image_path: str, prediction_result: Dict) -> Tuple[str, float]:
         """Process leaf image with advanced techniques"""
+        with timed("decode"):
+            img = self.load_image(image_path)
+        return self.analyze_image(img, prediction_result)
+
+    @staticmethod
+    def load_image(image_path: str) -> np.ndarray:
+        """Decode an image file to an RGB array"""
+        import cv2
         img = cv2.imread(image_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def analyze_image(self, img: np.ndarray, prediction_result: Dict) -> Tuple[str, float]:
+        """Segment, score and render an already decoded RGB image; returns (save_path, severity)"""
+        result = self.analyze(img, prediction_result)
+        return self.render_analysis(img, result), result.severity
+
+    def analyze(self, img: np.ndarray, prediction_result: Dict) -> AnalysisResult:
+        """Segment and score an already decoded RGB image without rendering anything
         
-        leaf_mask, binary = self.segment_leaf(img)
-        disease_mask, heatmap = self.detect_disease_regions(img, leaf_mask, prediction_result["predicted_class"])
+        A prediction that carries a Grad-CAM map ("cam") is scored from the map
+        when CAM_ACTIVATION_THRESHOLD is set; otherwise the map is kept for the
+        rendered heatmap and the colour rules score it.
+        """
+        cam = prediction_result.get("cam")
+        use_cam = bool(cam) and CAM_ACTIVATION_THRESHOLD > 0 and "peak" in cam
+        with timed("segmentation"):
+            leaf_mask, binary = self.segment_leaf(img)
+        with timed("region_detection"):
+            if use_cam:
+                disease_mask, _ = self.cam_disease_regions(img, leaf_mask, prediction_result["predicted_class"],
+                                                           self.cam_activation(cam, img.shape[:2]))
+            else:
+                disease_mask, _ = self.detect_disease_regions(img, leaf_mask, prediction_result["predicted_class"])
+        with timed("result_encoding"):
+            return AnalysisResult.from_masks(prediction_result, leaf_mask, disease_mask,
+                                             "cam" if use_cam else "rules", cam)
+
+    def render_analysis(self, img: np.ndarray, result: AnalysisResult, save_path: Optional[str] = None) -> str:
+        """Draw the four-panel analysis figure for an image and its AnalysisResult; returns the PNG path"""
+        import cv2
+        import matplotlib.pyplot as plt
+        from matplotlib import cm
+        leaf_mask, disease_mask = result.masks(img.shape[:2])
+        if result.cam:
+            activation = cv2.resize(response_format.decode_map(result.cam), (img.shape[1], img.shape[0]),
+                                    interpolation=cv2.INTER_LINEAR)
+            heatmap = cm.jet(activation / 255.0)[:, :, :3]
+        else:
+            heatmap = self.create_disease_heatmap(img, disease_mask)
         
         alpha = 0.6
         blended = img.copy().astype(float) / 255
         blended[disease_mask > 0] = blended[disease_mask > 0] * (1 - alpha) + heatmap[disease_mask > 0] * alpha
         
-        severity = np.sum(disease_mask > 0) / np.sum(leaf_mask > 0) * 100
-        
-        # Create disease-specific subfolder
-        disease_name = prediction_result['predicted_class']
-        disease_output_dir = os.path.join(self.output_dir, disease_name)
-        os.makedirs(disease_output_dir, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"analysis_{timestamp}_{prediction_result['predicted_class']}_{prediction_result['confidence']:.2f}_severity_{severity:.1f}.png"
-        save_path = os.path.join(disease_output_dir, filename)
-        
-        plt.figure(figsize=(15, 5))
-        
-        plt.subplot(141)
-        plt.imshow(img)
-        plt.title('Original Image')
-        plt.axis('off')
-        
-        plt.subplot(142)
-        plt.imshow(leaf_mask, cmap='gray')
-        plt.title('Leaf Segmentation')
-        plt.axis('off')
-        
-        plt.subplot(143)
-        plt.imshow(heatmap)
-        plt.title(f'Disease Heatmap\nSeverity: {severity:.1f}%')
-        plt.axis('off')
-        
-        plt.subplot(144)
-        plt.imshow(blended)
-        plt.title('Highlighted Areas')
-        plt.axis('off')
-        
-        plt.tight_layout()
-        plt.savefig(save_path, dpi=300, bbox_inches='tight')
-        plt.close()
+        severity = result.severity
+        if save_path is None:
+            # Create disease-specific subfolder
+            disease_output_dir = os.path.join(self.output_dir, result.predicted_class)
+            os.makedirs(disease_output_dir, exist_ok=True)
+            
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            filename = f"analysis_{timestamp}_{result.predicted_class}_{result.confidence:.2f}_severity_{severity:.1f}.png"
+            save_path = os.path.join(disease_output_dir, filename)
+        
+        with timed("rendering"):
+            figure = plt.figure(figsize=(15, 5))
+            try:
+                plt.subplot(141)
+                plt.imshow(img)
+                plt.title('Original Image')
+                plt.axis('off')
+            
+                plt.subplot(142)
+                plt.imshow(leaf_mask, cmap='gray')
+                plt.title('Leaf Segmentation')
+                plt.axis('off')
+            
+                plt.subplot(143)
+                plt.imshow(heatmap)
+                plt.title(f'Disease Heatmap\nSeverity: {severity:.1f}%')
+                plt.axis('off')
+            
+                plt.subplot(144)
+                plt.imshow(blended)
+                plt.title('Highlighted Areas')
+                plt.axis('off')
+            
+                plt.tight_layout()
+                plt.savefig(save_path, dpi=300, bbox_inches='tight')
+            finally:
+                # Also when drawing or saving fails; pyplot otherwise keeps the figure for the life of the process
+                plt.close(figure)
         
-        return save_path, severity
+        return save_path
 
     def get_weather_data(self) -> Tuple[Optional[Dict], Optional[List[float]], Optional[Dict]]:
         """Fetch weather data"""
+        with timed("weather_fetch"):
+            return self._fetch_weather_data()
+
+    def _fetch_weather_data(self) -> Tuple[Optional[Dict], Optional[List[float]], Optional[Dict]]:
+        """Fetch current conditions, three days of rainfall history and a three day forecast"""
         try:
-            current_url = f"http://api.weatherapi.com/v1/current.json?key={self.api_key}&q={self.location}"
-            current_response = requests.get(current_url)
+            current_url = f"{WEATHER_API_URL}/current.json?key={self.api_key}&q={self.location}"
+            current_response = requests.get(current_url, timeout=self.request_timeout)
             current_response.raise_for_status()
             current_weather = current_response.json()["current"]
 
             rainfall_data = []
             for i in range(1, 4):
                 date = (datetime.today() - timedelta(days=i)).strftime("%Y-%m-%d")
-                history_url = f"http://api.weatherapi.com/v1/history.json?key={self.api_key}&q={self.location}&dt={date}"
-                history_response = requests.get(history_url)
+                history_url = f"{WEATHER_API_URL}/history.json?key={self.api_key}&q={self.location}&dt={date}"
+                history_response = requests.get(history_url, timeout=self.request_timeout)
                 history_response.raise_for_status()
                 rainfall = history_response.json()["forecast"]["forecastday"][0]["day"]["totalprecip_mm"]
                 rainfall_data.append(rainfall)
 
-            forecast_url = f"http://api.weatherapi.com/v1/forecast.json?key={self.api_key}&q={self.location}&days=3"
-            forecast_response = requests.get(forecast_url)
+            forecast_url = f"{WEATHER_API_URL}/forecast.json?key={self.api_key}&q={self.location}&days=3"
+            forecast_response = requests.get(forecast_url, timeout=self.request_timeout)
             forecast_response.raise_for_status()
             forecast_data = forecast_response.json()["forecast"]["forecastday"]
 
@@ -252,18 +429,23 @@ class EnhancedTomatoDiseaseClient:
             print(f"Error fetching weather data: {e}")
             return None, None, None
 
-    def generate_recommendations(self, predicted_class: str, confidence: float, weather_data: Dict) -> Dict:
-        """Generate comprehensive recommendations based on disease and conditions"""
+    def generate_recommendations(self, predicted_class: str, confidence: float, weather_data: Dict,
+                                 uncertainty: Optional[float] = None, agreement: Optional[float] = None) -> Dict:
+        """Generate comprehensive recommendations based on disease and conditions
+        
+        uncertainty and agreement come from the prediction's "tta" block, when the server used TTA.
+        """
         if predicted_class == 'Tomato_healthy':
             return self._get_healthy_recommendations()
 
         disease_info = self.disease_database.get(predicted_class, {})
         disease_risk = self._calculate_disease_risk(weather_data, predicted_class)
-        severity = self.determine_severity_level(confidence)
+        severity = self.determine_severity_level(confidence, agreement)
 
         return {
             'disease': predicted_class,
             'confidence': confidence,
+            'uncertainty': uncertainty,
             'risk_level': disease_risk,
             'severity': severity,
             'severity_description': disease_info.get('severity_levels', {}).get(severity, ''),
@@ -274,14 +456,26 @@ class EnhancedTomatoDiseaseClient:
             'treatment_schedule': self._get_treatment_schedule(predicted_class, weather_data)
         }
 
-    def determine_severity_level(self, confidence: float) -> str:
-        """Determine severity level based on confidence score"""
+    def determine_severity_level(self, confidence: float, agreement: Optional[float] = None) -> str:
+        """Determine severity level based on confidence score
+        
+        With TTA the confidence is already the mean over the views, so views
+        that doubt the class lower it directly. The level drops by one more
+        only when fewer than MIN_TTA_AGREEMENT of the views vote for the class.
+        The normalized entropy is not used: it is well above zero for any
+        confident prediction over ten classes (0.24 at p=0.9), so discounting
+        by it moved nearly every TTA prediction down a level.
+        """
+        levels = ['low', 'medium', 'high']
         if confidence >= 0.8:
-            return 'high'
+            level = 2
         elif confidence >= 0.6:
-            return 'medium'
+            level = 1
         else:
-            return 'low'
+            level = 0
+        if agreement is not None and agreement < MIN_TTA_AGREEMENT:
+            level = max(0, level - 1)
+        return levels[level]
 
     def _calculate_disease_risk(self, weather_data: Dict, disease: str) -> float:
         """Calculate disease risk based on weather conditions and disease-specific thresholds"""
@@ -290,6 +484,9 @@ class EnhancedTomatoDiseaseClient:
 
         temp = weather_data.get('temp_c', 20)  # Default value if missing
         humidity = weather_data.get('humidity', 50)  # Default value if missing
+        # Sustained leaf wetness drives infection more than one reading, so prefer the sensors' 24-hour mean
+        if weather_data.get('humidity_24h_avg') is not None:
+            humidity = weather_data['humidity_24h_avg']
         disease_info = self.disease_database[disease]
         
         optimal_temp = disease_info.get('optimal_temp', (20, 30))
@@ -508,7 +705,9 @@ def run_client(image_path: str, server_url: str, api_key: str, location: str):
         recommendations = client.generate_recommendations(
             prediction_result["predicted_class"],
             prediction_result["confidence"],
-            current_weather
+            current_weather,
+            prediction_result.get("tta", {}).get("uncertainty"),
+            prediction_result.get("tta", {}).get("agreement")
         )
         
         # Print detailed results
@@ -547,6 +746,10 @@ def run_client(image_path: str, server_url: str, api_key: str, location: str):
         for i, schedule in enumerate(recommendations['treatment_schedule'], 1):
             print(f"{i}. {schedule}")
 
+        print("\nStage Timings:")
+        for stage, stats in stage_report().items():
+            print(f"{stage}: {stats['mean_ms']:.1f} ms (n={stats['count']})")
+
     except Exception as e:
         print(f"Error running client: {e}")
 